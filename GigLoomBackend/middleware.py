@@ -1,8 +1,10 @@
+import re
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
+from django.conf import settings
 
 User = get_user_model()
 
@@ -30,3 +32,21 @@ class TokenAuthMiddleware(BaseMiddleware):
             scope['user'] = AnonymousUser()
         
         return await super().__call__(scope, receive, send)
+
+
+class ImmutableMediaMiddleware:
+    """
+    Marks content-addressed media (gigs.storage blobs and their variants) as
+    immutable: a URL named after a hash never changes what it serves.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pattern = re.compile(
+            r'^/?%s(blobs/[0-9a-f]{2}/|derivatives/)[0-9a-f]{64}[._]' % re.escape(settings.MEDIA_URL.lstrip('/'))
+        )
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.status_code == 200 and self.pattern.match(request.path):
+            response['Cache-Control'] = f'public, max-age={settings.MEDIA_IMMUTABLE_MAX_AGE}, immutable'
+        return response
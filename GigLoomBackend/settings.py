@@ -76,6 +76,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'GigLoomBackend.middleware.ImmutableMediaMiddleware',
 ]
 
 ROOT_URLCONF = 'GigLoomBackend.urls'
@@ -100,12 +101,97 @@ WSGI_APPLICATION = 'GigLoomBackend.wsgi.application'
 
 ASGI_APPLICATION = 'GigLoomBackend.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
+# 'memory' keeps chat groups inside one daphne process. 'broker' shares them
+# between all daphne processes on this host through chats.broker; start
+# `manage.py run_channel_broker` first.
+
+CHANNEL_LAYER = os.getenv('CHANNEL_LAYER', 'memory')
+
+CHANNEL_BROKER_CONFIG = {
+    'path': os.getenv('CHANNEL_BROKER_SOCKET', str(BASE_DIR / 'channel-broker.sock')),
+    'expiry': 60,
+    'group_expiry': 86400,
+    'capacity': 100,
 }
 
+if CHANNEL_LAYER == 'broker':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chats.layers.BrokerChannelLayer',
+            'CONFIG': CHANNEL_BROKER_CONFIG,
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Seconds a chat socket stays present without a heartbeat; consumers renew
+# it every third of that, so crashed workers drop out on their own.
+
+CHAT_PRESENCE_TTL = 60
+
+# Largest page of GET chatrooms/<id>/messages/, and the most missed messages a
+# reconnecting socket replays before telling the client to page the rest.
+
+CHAT_MESSAGES_MAX_PAGE_SIZE = 100
+
+CHAT_RESUME_MAX_MESSAGES = 200
+
+# Frames waiting for a slow chat socket (chats.outbox), plus those written but
+# not yet acknowledged by a client that sends acks; daphne buffers writes, so
+# only acks show a slow client there. Past the limit the socket is closed with
+# code 4008 and the client resumes from history, so keep it above
+# CHAT_RESUME_MAX_MESSAGES.
+
+CHAT_SOCKET_OUTBOX_LIMIT = 500
+
+# Chat message search (GET chatrooms/search/). SQLite FTS5 index by default; use
+# 'chats.search.BasicMessageSearchBackend' on databases without FTS5.
+
+CHAT_SEARCH_BACKEND = os.getenv('CHAT_SEARCH_BACKEND', 'chats.search.SQLiteFTSMessageSearchBackend')
+
+# Push notifications go through chats.push.PushDispatcher. CHAT_PUSH_CLIENT is a
+# factory returning an object with Expo's publish_multiple/check_receipts_multiple
+# (tests swap in a fake); receipts are checked CHAT_PUSH_RECEIPT_DELAY seconds
+# after sending, as Expo recommends.
+
+CHAT_PUSH_CLIENT = 'chats.push.expo_client'
+
+CHAT_PUSH_BATCH_WINDOW = 0.05
+
+CHAT_PUSH_RECEIPT_DELAY = 900
+
+# Messages to an offline recipient in one room within CHAT_PUSH_DIGEST_WINDOW
+# seconds of each other are merged into a single "N new messages" push, sent
+# no later than CHAT_PUSH_DIGEST_MAX_WAIT seconds after the first. 0 disables.
+
+CHAT_PUSH_DIGEST_WINDOW = 3
+
+CHAT_PUSH_DIGEST_MAX_WAIT = 15
+
+# Write-behind mode for chat messages (chats.writebehind): messages are
+# broadcast at once and saved in bulk every CHAT_WRITE_BEHIND_INTERVAL seconds.
+# Until then they live in the journal, which survives a crashed process and is
+# replayed on the next start; with FSYNC off it does not survive a power loss.
+
+CHAT_WRITE_BEHIND = str(os.getenv('CHAT_WRITE_BEHIND')) == 'True'
+
+CHAT_WRITE_BEHIND_INTERVAL = 0.005
+
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500
+
+CHAT_WRITE_BEHIND_FSYNC = False
+
+CHAT_WRITE_BEHIND_JOURNAL = BASE_DIR / 'chat-journal'
+
+# Message ids each process reserves at a time from the table's id sequence.
+# Unused ones are skipped when the process stops.
+
+CHAT_WRITE_BEHIND_ID_BLOCK = 1000
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -117,6 +203,86 @@ DATABASES = {
 }
 
 
+# Gig search
+# SQLite FTS5 index by default; use 'gigs.search.BasicSearchBackend' on databases without FTS5.
+
+GIG_SEARCH_BACKEND = os.getenv('GIG_SEARCH_BACKEND', 'gigs.search.SQLiteFTSSearchBackend')
+
+# Only the newest GIG_SEARCH_MAX_CANDIDATES matches of a search are ranked by
+# relevance; older matches follow them, newest first. 0 ranks every match.
+
+GIG_SEARCH_MAX_CANDIDATES = 2000
+
+# Gig response cache. Entries are keyed by the normalized filters and a generation
+# number that every gig write bumps; point GIG_CACHE_ALIAS at a shared backend
+# (memcached, redis, database) when running several processes.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'gigloom',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
+GIG_CACHE_ALIAS = 'default'
+
+GIG_CACHE_TIMEOUT = 300
+
+# Seconds a gig total is cached for filter sets the per-category counters cannot answer.
+
+GIG_COUNT_CACHE_TIMEOUT = 60
+
+# Radius search (`near=lat,lng&radius=km` on the gig feed).
+
+GIG_NEAR_DEFAULT_RADIUS_KM = 10
+
+GIG_NEAR_MAX_RADIUS_KM = 500
+
+# Most gig ids gigs/batch/ hydrates in one request.
+
+GIG_BATCH_MAX_IDS = 200
+
+# Price histogram of the facets endpoint. Counters are kept per STEP-wide
+# bucket; priceBucket must be a multiple of it. After changing STEP run
+# `manage.py rebuild_gig_listing_counts`.
+
+GIG_FACET_PRICE_STEP = 50
+
+GIG_FACET_PRICE_BUCKET = 500
+
+# Gig image derivatives, built by a worker pool after upload. Sizes are the
+# longest edge in pixels; each is written as WebP and as a JPEG fallback.
+
+GIG_IMAGE_VARIANTS = {
+    'thumbnail': 320,
+    'medium': 1280,
+}
+
+GIG_IMAGE_WORKERS = 2
+
+# Threads writing the images of one upload request to storage concurrently.
+
+GIG_UPLOAD_WORKERS = 4
+
+GIG_IMAGE_WEBP_QUALITY = 80
+
+GIG_IMAGE_JPEG_QUALITY = 85
+
+# Part of every derivative's name along with its size, format and quality.
+# Bump it when the encoding changes in a way the other settings do not show,
+# so rebuilt variants get new names instead of replacing cached files.
+
+GIG_IMAGE_VARIANT_VERSION = 1
+
+# Cache lifetime for hash-named media (blobs/ and their derivatives/), which
+# never change once written. Mirror it on the CDN or static file mapping.
+
+MEDIA_IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
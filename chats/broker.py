@@ -0,0 +1,253 @@
+"""
+Channel broker shared by every daphne process on one host.
+
+chats.layers.BrokerChannelLayer talks to it over a Unix socket with
+length-prefixed JSON frames. The broker owns the channel queues and the group
+memberships, so a group_send from any process reaches consumers in all of them.
+Start it with `manage.py run_channel_broker` before the workers.
+"""
+import asyncio
+import base64
+import fnmatch
+import json
+import logging
+import os
+import re
+import struct
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f"{type(value).__name__} is not serializable in a channel message")
+
+
+def _object_hook(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def encode_frame(payload):
+    body = json.dumps(payload, default=_default, separators=(',', ':')).encode()
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """Next frame from `reader`, or None once the other side has closed."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (length,) = HEADER.unpack(header)
+        if length > MAX_FRAME:
+            raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME} byte limit.")
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(body, object_hook=_object_hook)
+
+
+class ChannelBroker:
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None):
+        self.path = str(path)
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.channel_capacity = [
+            (re.compile(fnmatch.translate(pattern)), value) for pattern, value in (channel_capacity or {}).items()
+        ]
+        # channel -> deque of (expires_at, message)
+        self.queues = defaultdict(deque)
+        # channel -> deque of (writer, request id) waiting in receive()
+        self.waiters = defaultdict(deque)
+        # group -> {channel: expires_at}
+        self.groups = defaultdict(dict)
+        # presence key -> {connection: expires_at}, see chats.presence
+        self.presence = defaultdict(dict)
+        self.server = None
+
+    def get_capacity(self, channel):
+        for pattern, capacity in self.channel_capacity:
+            if pattern.match(channel):
+                return capacity
+        return self.capacity
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_connection, path=self.path)
+        os.chmod(self.path, 0o600)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        sweeper = asyncio.create_task(self.sweep_forever())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+    async def sweep_forever(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def sweep(self):
+        now = time.time()
+        for channel in list(self.queues):
+            queue = self.queues[channel]
+            while queue and queue[0][0] < now:
+                queue.popleft()
+            if not queue:
+                del self.queues[channel]
+        for group in list(self.groups):
+            members = self.groups[group]
+            for channel in [channel for channel, expires_at in members.items() if expires_at < now]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+        for key in list(self.presence):
+            self.present(key, now)
+
+    def present(self, key, now=None):
+        connections = self.presence.get(key)
+        if connections is None:
+            return False
+        now = now or time.time()
+        for connection in [connection for connection, expires_at in connections.items() if expires_at < now]:
+            del connections[connection]
+        if not connections:
+            del self.presence[key]
+            return False
+        return True
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                self.handle_request(writer, frame)
+        except (ConnectionError, ValueError) as e:
+            logger.warning("Dropping channel broker client: %s", e)
+        except asyncio.CancelledError:
+            # Broker shutting down. Ending normally keeps asyncio's stream
+            # callback from logging the cancellation as an error.
+            pass
+        finally:
+            self.forget(writer)
+            writer.close()
+
+    def forget(self, writer):
+        for channel in list(self.waiters):
+            waiters = self.waiters[channel]
+            remaining = deque(waiter for waiter in waiters if waiter[0] is not writer)
+            if remaining:
+                self.waiters[channel] = remaining
+            else:
+                del self.waiters[channel]
+
+    def reply(self, writer, request_id, **payload):
+        if not writer.is_closing():
+            writer.write(encode_frame({'id': request_id, **payload}))
+
+    def handle_request(self, writer, frame):
+        op = frame.get('op')
+        request_id = frame.get('id')
+        if op == 'send':
+            if self.deliver(frame['channel'], frame['message']):
+                self.reply(writer, request_id, ok=True)
+            else:
+                self.reply(writer, request_id, error='full')
+        elif op == 'receive':
+            self.receive(writer, request_id, frame['channel'])
+        elif op == 'cancel':
+            self.cancel(writer, frame['request'], frame['channel'])
+        elif op == 'group_add':
+            self.groups[frame['group']][frame['channel']] = time.time() + self.group_expiry
+            self.reply(writer, request_id, ok=True)
+        elif op == 'group_discard':
+            members = self.groups.get(frame['group'])
+            if members is not None:
+                members.pop(frame['channel'], None)
+                if not members:
+                    del self.groups[frame['group']]
+            self.reply(writer, request_id, ok=True)
+        elif op == 'group_send':
+            now = time.time()
+            for channel, expires_at in list(self.groups.get(frame['group'], {}).items()):
+                # Full members miss the message, as in the other layers.
+                if expires_at >= now:
+                    self.deliver(channel, frame['message'])
+            self.reply(writer, request_id, ok=True)
+        elif op == 'presence_join':
+            # Also the heartbeat: joining again extends the connection's TTL.
+            self.presence[frame['key']][frame['connection']] = time.time() + frame['ttl']
+            self.reply(writer, request_id, ok=True)
+        elif op == 'presence_leave':
+            connections = self.presence.get(frame['key'])
+            if connections is not None:
+                connections.pop(frame['connection'], None)
+                if not connections:
+                    del self.presence[frame['key']]
+            self.reply(writer, request_id, ok=True)
+        elif op == 'presence_check':
+            self.reply(writer, request_id, present=self.present(frame['key']))
+        elif op == 'flush':
+            self.queues.clear()
+            self.groups.clear()
+            self.presence.clear()
+            self.reply(writer, request_id, ok=True)
+        else:
+            self.reply(writer, request_id, error=f"unknown operation {op!r}")
+
+    def deliver(self, channel, message):
+        """Hands `message` to a waiting receive() or queues it. False when the channel is full."""
+        waiters = self.waiters.get(channel)
+        while waiters:
+            writer, request_id = waiters.popleft()
+            if not writer.is_closing():
+                if not waiters:
+                    del self.waiters[channel]
+                self.reply(writer, request_id, message=message)
+                return True
+        self.waiters.pop(channel, None)
+
+        queue = self.queues[channel]
+        now = time.time()
+        while queue and queue[0][0] < now:
+            queue.popleft()
+        if len(queue) >= self.get_capacity(channel):
+            return False
+        queue.append((now + self.expiry, message))
+        return True
+
+    def receive(self, writer, request_id, channel):
+        queue = self.queues.get(channel)
+        now = time.time()
+        while queue:
+            expires_at, message = queue.popleft()
+            if expires_at >= now:
+                if not queue:
+                    del self.queues[channel]
+                self.reply(writer, request_id, message=message)
+                return
+        self.queues.pop(channel, None)
+        self.waiters[channel].append((writer, request_id))
+
+    def cancel(self, writer, request_id, channel):
+        waiters = self.waiters.get(channel)
+        if waiters:
+            try:
+                waiters.remove((writer, request_id))
+            except ValueError:
+                pass
+            if not waiters:
+                del self.waiters[channel]
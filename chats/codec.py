@@ -0,0 +1,78 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    # Optional: without it only JSON is offered.
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'gigloom.msgpack'
+
+# Frame keys and their one-letter form on the msgpack protocol.
+SHORT_KEYS = {
+    'type': 't',
+    'room': 'r',
+    'rooms': 'R',
+    'id': 'i',
+    'ids': 'I',
+    'seq': 's',
+    'last_seq': 'l',
+    'message': 'm',
+    'sender_id': 'f',
+    'user_id': 'u',
+    'unread_count': 'n',
+    'has_more': 'h',
+    'received': 'a',
+    'error': 'e',
+}
+
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+class JSONCodec:
+    """The default protocol: one JSON text message per frame."""
+
+    subprotocol = None
+
+    def encode(self, frames):
+        """The send() arguments of each websocket message carrying `frames`."""
+        return [{'text_data': json.dumps(frame)} for frame in frames]
+
+    def decode(self, text_data=None, bytes_data=None):
+        return [json.loads(text_data)]
+
+
+class MsgpackCodec(JSONCodec):
+    """
+    The gigloom.msgpack subprotocol: frames with one-letter keys, sent as one
+    binary message holding an array of every frame waiting for the socket.
+    Clients send a frame or an array of them, and may still send JSON text.
+    """
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, frames):
+        return [{'bytes_data': msgpack.packb([
+            {SHORT_KEYS.get(key, key): value for key, value in frame.items()} for frame in frames
+        ])}]
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return super().decode(text_data)
+        frames = msgpack.unpackb(bytes_data)
+        if isinstance(frames, dict):
+            frames = [frames]
+        return [{LONG_KEYS.get(key, key): value for key, value in frame.items()} for frame in frames]
+
+
+JSON = JSONCodec()
+
+MSGPACK = MsgpackCodec()
+
+
+def negotiate(subprotocols):
+    """The codec of the first subprotocol the client offers that is available, else JSON."""
+    for subprotocol in subprotocols:
+        if subprotocol == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return MSGPACK
+    return JSON
@@ -1,155 +1,342 @@
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import ChatRoom, Message
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import models, transaction
+from .codec import negotiate
+from .inbox import mark_read, record_last_message
+from .presence import is_present, track_presence, untrack_presence
+from .models import ChatRoom, Message, UserProfile
+from .outbox import Outbox
 from django.contrib.auth import get_user_model
-from exponent_server_sdk import (
-    DeviceNotRegisteredError,
-    PushClient,
-    PushMessage,
-    PushServerError,
-    PushTicketError,
-)
-import requests
-from requests.exceptions import ConnectionError, HTTPError
+from .push import get_push_dispatcher
+from .signals import profile_group, use_socket_loop, user_group
+from .writebehind import get_message_buffer, write_behind_enabled
 
 User = get_user_model()
 
-active_users = {}
+# Close code for a socket that fell too far behind; the client reconnects and
+# resumes from the last seq it saw.
+CLOSE_BEHIND = 4008
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        session = requests.Session()
-        session.headers.update({
-            "accept": "application/json",
-            "accept-encoding": "gzip, deflate",
-            "content-type": "application/json",
-        })
-        self.push_client = PushClient(session=session)
+
+class Membership:
+    """What a socket needs to post in one room, resolved when it subscribes."""
+
+    __slots__ = ('id', 'buyer_id', 'recipient_id', 'recipient_push_token')
+
+    def __init__(self, chat_room, user_id):
+        recipient = chat_room.seller if chat_room.buyer_id == user_id else chat_room.buyer
+        self.id = chat_room.id
+        # buyer_id lets chats.inbox.mark_read take a Membership for a ChatRoom.
+        self.buyer_id = chat_room.buyer_id
+        self.recipient_id = recipient.id
+        try:
+            self.recipient_push_token = recipient.userprofile.push_token
+        except UserProfile.DoesNotExist:
+            self.recipient_push_token = None
+
+
+@database_sync_to_async
+def load_memberships(user_id, room_ids=None):
+    """The user's open rooms (or those of `room_ids` they are in), by id, in one query."""
+    chat_rooms = ChatRoom.objects.select_related(
+        'buyer__userprofile', 'seller__userprofile'
+    ).filter(models.Q(buyer_id=user_id) | models.Q(seller_id=user_id), is_closed=False)
+    if room_ids is not None:
+        chat_rooms = chat_rooms.filter(id__in=room_ids)
+    return {chat_room.id: Membership(chat_room, user_id) for chat_room in chat_rooms}
+
+
+def insert_message(chat_room_id, sender_id, message):
+    with transaction.atomic():
+        saved_message = Message.objects.create(
+            room_id=chat_room_id,
+            sender_id=sender_id,
+            content=message,
+            seq=ChatRoom.allocate_seq(chat_room_id, [sender_id])
+        )
+        record_last_message(saved_message)
+        return saved_message
+
+
+@database_sync_to_async
+def get_messages_after(chat_room_id, last_seq, limit):
+    return list(
+        Message.objects.filter(room_id=chat_room_id, seq__gt=last_seq)
+        .order_by('seq')
+        .values('id', 'seq', 'sender_id', 'content')[:limit + 1]
+    )
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """
+    Message, resume and read handling shared by the per-room ChatConsumer and
+    the per-user UserChatConsumer. Room state is resolved on connect (or
+    subscribe) and kept current by room_changed and profile_changed, so
+    posting does no lookups. Every event goes to the room group and to both
+    participants' user groups, tagged with its room. Frames to the client go
+    through a bounded chats.outbox.Outbox, encoded by the chats.codec the
+    client negotiated.
+    """
 
     async def connect(self):
         if self.scope["user"].is_anonymous:
             await self.close()
             return
-            
-        self.chat_room_id = self.scope['url_route']['kwargs']['chat_room_id']
-        self.room_group_name = f"chat_{self.chat_room_id}"
-        self.user_id = str(self.scope["user"].id)
 
-        active_users[self.user_id] = self.chat_room_id
+        self.user_id = self.scope["user"].id
+        use_socket_loop(asyncio.get_running_loop())
+        if not await self.join():
+            await self.close()
+            return
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
+        for room_id in self.presence_rooms():
+            await track_presence(self.user_id, room_id, self.channel_name)
+        for group in self.channel_groups():
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.joined = True
+        self.codec = negotiate(self.scope.get('subprotocols', []))
+        self.outbox = Outbox(self.write_frames, getattr(settings, 'CHAT_SOCKET_OUTBOX_LIMIT', 500))
+        await self.accept(self.codec.subprotocol)
 
     async def disconnect(self, close_code):
-        if self.user_id in active_users:
-            del active_users[self.user_id]
+        if not getattr(self, 'joined', False):
+            return
 
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        self.outbox.close()
+        for room_id in self.presence_rooms():
+            await untrack_presence(self.user_id, room_id, self.channel_name)
+        for group in self.channel_groups():
+            await self.channel_layer.group_discard(group, self.channel_name)
 
-    @database_sync_to_async
-    def save_message(self, chat_room_id, sender_id, message):
-        try:
-            chat_room = ChatRoom.objects.select_for_update().get(id=chat_room_id)
-            return Message.objects.create(
-                room=chat_room,
-                sender_id=sender_id,
-                content=message
-            )
-        except ChatRoom.DoesNotExist:
-            raise ValueError("Chat room does not exist")
-
-    @database_sync_to_async
-    def get_recipient_info(self, chat_room_id, sender_id):
-        chat_room = ChatRoom.objects.select_related('buyer', 'seller').get(id=chat_room_id)
-        is_sender_seller = str(chat_room.seller.id) == str(sender_id)
-        recipient = chat_room.buyer if is_sender_seller else chat_room.seller
-        recipient_id = str(recipient.id)
-        
-        try:
-            push_token = recipient.userprofile.push_token
-            return {
-                'recipient_id': recipient_id,
-                'push_token': push_token
-            }
-        except:
-            return {
-                'recipient_id': recipient_id,
-                'push_token': None
-            }
-
-    @database_sync_to_async
-    def deactivate_push_token(self, token):
-        from accounts.models import UserProfile
-        UserProfile.objects.filter(push_token=token).update(push_token=None)
-
-    async def send_push_notification(self, token, message, sender_name):
-        try:
-            push_message = PushMessage(
-                to=token,
-                body=f"{sender_name}: {message}",
-                data={
-                    'type': 'chat_message',
-                    'chat_room_id': self.chat_room_id
-                },
-                sound="default",
-                title="New Message"
-            )
-
-            response = await sync_to_async(self.push_client.publish)(push_message)
-            await sync_to_async(response.validate_response)()
-
-        except PushServerError as exc:
-            print(f"Push Server Error: {exc.errors}")
-            print(f"Response data: {exc.response_data}")
-        except (ConnectionError, HTTPError) as exc:
-            print(f"Connection Error: {exc}")
-        except DeviceNotRegisteredError:
-            await self.deactivate_push_token(token)
-        except PushTicketError as exc:
-            print(f"Push Ticket Error: {exc.push_response._asdict()}")
-        except Exception as e:
-            print(f"Unknown error sending push notification: {str(e)}")
-
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        sender_id = self.scope["user"].id
-
-        saved_message = await self.save_message(self.chat_room_id, sender_id, message)
-
-        recipient_info = await self.get_recipient_info(self.chat_room_id, sender_id)
-        recipient_id = recipient_info['recipient_id']
-        
-        if recipient_id not in active_users or active_users[recipient_id] != self.chat_room_id:
-            push_token = recipient_info['push_token']
+    async def publish(self, membership, event):
+        event['room'] = membership.id
+        for group in (f"chat_{membership.id}", user_group(self.user_id), user_group(membership.recipient_id)):
+            await self.channel_layer.group_send(group, event)
+
+    async def save_message(self, chat_room_id, sender_id, message):
+        if write_behind_enabled():
+            buffer = get_message_buffer()
+            if not buffer.ids.available():
+                # Reserving ids writes to the database; keep it off the loop.
+                await database_sync_to_async(buffer.ids.reserve)()
+            return buffer.add(chat_room_id, sender_id, message)
+        return await database_sync_to_async(insert_message)(chat_room_id, sender_id, message)
+
+    async def post(self, membership, message):
+        saved_message = await self.save_message(membership.id, self.user_id, message)
+
+        await self.publish(membership, {
+            'type': 'chat_message',
+            'id': saved_message.id,
+            # None in write-behind mode; a `saved` frame follows once it is
+            # committed, see chat_saved.
+            'seq': saved_message.seq,
+            'message': message,
+            'sender_id': self.user_id,
+        })
+
+        if not await is_present(membership.recipient_id, membership.id):
+            push_token = membership.recipient_push_token
             if push_token:
-                sender_name = self.scope["user"].get_full_name() or "New message"
-                await self.send_push_notification(push_token, message, sender_name)
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'sender_id': sender_id,
-            }
-        )
+                get_push_dispatcher().notify(
+                    (membership.recipient_id, membership.id),
+                    push_token,
+                    self.scope["user"].name or "New message",
+                    message,
+                    data={
+                        'type': 'chat_message',
+                        'chat_room_id': str(membership.id)
+                    },
+                )
+
+    async def resume(self, membership, last_seq):
+        """Replays the messages after `last_seq`, the last one the client saw before reconnecting."""
+        limit = getattr(settings, 'CHAT_RESUME_MAX_MESSAGES', 200)
+        missed = await get_messages_after(membership.id, last_seq, limit)
+        replayed = missed[:limit]
+        for message in replayed:
+            await self.send_message(membership.id, message['id'], message['seq'], message['content'], message['sender_id'])
+        # With has_more the gap is too long for the socket; the client pages
+        # the rest in with GET .../messages/?after_seq=.
+        await self.send_frame({
+            'type': 'resume_complete',
+            'room': membership.id,
+            'last_seq': replayed[-1]['seq'] if replayed else last_seq,
+            'has_more': len(missed) > limit,
+        })
+
+    async def read_up_to(self, membership, seq):
+        unread_count = await database_sync_to_async(mark_read)(membership, self.user_id, seq)
+        if unread_count is None:
+            # Another device already read this far.
+            return
+        await self.publish(membership, {
+            'type': 'chat_read',
+            'user_id': self.user_id,
+            'seq': seq,
+            'unread_count': unread_count,
+        })
+
+    async def handle_frame(self, membership, data):
+        frame_type = data.get('type', 'message')
+        if frame_type == 'resume':
+            await self.resume(membership, int(data.get('last_seq') or 0))
+        elif frame_type == 'read':
+            await self.read_up_to(membership, int(data['seq']))
+        else:
+            await self.post(membership, data['message'])
+
+    def follows(self, room_id):
+        return True
 
     async def chat_message(self, event):
-        message = event['message']
-        sender_id = event['sender_id']
+        if self.follows(event['room']):
+            await self.send_message(event['room'], event['id'], event['seq'], event['message'], event['sender_id'])
+
+    async def chat_saved(self, event):
+        # Write-behind messages committed: the seqs of `ids` run up to
+        # last_seq, for resuming and read markers.
+        if self.follows(event['room']):
+            await self.send_frame({
+                'type': 'saved', 'room': event['room'], 'ids': event['ids'], 'last_seq': event['last_seq'],
+            })
+
+    async def chat_read(self, event):
+        if not self.follows(event['room']):
+            return
+        frame = {'type': 'read', 'room': event['room'], 'user_id': event['user_id'], 'seq': event['seq']}
+        if event['user_id'] == self.user_id:
+            # The reader's other devices update their badge.
+            frame['unread_count'] = event['unread_count']
+        # A client that is behind only needs the furthest read.
+        await self.send_frame(frame, coalesce=('read', event['room'], event['user_id']))
 
-        await self.send(text_data=json.dumps({
+    async def send_message(self, room_id, message_id, seq, message, sender_id):
+        await self.send_frame({
+            'room': room_id,
+            'id': message_id,
+            'seq': seq,
             'message': message,
             'sender_id': sender_id,
-        }))
-        
+        })
+
+    async def send_frame(self, frame, coalesce=None):
+        if not self.outbox.put(frame, coalesce):
+            await self.close(code=CLOSE_BEHIND)
+
+    async def write_frames(self, frames):
+        for message in self.codec.encode(frames):
+            await self.send(**message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        for data in self.codec.decode(text_data, bytes_data):
+            if data.get('type') == 'ack':
+                self.outbox.ack(int(data['received']))
+            else:
+                await self.receive_frame(data)
+
+
+class ChatConsumer(BaseChatConsumer):
+    """ws/chat/<chat_room_id>/: one socket per open conversation."""
+
+    async def join(self):
+        self.chat_room_id = int(self.scope['url_route']['kwargs']['chat_room_id'])
+        self.membership = (await load_memberships(self.user_id, [self.chat_room_id])).get(self.chat_room_id)
+        return self.membership is not None
+
+    def channel_groups(self):
+        return [f"chat_{self.chat_room_id}", profile_group(self.membership.recipient_id)]
+
+    def presence_rooms(self):
+        return [self.chat_room_id]
+
+    async def receive_frame(self, data):
+        await self.handle_frame(self.membership, data)
+
+    async def room_changed(self, event):
+        self.membership = (await load_memberships(self.user_id, [self.chat_room_id])).get(self.chat_room_id)
+        if self.membership is None:
+            await self.close()
+
+    async def profile_changed(self, event):
+        self.membership.recipient_push_token = event['push_token']
+
+
+class UserChatConsumer(BaseChatConsumer):
+    """
+    ws/chat/: one socket for all of the user's rooms. It follows every open
+    room through the user's group. Frames to and from it carry a `room`, and
+    {"type": "subscribe" | "unsubscribe", "rooms": [...]} changes which rooms
+    it is sent.
+    """
+
+    async def join(self):
+        self.memberships = await load_memberships(self.user_id)
+        self.subscribed = set(self.memberships)
+        return True
+
+    def channel_groups(self):
+        return [user_group(self.user_id)]
+
+    def presence_rooms(self):
+        # Present, so not pushed to, only where it is sent the messages.
+        return list(self.subscribed)
+
+    async def subscribe(self, rooms):
+        for room_id in rooms - self.subscribed:
+            await track_presence(self.user_id, room_id, self.channel_name)
+        self.subscribed |= rooms
+
+    async def unsubscribe(self, rooms):
+        for room_id in rooms & self.subscribed:
+            await untrack_presence(self.user_id, room_id, self.channel_name)
+        self.subscribed -= rooms
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol)
+        await self.send_subscriptions()
+
+    async def send_subscriptions(self):
+        await self.send_frame({'type': 'subscribed', 'rooms': sorted(self.subscribed)}, coalesce=('subscribed',))
+
+    async def receive_frame(self, data):
+        frame_type = data.get('type', 'message')
+        if frame_type in ('subscribe', 'unsubscribe'):
+            rooms = {int(room_id) for room_id in data.get('rooms', [])}
+            if frame_type == 'subscribe':
+                missing = rooms - set(self.memberships)
+                if missing:
+                    self.memberships.update(await load_memberships(self.user_id, missing))
+                await self.subscribe(rooms & set(self.memberships))
+            else:
+                await self.unsubscribe(rooms)
+            await self.send_subscriptions()
+            return
+
+        membership = self.memberships.get(int(data.get('room') or 0))
+        if membership is None:
+            await self.send_frame({'type': 'error', 'room': data.get('room'), 'error': 'Not one of your rooms.'})
+            return
+        await self.handle_frame(membership, data)
+
+    def follows(self, room_id):
+        return room_id in self.subscribed
+
+    async def room_changed(self, event):
+        room_id = event['room']
+        membership = (await load_memberships(self.user_id, [room_id])).get(room_id)
+        if membership is None:
+            self.memberships.pop(room_id, None)
+            await self.unsubscribe({room_id})
+        else:
+            if room_id not in self.memberships:
+                # A new conversation is followed like the rest.
+                await self.subscribe({room_id})
+            self.memberships[room_id] = membership
+
+    async def profile_changed(self, event):
+        for membership in self.memberships.values():
+            if membership.recipient_id == event['user_id']:
+                membership.recipient_push_token = event['push_token']
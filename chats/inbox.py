@@ -0,0 +1,59 @@
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from .models import ChatRoom, Message
+
+PREVIEW_LENGTH = 100
+
+
+def record_last_message(message):
+    """
+    Points the room's inbox snapshot at `message`. Call in the transaction
+    that creates it; an older message never replaces a newer one.
+    """
+    ChatRoom.objects.filter(
+        Q(last_message__isnull=True) | Q(last_message_id__lt=message.id), id=message.room_id
+    ).update(
+        last_message=message,
+        last_message_preview=message.content[:PREVIEW_LENGTH],
+        last_message_sender_id=message.sender_id,
+        last_message_at=message.timestamp,
+        last_activity_at=message.timestamp,
+    )
+
+
+def mark_read(room, user_id, seq):
+    """
+    Moves the user's read cursor in `room` up to `seq` and recounts what is
+    left unread. The cursor only moves forward, so devices sending markers
+    at the same time settle on the highest one; the count is recomputed in
+    the same UPDATE, over the messages after the cursor only. Returns the
+    user's unread count, or None when the cursor was already at or past `seq`.
+    """
+    side, other = ('buyer', 'seller') if room.buyer_id == user_id else ('seller', 'buyer')
+    unread = Message.objects.filter(
+        room=OuterRef('pk'), seq__gt=seq, sender_id=OuterRef(f'{other}_id')
+    ).values('room').annotate(count=Count('id')).values('count')
+    updated = ChatRoom.objects.filter(
+        id=room.id, last_seq__gte=seq, **{f'{side}_read_seq__lt': seq}
+    ).update(**{
+        f'{side}_read_seq': seq,
+        f'{side}_unread_count': Coalesce(Subquery(unread), Value(0)),
+    })
+    if not updated:
+        return None
+    return ChatRoom.objects.values_list(f'{side}_unread_count', flat=True).get(id=room.id)
+
+
+def backfill_last_messages(rooms=None):
+    """Recomputes the snapshot of `rooms` (all rooms by default) in one UPDATE."""
+    latest = Message.objects.filter(room=OuterRef('pk')).order_by('-id')
+    rooms = ChatRoom.objects.all() if rooms is None else rooms
+    return rooms.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(latest.annotate(preview=Substr('content', 1, PREVIEW_LENGTH)).values('preview')[:1]), Value('')
+        ),
+        last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('timestamp')[:1]), F('created_at')),
+    )
@@ -0,0 +1,192 @@
+import asyncio
+import itertools
+import time
+import uuid
+import weakref
+from collections import deque
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from .broker import encode_frame, read_frame
+
+
+class BrokerError(Exception):
+    pass
+
+
+class _BrokerConnection:
+    """One socket to the broker per event loop, multiplexing request ids."""
+
+    def __init__(self, reader, writer, expiry=60):
+        self.reader = reader
+        self.writer = writer
+        self.expiry = expiry
+        self.ids = itertools.count(1)
+        # request id -> (future, channel or None)
+        self.pending = {}
+        # receive() calls cancelled while the broker may already have answered.
+        self.cancelled = {}
+        # channel -> deque of (expires_at, message) answered to a cancelled
+        # receive(). The broker has already dequeued them, so they are older
+        # than anything it still holds for the channel and go out first.
+        self.held = {}
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_replies())
+
+    def hold(self, channel, message):
+        now = time.time()
+        for held_channel in [held_channel for held_channel, messages in self.held.items() if messages[-1][0] < now]:
+            # The consumer went away; nobody will receive these.
+            del self.held[held_channel]
+        self.held.setdefault(channel, deque()).append((now + self.expiry, message))
+
+    def take_held(self, channel):
+        messages = self.held.get(channel)
+        now = time.time()
+        while messages:
+            expires_at, message = messages.popleft()
+            if not messages:
+                del self.held[channel]
+            if expires_at >= now:
+                return message
+        return None
+
+    async def read_replies(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                request_id = frame.pop('id')
+                channel = self.cancelled.pop(request_id, None)
+                if channel is not None:
+                    if 'message' in frame:
+                        # Answered before the cancel arrived; keep it for the
+                        # next receive() rather than requeueing it behind
+                        # newer messages.
+                        self.hold(channel, frame['message'])
+                    continue
+                future, channel = self.pending.pop(request_id, (None, None))
+                if channel in self.held and 'message' in frame:
+                    # A receive() sent before the held message came back.
+                    self.hold(channel, frame['message'])
+                    frame['message'] = self.take_held(channel)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        finally:
+            error = BrokerError('Connection to the channel broker was lost.')
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    @property
+    def closed(self):
+        return self.reader_task.done() or self.writer.is_closing()
+
+    def write(self, payload):
+        self.writer.write(encode_frame(payload))
+
+    async def request(self, op, **fields):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, fields['channel'] if op == 'receive' else None)
+        self.write({'op': op, 'id': request_id, **fields})
+        try:
+            reply = await future
+        except asyncio.CancelledError:
+            self.pending.pop(request_id, None)
+            if op == 'receive' and not self.closed:
+                self.cancelled[request_id] = fields['channel']
+                self.write({'op': 'cancel', 'request': request_id, 'channel': fields['channel']})
+            raise
+        if 'error' in reply:
+            if reply['error'] == 'full':
+                raise ChannelFull(fields.get('channel'))
+            raise BrokerError(reply['error'])
+        return reply
+
+    async def close(self):
+        self.writer.close()
+        self.reader_task.cancel()
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by chats.broker, so several daphne processes on one
+    host share groups without Redis. Queues, capacities and expiry live in the
+    broker; configure them on `run_channel_broker` from the same CONFIG.
+    """
+
+    extensions = ['groups', 'flush', 'presence']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self._connections = weakref.WeakKeyDictionary()
+        self._locks = weakref.WeakKeyDictionary()
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+        lock = self._locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            connection = self._connections.get(loop)
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                connection = self._connections[loop] = _BrokerConnection(reader, writer, self.expiry)
+        return connection
+
+    async def _request(self, op, **fields):
+        return await (await self._connection()).request(op, **fields)
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.valid_channel_name(channel)
+        await self._request('send', channel=channel, message=message)
+
+    async def receive(self, channel):
+        self.valid_channel_name(channel, receive=True)
+        connection = await self._connection()
+        message = connection.take_held(channel)
+        if message is not None:
+            return message
+        return (await connection.request('receive', channel=channel))['message']
+
+    async def new_channel(self, prefix='specific'):
+        return f"{prefix}.{uuid.uuid4().hex}"
+
+    async def group_add(self, group, channel):
+        self.valid_group_name(group)
+        self.valid_channel_name(channel)
+        await self._request('group_add', group=group, channel=channel)
+
+    async def group_discard(self, group, channel):
+        self.valid_group_name(group)
+        self.valid_channel_name(channel)
+        await self._request('group_discard', group=group, channel=channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.valid_group_name(group)
+        await self._request('group_send', group=group, message=message)
+
+    async def flush(self):
+        await self._request('flush')
+
+    # Presence extension, used by chats.presence.
+
+    async def presence_join(self, key, connection, ttl):
+        await self._request('presence_join', key=key, connection=connection, ttl=ttl)
+
+    async def presence_leave(self, key, connection):
+        await self._request('presence_leave', key=key, connection=connection)
+
+    async def presence_check(self, key):
+        return (await self._request('presence_check', key=key))['present']
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from chats.inbox import backfill_last_messages
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the last-message snapshot the chat inbox reads from each room.'
+
+    def handle(self, *args, **options):
+        updated = backfill_last_messages()
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} chat rooms."))
@@ -0,0 +1,111 @@
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from chats.broker import ChannelBroker
+from chats.layers import BrokerChannelLayer
+
+GROUP = 'bench'
+
+
+def run_broker(path):
+    asyncio.run(ChannelBroker(path, capacity=10000).serve_forever())
+
+
+def run_worker(path, consumers, messages, ready, results):
+    async def consume(layer, channel):
+        latencies = []
+        for _ in range(messages):
+            message = await layer.receive(channel)
+            latencies.append(time.time() - message['sent'])
+        return latencies
+
+    async def main():
+        layer = BrokerChannelLayer(path)
+        channels = [await layer.new_channel() for _ in range(consumers)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+        tasks = [asyncio.create_task(consume(layer, channel)) for channel in channels]
+        ready.release()
+        latencies = []
+        for task_latencies in await asyncio.gather(*tasks):
+            latencies.extend(task_latencies)
+        results.put(latencies)
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = 'Measures group fan-out throughput and latency of the broker channel layer across worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--consumers', type=int, default=50, help='Group members per worker process.')
+        parser.add_argument('--messages', type=int, default=200, help='group_send calls per run.')
+        parser.add_argument('--rate', type=float, default=0, help='group_send calls per second; 0 sends back to back.')
+
+    def run(self, path, workers, consumers, messages, rate):
+        context = multiprocessing.get_context('fork')
+        ready = context.Semaphore(0)
+        results = context.Queue()
+        processes = [
+            context.Process(target=run_worker, args=(path, consumers, messages, ready, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.acquire()
+
+        async def send():
+            layer = BrokerChannelLayer(path)
+            for _ in range(messages):
+                await layer.group_send(GROUP, {'type': 'bench.message', 'sent': time.time()})
+                if rate:
+                    await asyncio.sleep(1 / rate)
+            await layer.close()
+
+        started = time.perf_counter()
+        asyncio.run(send())
+        latencies = []
+        for _ in processes:
+            latencies.extend(results.get())
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        async def flush():
+            layer = BrokerChannelLayer(path)
+            await layer.flush()
+            await layer.close()
+        asyncio.run(flush())
+
+        latencies.sort()
+        return {
+            'deliveries': len(latencies),
+            'rate': len(latencies) / elapsed,
+            'p50': statistics.median(latencies) * 1000,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        }
+
+    def handle(self, *args, **options):
+        path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        broker = multiprocessing.get_context('fork').Process(target=run_broker, args=(path,), daemon=True)
+        broker.start()
+        while not os.path.exists(path):
+            time.sleep(0.05)
+
+        try:
+            self.stdout.write(f"{'workers':>8} {'members':>8} {'deliveries':>11} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+            for workers in options['workers']:
+                result = self.run(path, workers, options['consumers'], options['messages'], options['rate'])
+                self.stdout.write(
+                    f"{workers:>8} {workers * options['consumers']:>8} {result['deliveries']:>11} "
+                    f"{result['rate']:>10.0f} {result['p50']:>8.2f} {result['p99']:>8.2f}"
+                )
+        finally:
+            broker.terminate()
+            broker.join()
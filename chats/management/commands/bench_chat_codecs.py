@@ -0,0 +1,68 @@
+import random
+import time
+import zlib
+from django.core.management.base import BaseCommand, CommandError
+from chats.codec import JSON, MSGPACK, msgpack
+
+
+def sample_frames(count):
+    rng = random.Random(7)
+    words = 'hi ok thanks logo design price delivery tomorrow revision file sent please check the final version'.split()
+    for seq in range(1, count + 1):
+        if seq % 10 == 0:
+            yield {'type': 'read', 'room': 48213, 'user_id': 1032, 'seq': seq - 1, 'unread_count': 0}
+        else:
+            yield {
+                'room': 48213,
+                'id': 7291840000000000 + seq,
+                'seq': seq,
+                'message': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 30))),
+                'sender_id': rng.choice((1032, 2201)),
+            }
+
+
+def wire_size(payload):
+    # Payload plus the unmasked server-to-client frame header.
+    return len(payload) + (2 if len(payload) < 126 else 4 if len(payload) < 65536 else 10)
+
+
+def deflated_size(payload):
+    # permessage-deflate without context takeover: each message compressed
+    # alone, trailing 00 00 ff ff dropped.
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return wire_size(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)[:-4])
+
+
+class Command(BaseCommand):
+    help = 'Compares bytes on the wire and encode/decode CPU of the JSON and msgpack chat protocols.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--batch', type=int, default=20, help='Frames per msgpack message when batching.')
+
+    def handle(self, *args, **options):
+        if msgpack is None:
+            raise CommandError('msgpack is not installed.')
+
+        sample = list(sample_frames(options['messages']))
+        self.stdout.write(
+            f"{'codec':>8} {'batch':>6} {'KiB':>8} {'deflated':>9} {'encode ms':>10} {'decode ms':>10}"
+        )
+        for codec, batch in ((JSON, 1), (MSGPACK, 1), (MSGPACK, options['batch'])):
+            batches = [sample[start:start + batch] for start in range(0, len(sample), batch)]
+
+            started = time.process_time()
+            messages = [message for frames in batches for message in codec.encode(frames)]
+            encode = time.process_time() - started
+
+            payloads = [message.get('bytes_data') or message['text_data'].encode() for message in messages]
+            started = time.process_time()
+            for message in messages:
+                codec.decode(**message)
+            decode = time.process_time() - started
+
+            self.stdout.write(
+                f"{'json' if codec is JSON else 'msgpack':>8} {batch:>6} "
+                f"{sum(map(wire_size, payloads)) / 1024:>8.1f} {sum(map(deflated_size, payloads)) / 1024:>9.1f} "
+                f"{encode * 1000:>10.1f} {decode * 1000:>10.1f}"
+            )
@@ -0,0 +1,72 @@
+import random
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from chats.models import ChatRoom, Message
+from chats.search import BasicMessageSearchBackend, get_message_search_backend
+from gigs.management.commands._bench import WORDS, bench_user, rolled_back, timed
+from gigs.models import Gig
+
+QUERIES = ['logo', 'logos', 'invoice tomorrow', 'wedding portrait', 'biryani']
+
+
+class Command(BaseCommand):
+    help = 'Measures chat message search latency as the message table grows. All rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 500000, 1000000])
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rooms', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--skip-baseline', action='store_true', help='Do not time the icontains baseline.')
+
+    def make_messages(self, rooms, count, rng, seqs, batch_size=5000):
+        for start in range(0, count, batch_size):
+            batch = []
+            for _ in range(min(batch_size, count - start)):
+                room_id, buyer_id, seller_id = rng.choice(rooms)
+                seqs[room_id] += 1
+                batch.append(Message(
+                    room_id=room_id, sender_id=rng.choice((buyer_id, seller_id)), seq=seqs[room_id],
+                    content=' '.join(rng.choices(WORDS + ['invoice', 'tomorrow'], k=rng.randint(3, 25))),
+                ))
+            # Indexed by the triggers, as the write-behind buffer's inserts are.
+            Message.objects.bulk_create(batch)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        backend = get_message_search_backend()
+        baseline = BasicMessageSearchBackend()
+        limit = options['limit']
+
+        self.stdout.write(f"backend: {type(backend).__name__}, page size {limit}, {options['repeat']} runs per query")
+        self.stdout.write(f"{'messages':>10} {'query':>18} {'index p50 ms':>13} {'index p95 ms':>13} {'icontains p50 ms':>17}")
+
+        with rolled_back():
+            users = [bench_user() for _ in range(options['users'])]
+            gig = Gig.objects.create(
+                title='Bench', description='Bench', price=1, category='Design', location='Lahore', creator=users[0]
+            )
+            rooms = []
+            for _ in range(options['rooms']):
+                buyer, seller = rng.sample(users, 2)
+                room = ChatRoom.objects.create(gig=gig, buyer=buyer, seller=seller)
+                rooms.append((room.id, buyer.id, seller.id))
+            user_id = rooms[0][1]
+
+            seqs = defaultdict(int)
+            size = 0
+            for target in sorted(options['sizes']):
+                self.make_messages(rooms, target - size, rng, seqs)
+                size = target
+
+                for query in QUERIES:
+                    indexed = timed(lambda: backend.search(user_id, query, limit=limit), options['repeat'])
+                    if options['skip_baseline']:
+                        scanned = '-'
+                    else:
+                        scanned = timed(lambda: baseline.search(user_id, query, limit=limit), 3)
+                        scanned = f"{scanned['median']:.2f}"
+                    self.stdout.write(
+                        f"{size:>10} {query:>18} {indexed['median']:>13.2f} {indexed['p95']:>13.2f} {scanned:>17}"
+                    )
@@ -0,0 +1,97 @@
+import asyncio
+import gc
+import multiprocessing
+import resource
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connections
+from chats.consumers import ChatConsumer, UserChatConsumer
+from chats.models import ChatRoom
+from gigs.management.commands._bench import bench_user
+from gigs.models import Gig
+
+
+class IdleConsumer(AsyncWebsocketConsumer):
+    """Baseline: what the test communicator and an empty consumer cost."""
+
+    async def connect(self):
+        await self.accept()
+
+
+def rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak rather than current outside Linux, still fine for a growing set.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_sockets(consumer, count, room, user, results):
+    async def main():
+        application = consumer.as_asgi()
+        communicators = []
+        # Warm up imports, caches and the first DB connection.
+        for _ in range(10):
+            communicators.append(await connect(application))
+        gc.collect()
+        before = rss()
+        for _ in range(count):
+            communicators.append(await connect(application))
+        gc.collect()
+        results.put((rss() - before) / count)
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    async def connect(application):
+        path = f'/ws/chat/{room.id}/' if consumer is ChatConsumer else '/ws/chat/'
+        communicator = WebsocketCommunicator(application, path)
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'chat_room_id': str(room.id)}} if consumer is ChatConsumer else {'kwargs': {}}
+        connected, _ = await communicator.connect()
+        assert connected
+        if consumer is UserChatConsumer:
+            await communicator.receive_from()
+        return communicator
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = 'Opens idle chat sockets through the channels test communicator and reports RSS per connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        seller, buyer = bench_user(), bench_user()
+        gig = Gig.objects.create(
+            title='Bench', description='Bench', price=1, category='Design', location='Lahore', creator=seller
+        )
+        room = ChatRoom.objects.create(gig=gig, buyer=buyer, seller=seller)
+        context = multiprocessing.get_context('fork')
+
+        try:
+            self.stdout.write(f"{'consumer':>18} {'sockets':>8} {'KiB/socket':>11} {'over baseline':>14}")
+            baseline = None
+            for consumer in (IdleConsumer, ChatConsumer, UserChatConsumer):
+                # A fresh process per consumer, so freed memory is not reused.
+                connections.close_all()
+                results = context.Queue()
+                process = context.Process(target=open_sockets, args=(consumer, options['sockets'], room, buyer, results))
+                process.start()
+                per_socket = results.get()
+                process.join()
+                baseline = per_socket if baseline is None else baseline
+                self.stdout.write(
+                    f"{consumer.__name__:>18} {options['sockets']:>8} {per_socket / 1024:>11.1f} "
+                    f"{(per_socket - baseline) / 1024:>14.1f}"
+                )
+        finally:
+            gig.delete()
+            seller.delete()
+            buyer.delete()
@@ -0,0 +1,91 @@
+import asyncio
+import statistics
+import tempfile
+import time
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chats.inbox import record_last_message
+from chats.models import ChatRoom, Message
+from chats.writebehind import MessageBuffer
+from gigs.management.commands._bench import bench_user
+from gigs.models import Gig
+
+
+def insert_message(room_id, sender_id, content):
+    # The per-message path of ChatConsumer.insert_message.
+    with transaction.atomic():
+        message = Message.objects.create(
+            room_id=room_id, sender_id=sender_id, content=content, seq=ChatRoom.allocate_seq(room_id, [sender_id])
+        )
+        record_last_message(message)
+        return message
+
+
+class Command(BaseCommand):
+    help = 'Compares chat message throughput of per-message transactions and the write-behind buffer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--senders', type=int, default=50, help='Concurrent sockets sending messages.')
+        parser.add_argument('--rooms', type=int, default=20)
+        parser.add_argument('--interval', type=float, default=0.005, help='Write-behind flush interval in seconds.')
+
+    def run(self, save, rooms, senders, messages):
+        latencies = []
+
+        async def sender(index):
+            room, user_id = rooms[index % len(rooms)]
+            for count in range(messages // senders):
+                started = time.perf_counter()
+                await save(room, user_id, f'message {count} from socket {index}')
+                latencies.append(time.perf_counter() - started)
+
+        async def main():
+            await asyncio.gather(*(sender(index) for index in range(senders)))
+
+        started = time.perf_counter()
+        asyncio.run(main())
+        return started, latencies
+
+    def report(self, name, elapsed, latencies):
+        latencies.sort()
+        self.stdout.write(
+            f"{name:>14} {len(latencies) / elapsed:>10.0f} "
+            f"{statistics.median(latencies) * 1000:>8.3f} "
+            f"{latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:>8.3f}"
+        )
+
+    def handle(self, *args, **options):
+        seller, buyer = bench_user(), bench_user()
+        gig = Gig.objects.create(
+            title='Bench', description='Bench', price=1, category='Design', location='Lahore', creator=seller
+        )
+        rooms = [
+            (ChatRoom.objects.create(gig=gig, buyer=buyer, seller=seller).id, buyer.id)
+            for _ in range(options['rooms'])
+        ]
+
+        try:
+            self.stdout.write(f"{'path':>14} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+
+            direct = database_sync_to_async(insert_message)
+            started, latencies = self.run(direct, rooms, options['senders'], options['messages'])
+            self.report('per-message', time.perf_counter() - started, latencies)
+
+            buffer = MessageBuffer(tempfile.mkdtemp(), interval=options['interval']).start()
+
+            async def buffered(room_id, sender_id, content):
+                # As ChatConsumer.save_message does.
+                if not buffer.ids.available():
+                    await database_sync_to_async(buffer.ids.reserve)()
+                buffer.add(room_id, sender_id, content)
+
+            started, latencies = self.run(buffered, rooms, options['senders'], options['messages'])
+            # Throughput counts until the last message is committed.
+            buffer.stop()
+            self.report('write-behind', time.perf_counter() - started, latencies)
+        finally:
+            gig.delete()
+            seller.delete()
+            buyer.delete()
@@ -0,0 +1,22 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chats.broker import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = 'Runs the Unix-socket channel broker that daphne processes share when CHANNEL_LAYER=broker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Socket path; defaults to CHANNEL_BROKER_CONFIG["path"].')
+
+    def handle(self, *args, **options):
+        config = dict(settings.CHANNEL_BROKER_CONFIG)
+        if options['path']:
+            config['path'] = options['path']
+        broker = ChannelBroker(**config)
+        self.stdout.write(f"Channel broker listening on {broker.path}")
+        try:
+            asyncio.run(broker.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,69 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_last_messages(apps, schema_editor):
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    Message = apps.get_model('chats', 'Message')
+    latest = Message.objects.filter(room=OuterRef('pk')).order_by('-id')
+    ChatRoom.objects.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(latest.annotate(preview=Substr('content', 1, 100)).values('preview')[:1]), Value('')
+        ),
+        last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('timestamp')[:1]), F('created_at')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+        ('gigs', '0008_gig_listed_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['buyer', '-last_activity_at', '-id'], name='chats_buyer_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['seller', '-last_activity_at', '-id'], name='chats_seller_activity_idx'),
+        ),
+        migrations.RunPython(backfill_last_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:02
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_seq(apps, schema_editor):
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    Message = apps.get_model('chats', 'Message')
+    earlier = Message.objects.filter(room=OuterRef('room'), id__lte=OuterRef('id')).values('room')
+    Message.objects.update(seq=Subquery(earlier.annotate(count=Count('id')).values('count')))
+    in_room = Message.objects.filter(room=OuterRef('pk')).values('room')
+    ChatRoom.objects.update(
+        last_seq=Coalesce(Subquery(in_room.annotate(count=Count('id')).values('count')), Value(0))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chats_message_room_seq_unique'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.4 on 2026-10-18 19:40
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_history_read(apps, schema_editor):
+    # Messages sent before read cursors existed count as read.
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    ChatRoom.objects.update(buyer_read_seq=F('last_seq'), seller_read_seq=F('last_seq'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='buyer_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='buyer_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='seller_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='seller_unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_history_read, migrations.RunPython.noop),
+    ]
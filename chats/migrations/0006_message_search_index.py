@@ -0,0 +1,81 @@
+# Generated by Django 5.1.4 on 2026-10-18 22:10
+
+from django.db import migrations
+
+# Participant and room tokens of a message: "u<buyer> u<seller> r<room>".
+# A room's participants never change, so they are indexed with its messages.
+SCOPE = "'u' || buyer_id || ' u' || seller_id || ' r' || id"
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    # External content table: the text stays in chats_message and is read
+    # through the view for snippet(), only the index is stored. No prefix
+    # index either, searches match whole words (see chats.search).
+    schema_editor.execute(
+        "CREATE VIEW IF NOT EXISTS chats_message_fts_source AS "
+        "SELECT m.id AS id, m.content AS content, "
+        "'u' || r.buyer_id || ' u' || r.seller_id || ' r' || r.id AS scope "
+        "FROM chats_message m JOIN chats_chatroom r ON r.id = m.room_id"
+    )
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chats_message_fts USING fts5("
+        "content, scope, content = 'chats_message_fts_source', content_rowid = 'id', "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    # Triggers keep the index in step with every insert, including bulk ones
+    # from the write-behind buffer. An external content index is deleted from
+    # by replaying the indexed values, so a room being deleted first takes its
+    # messages out of the index.
+    schema_editor.execute(
+        "CREATE TRIGGER chats_message_fts_insert AFTER INSERT ON chats_message BEGIN "
+        f"INSERT INTO chats_message_fts (rowid, content, scope) SELECT new.id, new.content, {SCOPE} "
+        "FROM chats_chatroom WHERE id = new.room_id; "
+        "END"
+    )
+    schema_editor.execute(
+        "CREATE TRIGGER chats_message_fts_delete AFTER DELETE ON chats_message BEGIN "
+        "INSERT INTO chats_message_fts (chats_message_fts, rowid, content, scope) "
+        f"SELECT 'delete', old.id, old.content, {SCOPE} FROM chats_chatroom WHERE id = old.room_id; "
+        "END"
+    )
+    schema_editor.execute(
+        "CREATE TRIGGER chats_message_fts_update AFTER UPDATE OF content, room_id ON chats_message BEGIN "
+        "INSERT INTO chats_message_fts (chats_message_fts, rowid, content, scope) "
+        f"SELECT 'delete', old.id, old.content, {SCOPE} FROM chats_chatroom WHERE id = old.room_id; "
+        f"INSERT INTO chats_message_fts (rowid, content, scope) SELECT new.id, new.content, {SCOPE} "
+        "FROM chats_chatroom WHERE id = new.room_id; "
+        "END"
+    )
+    schema_editor.execute(
+        "CREATE TRIGGER chats_chatroom_fts_delete BEFORE DELETE ON chats_chatroom BEGIN "
+        "INSERT INTO chats_message_fts (chats_message_fts, rowid, content, scope) "
+        "SELECT 'delete', m.id, m.content, 'u' || old.buyer_id || ' u' || old.seller_id || ' r' || old.id "
+        "FROM chats_message m WHERE m.room_id = old.id; "
+        "END"
+    )
+    schema_editor.execute("INSERT INTO chats_message_fts (chats_message_fts) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    for trigger in ('chats_message_fts_insert', 'chats_message_fts_delete', 'chats_message_fts_update',
+                    'chats_chatroom_fts_delete'):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    schema_editor.execute("DROP TABLE IF EXISTS chats_message_fts")
+    schema_editor.execute("DROP VIEW IF EXISTS chats_message_fts_source")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_chat_room_unread'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
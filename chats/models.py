@@ -1,25 +1,96 @@
-from django.db import models
+from collections import Counter
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from gigs.models import Gig
 
 User = get_user_model()
 
+# On SQLite, triggers from chats/migrations/0006_message_search_index.py keep
+# the message search index in step with this table. Migrations that rebuild
+# it (most column changes do) drop them and must create them again.
 class ChatRoom(models.Model):
     gig = models.ForeignKey(Gig, on_delete=models.CASCADE, related_name="chat_rooms")
     buyer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chat_buyer")
     seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chat_seller")
     is_closed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Snapshot of the newest message for the inbox, written by chats.inbox
+    # in the transaction that saves the message.
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_preview = models.CharField(max_length=255, blank=True, default='')
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # last_message_at, or created_at before the first message.
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Highest Message.seq handed out in this room.
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Read cursor (highest seq seen) and the number of the other side's
+    # messages after it, per participant. Kept by allocate_seq and
+    # chats.inbox.mark_read.
+    buyer_read_seq = models.PositiveBigIntegerField(default=0)
+    seller_read_seq = models.PositiveBigIntegerField(default=0)
+    buyer_unread_count = models.PositiveIntegerField(default=0)
+    seller_unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Inbox pages, most recent activity first, for either participant.
+            models.Index(fields=['buyer', '-last_activity_at', '-id'], name='chats_buyer_activity_idx'),
+            models.Index(fields=['seller', '-last_activity_at', '-id'], name='chats_seller_activity_idx'),
+        ]
+
+    @classmethod
+    def allocate_seq(cls, room_id, sender_ids):
+        """
+        Reserves one sequence number per message of `sender_ids` and returns
+        the last one, counting each message as unread for the other side.
+        Call inside a transaction; the UPDATE holds the room until it commits.
+        """
+        senders = Counter(sender_ids)
+
+        def sent_by(field):
+            return models.Case(
+                *(models.When(**{field: sender_id}, then=models.Value(count)) for sender_id, count in senders.items()),
+                default=models.Value(0),
+            )
+
+        cls.objects.filter(id=room_id).update(
+            last_seq=models.F('last_seq') + len(sender_ids),
+            buyer_unread_count=models.F('buyer_unread_count') + sent_by('seller_id'),
+            seller_unread_count=models.F('seller_unread_count') + sent_by('buyer_id'),
+        )
+        return cls.objects.values_list('last_seq', flat=True).get(id=room_id)
+
+    def unread_count_for(self, user_id):
+        return self.buyer_unread_count if self.buyer_id == user_id else self.seller_unread_count
 
     def __str__(self):
         return f"ChatRoom for {self.gig.title} (Buyer: {self.buyer.name}, Seller: {self.seller.name})"
 
 
+# Indexed for search by SQLite triggers; see the note on ChatRoom before
+# migrating this table.
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name="messages")
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: chats.writebehind stamps messages before they are saved.
+    timestamp = models.DateTimeField(default=timezone.now)
+    # 1, 2, 3... within the room, so clients can ask for what they missed.
+    seq = models.PositiveBigIntegerField(editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chats_message_room_seq_unique'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            with transaction.atomic():
+                self.seq = ChatRoom.allocate_seq(self.room_id, [self.sender_id])
+                return super().save(*args, **kwargs)
+        return super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Message from {self.sender.name} in {self.room.gig.title}"
@@ -27,6 +98,14 @@ class Message(models.Model):
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     push_token = models.CharField(max_length=255, blank=True, null=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Compared on save, so sockets only hear about tokens that changed.
+        if 'push_token' not in instance.get_deferred_fields():
+            instance._stored_push_token = instance.push_token
+        return instance
     
     def __str__(self):
         return f"Profile for {self.user.username}"
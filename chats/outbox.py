@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Outboxes with frames waiting to be written, and counters, for stats().
+_behind = set()
+_counts = collections.Counter()
+
+
+class Outbox:
+    """
+    Frames waiting to be written to one socket. A writer task hands all that
+    are waiting to `write` as one batch, in order, and exists only while some
+    are waiting, so channel layer handlers never block on a slow client. A
+    frame put with the same `coalesce` key as one still waiting replaces it,
+    at the back of the queue so it never overtakes frames put before it.
+
+    Servers such as daphne buffer whatever is sent and return at once, so the
+    queue alone never shows a slow client. A client that acknowledges frames
+    ({"type": "ack", "received": <frames received so far>}) is also charged
+    for those written but not yet acknowledged. Past `limit` frames the
+    outbox closes and put() returns False; the caller drops the connection
+    and the client resyncs through history.
+    """
+
+    __slots__ = ('write', 'limit', 'frames', 'latest', 'writer', 'closed', 'sent', 'acked')
+
+    def __init__(self, write, limit):
+        self.write = write
+        self.limit = limit
+        # Allocated while frames are waiting, idle sockets keep neither.
+        self.frames = None
+        self.latest = None
+        self.writer = None
+        self.closed = False
+        self.sent = 0
+        # None until the client first acknowledges.
+        self.acked = None
+
+    def __len__(self):
+        return (len(self.frames) if self.frames else 0) + self.unacked()
+
+    def unacked(self):
+        return 0 if self.acked is None else self.sent - self.acked
+
+    def put(self, frame, coalesce=None):
+        if self.closed:
+            return True
+        if self.frames is None:
+            self.frames = collections.deque()
+            self.latest = {}
+        elif coalesce is not None and coalesce in self.latest:
+            self.frames.remove(self.latest.pop(coalesce))
+            _counts['coalesced'] += 1
+
+        if len(self) >= self.limit:
+            _counts['overflows'] += 1
+            self.close()
+            return False
+
+        entry = [coalesce, frame]
+        self.frames.append(entry)
+        if coalesce is not None:
+            self.latest[coalesce] = entry
+        _behind.add(self)
+        if self.writer is None:
+            self.writer = asyncio.get_running_loop().create_task(self.drain())
+        return True
+
+    def ack(self, received):
+        """The client has received `received` frames from this socket so far."""
+        self.acked = max(self.acked or 0, min(received, self.sent))
+        if not len(self):
+            _behind.discard(self)
+
+    async def drain(self):
+        try:
+            while self.frames:
+                batch = [frame for _, frame in self.frames]
+                self.frames.clear()
+                self.latest.clear()
+                await self.write(batch)
+                self.sent += len(batch)
+        except Exception:
+            logger.exception("Could not write to chat socket")
+            self.close()
+        finally:
+            self.writer = None
+            self.frames = self.latest = None
+            if not self.unacked():
+                _behind.discard(self)
+
+    def close(self):
+        self.closed = True
+        self.frames = self.latest = None
+        _behind.discard(self)
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+def stats():
+    """Queue depths, unacknowledged frames included, of the sockets in this process that are behind."""
+    depths = [len(outbox) for outbox in list(_behind)]
+    return {
+        'coalesced': _counts['coalesced'],
+        'overflows': _counts['overflows'],
+        'socketsBehind': len(depths),
+        'queuedFrames': sum(depths),
+        'maxQueueDepth': max(depths, default=0),
+    }
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class LocalPresence:
+    """
+    In-process presence for the in-memory channel layer. The broker layer keeps
+    the same structure in chats.broker so every worker process shares it.
+    """
+
+    def __init__(self):
+        # key -> {connection: expires_at}
+        self.entries = defaultdict(dict)
+
+    async def presence_join(self, key, connection, ttl):
+        self.entries[key][connection] = time.monotonic() + ttl
+
+    async def presence_leave(self, key, connection):
+        connections = self.entries.get(key)
+        if connections is not None:
+            connections.pop(connection, None)
+            if not connections:
+                del self.entries[key]
+
+    async def presence_check(self, key):
+        connections = self.entries.get(key)
+        if connections is None:
+            return False
+        now = time.monotonic()
+        for connection in [connection for connection, expires_at in connections.items() if expires_at < now]:
+            del connections[connection]
+        if not connections:
+            del self.entries[key]
+            return False
+        return True
+
+
+_local_presence = LocalPresence()
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+
+
+def _backend():
+    layer = get_channel_layer()
+    if 'presence' in getattr(layer, 'extensions', []):
+        return layer
+    return _local_presence
+
+
+def _key(user_id, room_id):
+    return f"{user_id}:{room_id}"
+
+
+async def mark_present(user_id, room_id, connection):
+    """
+    Registers one open socket of the user in the room. Each device or tab is a
+    separate `connection`, so the user stays present until the last one leaves
+    or stops heartbeating (call again every presence_ttl() / 3 seconds, or
+    use track_presence).
+    """
+    await _backend().presence_join(_key(user_id, room_id), connection, presence_ttl())
+
+
+async def mark_absent(user_id, room_id, connection):
+    await _backend().presence_leave(_key(user_id, room_id), connection)
+
+
+async def is_present(user_id, room_id):
+    return await _backend().presence_check(_key(user_id, room_id))
+
+
+class _Heartbeat:
+    """
+    Renews the presence of every socket on one event loop from a single task,
+    rather than a sleeping task per idle socket.
+    """
+
+    def __init__(self):
+        # (connection, room_id) -> user_id; a socket following several rooms
+        # is present in each of them.
+        self.connections = {}
+        self.task = None
+
+    def add(self, user_id, room_id, connection):
+        self.connections[connection, room_id] = user_id
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while self.connections:
+            await asyncio.sleep(presence_ttl() / 3)
+            for (connection, room_id), user_id in list(self.connections.items()):
+                if (connection, room_id) not in self.connections:
+                    # Left while an earlier renewal was awaited; renewing now
+                    # would mark the closed socket present again.
+                    continue
+                try:
+                    await mark_present(user_id, room_id, connection)
+                except Exception:
+                    logger.exception("Could not renew chat presence of %s", connection)
+
+
+_heartbeats = weakref.WeakKeyDictionary()
+
+
+async def track_presence(user_id, room_id, connection):
+    """mark_present() now and every presence_ttl() / 3 seconds until untrack_presence()."""
+    await mark_present(user_id, room_id, connection)
+    loop = asyncio.get_running_loop()
+    heartbeat = _heartbeats.get(loop)
+    if heartbeat is None:
+        heartbeat = _heartbeats[loop] = _Heartbeat()
+    heartbeat.add(user_id, room_id, connection)
+
+
+async def untrack_presence(user_id, room_id, connection):
+    heartbeat = _heartbeats.get(asyncio.get_running_loop())
+    if heartbeat is not None:
+        heartbeat.connections.pop((connection, room_id), None)
+    await mark_absent(user_id, room_id, connection)
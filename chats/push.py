@@ -0,0 +1,266 @@
+import atexit
+import logging
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from exponent_server_sdk import PushClient, PushMessage, PushServerError, PushTicket
+from requests.exceptions import ConnectionError, HTTPError
+from .models import UserProfile
+from .signals import announce_push_token
+
+logger = logging.getLogger(__name__)
+
+DEVICE_NOT_REGISTERED = PushTicket.ERROR_DEVICE_NOT_REGISTERED
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def expo_client():
+    session = requests.Session()
+    session.headers.update({
+        "accept": "application/json",
+        "accept-encoding": "gzip, deflate",
+        "content-type": "application/json",
+    })
+    return PushClient(session=session)
+
+
+def is_transient(error):
+    """Whether a failed Expo request may succeed unchanged: no connection, 429 or 5xx."""
+    if isinstance(error, ConnectionError):
+        return True
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def deactivate_tokens(tokens):
+    close_old_connections()
+    try:
+        with transaction.atomic():
+            profiles = UserProfile.objects.filter(push_token__in=tokens)
+            user_ids = list(profiles.values_list('user_id', flat=True))
+            profiles.update(push_token=None)
+            for user_id in user_ids:
+                announce_push_token(user_id, None)
+    finally:
+        close_old_connections()
+
+
+class PushDispatcher:
+    """
+    Sends Expo pushes from a background thread. enqueue() never blocks the
+    caller; the thread publishes up to `batch_size` messages per request,
+    retries transient failures with exponential backoff, and checks the
+    receipts `receipt_delay` seconds later to clear dead tokens. A batch Expo
+    rejects outright is split until the messages it refuses are found, and
+    only those are dropped.
+
+    notify() coalesces chat pushes per recipient and room: messages arriving
+    within `digest_window` seconds of each other become one push, sent at most
+    `digest_max_wait` seconds after the first of them.
+    """
+
+    def __init__(self, client_factory=expo_client, batch_size=100, batch_window=0.05,
+                 max_attempts=5, backoff=0.5, receipt_delay=900, digest_window=0, digest_max_wait=15):
+        self.client = client_factory()
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.receipt_delay = receipt_delay
+        self.digest_window = digest_window
+        self.digest_max_wait = digest_max_wait
+        # key -> pending digest, see notify()
+        self.digests = {}
+        self.queue = queue.Queue()
+        # (due_at, attempts, tickets) awaiting a receipt check
+        self.receipts = deque()
+        self.latencies = deque(maxlen=1000)
+        self.counts = {'enqueued': 0, 'sent': 0, 'failed': 0, 'retries': 0, 'deactivated': 0, 'coalesced': 0}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='chat-push', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def enqueue(self, token, body, data=None, title="New Message"):
+        message = PushMessage(to=token, body=body, data=data, sound="default", title=title)
+        self._count('enqueued')
+        self.queue.put((time.monotonic(), message))
+
+    def notify(self, key, token, sender_name, message, data=None):
+        if not self.digest_window:
+            self.enqueue(token, f"{sender_name}: {message}", data)
+            return
+        now = time.monotonic()
+        with self.lock:
+            digest = self.digests.get(key)
+            if digest is None:
+                digest = self.digests[key] = {'count': 0, 'first_at': now}
+            else:
+                self.counts['coalesced'] += 1
+            digest.update(token=token, sender_name=sender_name, message=message, data=data)
+            digest['count'] += 1
+            digest['due_at'] = min(now + self.digest_window, digest['first_at'] + self.digest_max_wait)
+
+    def flush_digests(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, digest in self.digests.items() if force or digest['due_at'] <= now]
+            digests = [self.digests.pop(key) for key in due]
+        for digest in digests:
+            if digest['count'] == 1:
+                body = f"{digest['sender_name']}: {digest['message']}"
+            else:
+                body = f"{digest['sender_name']}: {digest['count']} new messages"
+            self.enqueue(digest['token'], body, digest['data'])
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty() and not self.digests):
+            try:
+                if self.stopping.is_set():
+                    self.flush_digests(force=True)
+                self.process(timeout=0.5)
+            except Exception:
+                logger.exception("Push dispatcher iteration failed")
+
+    def process(self, timeout=0.0):
+        """One iteration: publish the next batch, then any receipts that are due."""
+        self.flush_digests()
+        batch = self.next_batch(timeout)
+        if batch:
+            self.publish(batch)
+        self.check_receipts()
+
+    def next_batch(self, timeout):
+        try:
+            batch = [self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def publish(self, batch):
+        tickets = self.publish_messages([message for _, message in batch])
+
+        now = time.monotonic()
+        published = {id(ticket.push_message) for ticket in tickets}
+        with self.lock:
+            self.latencies.extend(now - enqueued_at for enqueued_at, message in batch if id(message) in published)
+
+        accepted = []
+        dead_tokens = []
+        for ticket in tickets:
+            if ticket.is_success():
+                accepted.append(ticket)
+            elif (ticket.details or {}).get('error') == DEVICE_NOT_REGISTERED:
+                dead_tokens.append(ticket.push_message.to)
+            else:
+                logger.warning("Push rejected: %s", ticket.message)
+        self._count('sent', len(accepted))
+        self._count('failed', len(tickets) - len(accepted))
+        if accepted:
+            self.receipts.append((now + self.receipt_delay, 1, accepted))
+        if dead_tokens:
+            self.deactivate(dead_tokens)
+
+    def publish_messages(self, messages):
+        """The tickets of `messages`, less any Expo refused or could not be reached for."""
+        for attempt in range(self.max_attempts):
+            try:
+                return self.client.publish_multiple(messages)
+            except (PushServerError, ConnectionError, HTTPError) as e:
+                if not is_transient(e):
+                    # Sending the same request again gets the same answer.
+                    if len(messages) == 1:
+                        logger.warning("Push to %s rejected: %s", messages[0].to, e)
+                        self._count('failed')
+                        return []
+                    middle = len(messages) // 2
+                    return self.publish_messages(messages[:middle]) + self.publish_messages(messages[middle:])
+                if attempt + 1 == self.max_attempts:
+                    logger.error("Dropping %d pushes after %d attempts: %s", len(messages), self.max_attempts, e)
+                    self._count('failed', len(messages))
+                    return []
+                self._count('retries')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def check_receipts(self):
+        now = time.monotonic()
+        while self.receipts and self.receipts[0][0] <= now:
+            _, attempts, tickets = self.receipts.popleft()
+            try:
+                receipts = self.client.check_receipts_multiple(tickets)
+            except (PushServerError, ConnectionError, HTTPError) as e:
+                if is_transient(e) and attempts < self.max_attempts:
+                    self.receipts.append((now + self.backoff * 2 ** attempts, attempts + 1, tickets))
+                else:
+                    logger.warning("Giving up on %d push receipts: %s", len(tickets), e)
+                continue
+
+            tokens = {ticket.id: ticket.push_message.to for ticket in tickets}
+            dead_tokens = [
+                tokens[receipt.id] for receipt in receipts
+                if not receipt.is_success() and (receipt.details or {}).get('error') == DEVICE_NOT_REGISTERED
+            ]
+            if dead_tokens:
+                self.deactivate(dead_tokens)
+
+    def deactivate(self, tokens):
+        deactivate_tokens(tokens)
+        self._count('deactivated', len(tokens))
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+        return {
+            **counts,
+            'queueDepth': self.queue.qsize(),
+            'pendingDigests': len(self.digests),
+            'pendingReceipts': sum(len(tickets) for _, _, tickets in self.receipts),
+            'latencyMs': {
+                'p50': round(statistics.median(latencies) * 1000, 2) if latencies else None,
+                'p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None,
+            },
+        }
+
+
+def get_push_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = PushDispatcher(
+                client_factory=import_string(getattr(settings, 'CHAT_PUSH_CLIENT', 'chats.push.expo_client')),
+                batch_window=getattr(settings, 'CHAT_PUSH_BATCH_WINDOW', 0.05),
+                receipt_delay=getattr(settings, 'CHAT_PUSH_RECEIPT_DELAY', 900),
+                digest_window=getattr(settings, 'CHAT_PUSH_DIGEST_WINDOW', 0),
+                digest_max_wait=getattr(settings, 'CHAT_PUSH_DIGEST_MAX_WAIT', 15),
+            ).start()
+            atexit.register(_dispatcher.stop)
+        return _dispatcher
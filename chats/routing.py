@@ -1,6 +1,7 @@
 from django.urls import re_path
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, UserChatConsumer
 
 websocket_urlpatterns = [
+    re_path(r'ws/chat/$', UserChatConsumer.as_asgi()),
     re_path(r'ws/chat/(?P<chat_room_id>\d+)/$', ChatConsumer.as_asgi()),
 ]
\ No newline at end of file
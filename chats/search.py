@@ -0,0 +1,108 @@
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+from gigs.search import tokenize
+from .models import Message
+
+
+class MessageSearchBackend:
+    """
+    Interface every chat message search backend implements.
+
+    `search` returns up to `limit` (message id, snippet) pairs from the rooms
+    `user_id` takes part in, newest first and below `before_id` when given.
+    Snippets mark matched terms with `highlight`.
+    """
+
+    highlight = ('[', ']')
+
+    def search(self, user_id, query, room_id=None, before_id=None, limit=20):
+        raise NotImplementedError
+
+
+class BasicMessageSearchBackend(MessageSearchBackend):
+    """
+    Database agnostic fallback: every term must appear in the message. Scans
+    the user's messages, so only use it where FTS5 is not available.
+    """
+
+    snippet_length = 120
+
+    def search(self, user_id, query, room_id=None, before_id=None, limit=20):
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        messages = Message.objects.filter(Q(room__buyer_id=user_id) | Q(room__seller_id=user_id))
+        if room_id is not None:
+            messages = messages.filter(room_id=room_id)
+        if before_id is not None:
+            messages = messages.filter(id__lt=before_id)
+        for term in terms:
+            messages = messages.filter(content__icontains=term)
+        return [
+            (message_id, content[:self.snippet_length])
+            for message_id, content in messages.order_by('-id').values_list('id', 'content')[:limit]
+        ]
+
+
+class SQLiteFTSMessageSearchBackend(MessageSearchBackend):
+    """
+    SQLite FTS5 index over message content, created and kept up to date by the
+    triggers of migration 0006. Each message is also indexed with the tokens
+    u<buyer id>, u<seller id> and r<room id>, so scoping a search to the user
+    or a room is one more term in the same index lookup rather than a join.
+    """
+
+    table = 'chats_message_fts'
+
+    snippet_tokens = 12
+
+    def match_expression(self, user_id, query, room_id=None):
+        terms = tokenize(query)
+        if not terms:
+            return None
+        scope = f'scope : "u{int(user_id)}"'
+        if room_id is not None:
+            scope += f' AND scope : "r{int(room_id)}"'
+        # Terms are quoted so user input is never parsed as FTS5 syntax. They
+        # match whole words: FTS5 can skip through a term's doclist to the
+        # scope's rows, but has to merge every doclist a prefix covers first,
+        # which grows with the table.
+        phrases = ' '.join(f'"{term}"' for term in terms)
+        return f'{scope} AND content : ({phrases})'
+
+    def search(self, user_id, query, room_id=None, before_id=None, limit=20):
+        match = self.match_expression(user_id, query, room_id)
+        if not match:
+            return []
+
+        # Newest first by rowid (the message id) walks the index backwards from
+        # the cursor and stops after `limit` hits, without ranking or sorting
+        # every match, so a page costs the same at any table size.
+        sql = (
+            f"SELECT rowid, snippet({self.table}, 0, %s, %s, '…', %s) FROM {self.table} "
+            f"WHERE {self.table} MATCH %s"
+        )
+        params = [*self.highlight, self.snippet_tokens, match]
+        if before_id is not None:
+            sql += " AND rowid < %s"
+            params.append(before_id)
+        sql += " ORDER BY rowid DESC LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+@lru_cache(maxsize=None)
+def get_message_search_backend():
+    backend_path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if not backend_path:
+        if connection.vendor == 'sqlite':
+            backend_path = 'chats.search.SQLiteFTSMessageSearchBackend'
+        else:
+            backend_path = 'chats.search.BasicMessageSearchBackend'
+    return import_string(backend_path)()
@@ -7,5 +7,5 @@ class MessageSerializer(serializers.ModelSerializer):
 
    class Meta:
        model = Message
-       fields = ['id', 'room', 'sender', 'sender_name', 'content', 'timestamp'] 
-       read_only_fields = ['id', 'room', 'sender', 'timestamp']
\ No newline at end of file
+       fields = ['id', 'seq', 'room', 'sender', 'sender_name', 'content', 'timestamp'] 
+       read_only_fields = ['id', 'seq', 'room', 'sender', 'timestamp']
\ No newline at end of file
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import ChatRoom, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# The event loop serving this process's chat sockets, see use_socket_loop().
+_socket_loop = None
+_UNKNOWN = object()
+
+
+def profile_group(user_id):
+    """Group of the sockets that push to `user_id`, see ChatConsumer.profile_changed."""
+    return f"chat_profile_{user_id}"
+
+
+def _group_send(group, message):
+    # Also called from the push dispatcher's thread, see send_to_groups().
+    transaction.on_commit(lambda: send_to_groups([(group, message)]))
+
+
+def use_socket_loop(loop):
+    """Called by consumers on connect, so background threads can reach their loop."""
+    global _socket_loop
+    _socket_loop = loop
+
+
+async def _send_all(layer, sends):
+    for group, message in sends:
+        await layer.group_send(group, message)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Could not send chat group messages", exc_info=future.exception())
+
+
+def send_to_groups(sends):
+    """
+    Sends each (group, message) of `sends` from any thread. Background threads
+    (the write-behind flusher, the push dispatcher) have no event loop, and
+    async_to_sync would give every call a throwaway one: the in-memory layer's
+    queues are not safe to use from it and the broker layer would open a
+    connection per call. They hand the sends to the sockets' loop instead,
+    without waiting for them.
+    """
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    loop = _socket_loop
+    try:
+        on_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        on_loop = False
+    if loop is not None and loop.is_running() and not on_loop:
+        future = asyncio.run_coroutine_threadsafe(_send_all(layer, sends), loop)
+        future.add_done_callback(_log_failure)
+    else:
+        async_to_sync(_send_all)(layer, sends)
+
+
+def user_group(user_id):
+    """Group of the user's chats.consumers.UserChatConsumer sockets."""
+    return f"chat_user_{user_id}"
+
+
+def announce_push_token(user_id, push_token):
+    message = {'type': 'profile_changed', 'user_id': user_id, 'push_token': push_token}
+    _group_send(profile_group(user_id), message)
+    # Per-user sockets of everyone the user chats with cache the token too.
+    # Tokens change rarely, so finding those people here costs little.
+    counterparts = ChatRoom.objects.filter(buyer_id=user_id).values_list('seller_id', flat=True).union(
+        ChatRoom.objects.filter(seller_id=user_id).values_list('buyer_id', flat=True)
+    )
+    for counterpart_id in counterparts:
+        _group_send(user_group(counterpart_id), message)
+
+
+def announce_saved_messages(room_id, participant_ids, message_ids, last_seq):
+    """
+    Gives the room's sockets the seq of write-behind messages, which were
+    broadcast without one, once they are committed. The ids are in seq order
+    and end at `last_seq`.
+    """
+    message = {'type': 'chat_saved', 'room': room_id, 'ids': message_ids, 'last_seq': last_seq}
+    groups = (f"chat_{room_id}", *(user_group(user_id) for user_id in participant_ids))
+    transaction.on_commit(lambda: send_to_groups([(group, message) for group in groups]))
+
+
+@receiver(post_save, sender=UserProfile)
+def refresh_cached_push_token(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and 'push_token' not in update_fields):
+        return
+    # Profiles are saved on every app start; the union query and group sends
+    # only run when the token actually changed. Hand-built instances do not
+    # know the stored token and always announce.
+    previous = None if created else getattr(instance, '_stored_push_token', _UNKNOWN)
+    instance._stored_push_token = instance.push_token
+    if instance.push_token != previous:
+        announce_push_token(instance.user_id, instance.push_token)
+
+
+@receiver(post_delete, sender=UserProfile)
+def drop_cached_push_token(sender, instance, **kwargs):
+    announce_push_token(instance.user_id, None)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def refresh_cached_room(sender, instance, raw=False, **kwargs):
+    # Open sockets reload the room, and close if it was closed or deleted.
+    if raw:
+        return
+    message = {'type': 'room_changed', 'room': instance.id}
+    for group in (f"chat_{instance.id}", user_group(instance.buyer_id), user_group(instance.seller_id)):
+        _group_send(group, message)
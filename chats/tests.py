@@ -1,3 +1,952 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import time
+from unittest import mock, skipIf
+from channels.exceptions import ChannelFull
+from exponent_server_sdk import PushReceipt, PushServerError, PushTicket
+from requests import Response
+from requests.exceptions import ConnectionError
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from accounts.models import User
+from gigs.models import Gig
+from .broker import ChannelBroker
+from .codec import MSGPACK_SUBPROTOCOL, msgpack
+from .consumers import ChatConsumer, UserChatConsumer, insert_message
+from .inbox import backfill_last_messages, mark_read, record_last_message
+from .layers import BrokerChannelLayer
+from . import outbox
+from .presence import LocalPresence, is_present, mark_absent, mark_present, track_presence, untrack_presence
+from .models import ChatRoom, Message, UserProfile
+from .push import PushDispatcher, deactivate_tokens
+from .search import BasicMessageSearchBackend
+from .writebehind import MessageBuffer, replay_journal, reserve_message_ids, save_messages
 
-# Create your tests here.
+
+class ChatInboxTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(phone_number='+920000000001', password='secret', name='Seller')
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+        self.rooms = []
+        for idx in range(4):
+            buyer = User.objects.create_user(phone_number=f'+92000000010{idx}', password='secret', name=f'Buyer {idx}')
+            gig = Gig.objects.create(
+                title=f'Gig {idx}', description='Logos', price=100, category='Design',
+                location='Lahore', creator=self.seller
+            )
+            self.rooms.append(ChatRoom.objects.create(gig=gig, buyer=buyer, seller=self.seller))
+
+    def send(self, room, sender, content):
+        message = Message.objects.create(room=room, sender=sender, content=content)
+        record_last_message(message)
+        return message
+
+    def test_inbox_is_one_query_ordered_by_activity(self):
+        self.send(self.rooms[1], self.rooms[1].buyer, 'Hello')
+        self.send(self.rooms[2], self.seller, 'x' * 300)
+        self.send(self.rooms[1], self.seller, 'Hi there')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/chats/chatrooms/')
+        data = response.json()['data']
+
+        self.assertEqual([room['chat_room_id'] for room in data[:2]], [self.rooms[1].id, self.rooms[2].id])
+        self.assertEqual(data[0]['last_message'], 'Hi there')
+        self.assertEqual(data[0]['last_message_sender_id'], self.seller.id)
+        self.assertEqual(data[0]['other_person_name'], 'Buyer 1')
+        self.assertEqual(len(data[1]['last_message']), 100)
+        self.assertEqual(data[2]['last_message'], 'No messages yet')
+
+    def test_cursor_pages(self):
+        for room in self.rooms:
+            self.send(room, room.buyer, f'Message for {room.id}')
+
+        seen = []
+        params = {'limit': 3}
+        while True:
+            with self.assertNumQueries(1):
+                response = self.client.get('/chats/chatrooms/', params).json()
+            seen.extend(room['chat_room_id'] for room in response['data'])
+            if not response['next_cursor']:
+                break
+            params['cursor'] = response['next_cursor']
+        self.assertEqual(seen, [room.id for room in reversed(self.rooms)])
+
+    def test_reopening_keeps_counters_moved_meanwhile(self):
+        room = self.rooms[0]
+        self.send(room, room.buyer, 'Before closing')
+        ChatRoom.objects.filter(id=room.id).update(is_closed=True)
+        find_rooms = ChatRoom.objects.filter
+
+        def find_then_message(*args, **kwargs):
+            # A message lands after the view has loaded the room.
+            found = find_rooms(*args, **kwargs).first()
+            patcher.stop()
+            self.send(room, self.seller, 'While reopening')
+            return mock.Mock(first=mock.Mock(return_value=found))
+
+        self.client.force_authenticate(room.buyer)
+        patcher = mock.patch.object(ChatRoom.objects, 'filter', find_then_message)
+        patcher.start()
+        self.addCleanup(mock.patch.stopall)
+        response = self.client.post('/chats/chatrooms/create/', {'gig': room.gig_id})
+        self.assertEqual(response.json()['message'], 'Chat room reopened successfully.')
+
+        room.refresh_from_db()
+        self.assertFalse(room.is_closed)
+        self.assertEqual((room.last_seq, room.buyer_unread_count, room.seller_unread_count), (2, 1, 1))
+        self.assertEqual(room.last_message_preview, 'While reopening')
+
+    def test_older_message_does_not_replace_newer(self):
+        newer = self.send(self.rooms[0], self.seller, 'Newer')
+        older = Message.objects.create(room=self.rooms[0], sender=self.seller, content='Older')
+        older.id = newer.id - 1
+        record_last_message(older)
+        self.rooms[0].refresh_from_db()
+        self.assertEqual(self.rooms[0].last_message_id, newer.id)
+
+    def test_unread_counts_and_read_markers(self):
+        room = self.rooms[0]
+        for idx in range(3):
+            self.send(room, room.buyer, f'Question {idx}')
+        self.send(room, self.seller, 'Answer')
+
+        with self.assertNumQueries(1):
+            data = self.client.get('/chats/chatrooms/').json()['data']
+        self.assertEqual({r['chat_room_id']: r['unread_count'] for r in data}[room.id], 3)
+
+        room.refresh_from_db()
+        self.assertEqual(room.buyer_unread_count, 1)
+        # The seller's own answer (seq 4) is not unread for them.
+        self.assertEqual(mark_read(room, self.seller.id, 2), 1)
+        # A slower device sending an older marker changes nothing.
+        self.assertIsNone(mark_read(room, self.seller.id, 1))
+        self.assertIsNone(mark_read(room, self.seller.id, 99))
+        self.assertEqual(mark_read(room, self.seller.id, 4), 0)
+        self.assertEqual(mark_read(room, room.buyer_id, 4), 0)
+
+    def test_backfill(self):
+        message = Message.objects.create(room=self.rooms[3], sender=self.seller, content='Before the snapshot')
+        self.assertEqual(backfill_last_messages(), 4)
+
+        room = ChatRoom.objects.get(id=self.rooms[3].id)
+        self.assertEqual(room.last_message_id, message.id)
+        self.assertEqual(room.last_message_preview, 'Before the snapshot')
+        self.assertEqual(room.last_activity_at, message.timestamp)
+        untouched = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual(untouched.last_activity_at, untouched.created_at)
+
+
+
+class ChatHistorySyncTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(phone_number='+920000000601', password='secret', name='Seller')
+        self.buyer = User.objects.create_user(phone_number='+920000000602', password='secret', name='Buyer')
+        gig = Gig.objects.create(
+            title='Logo', description='Logos', price=100, category='Design', location='Lahore', creator=self.seller
+        )
+        self.room = ChatRoom.objects.create(gig=gig, buyer=self.buyer, seller=self.seller)
+        other = ChatRoom.objects.create(gig=gig, buyer=self.seller, seller=self.buyer)
+        self.messages = []
+        for idx in range(7):
+            self.messages.append(Message.objects.create(room=self.room, sender=self.buyer, content=f'm{idx}'))
+            Message.objects.create(room=other, sender=self.buyer, content=f'other {idx}')
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+    def test_seq_counts_per_room(self):
+        self.assertEqual([m.seq for m in self.messages], [1, 2, 3, 4, 5, 6, 7])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 7)
+
+    def test_forward_sync_after_id(self):
+        url = f'/chats/chatrooms/{self.room.id}/messages/'
+        response = self.client.get(url, {'after_id': self.messages[1].id, 'page_size': 3}).json()
+        self.assertEqual([m['content'] for m in response['data']], ['m2', 'm3', 'm4'])
+        self.assertTrue(response['has_more'])
+
+        response = self.client.get(url, {'after_id': response['data'][-1]['id'], 'page_size': 3}).json()
+        self.assertEqual([m['seq'] for m in response['data']], [6, 7])
+        self.assertFalse(response['has_more'])
+
+        self.assertEqual(self.client.get(url, {'page_size': 0}).status_code, 400)
+
+    def test_forward_sync_after_seq_follows_commit_order(self):
+        # Write-behind: the message with the lower id commits last.
+        earlier, later = (
+            Message(id=message_id, room=self.room, sender=self.buyer, content=content)
+            for message_id, content in zip(reserve_message_ids(2), ('earlier', 'later'))
+        )
+        save_messages([later])
+        save_messages([earlier])
+        url = f'/chats/chatrooms/{self.room.id}/messages/'
+
+        self.assertEqual(self.client.get(url, {'after_id': later.id}).json()['data'], [])
+        response = self.client.get(url, {'after_seq': later.seq}).json()
+        self.assertEqual([(m['content'], m['seq']) for m in response['data']], [('earlier', 9)])
+
+
+class ChatSearchTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(phone_number='+920000000701', password='secret', name='Seller')
+        self.buyer = User.objects.create_user(phone_number='+920000000702', password='secret', name='Buyer')
+        self.stranger = User.objects.create_user(phone_number='+920000000703', password='secret', name='Stranger')
+        self.gig = Gig.objects.create(
+            title='Logo', description='Logos', price=100, category='Design', location='Lahore', creator=self.seller
+        )
+        self.room = ChatRoom.objects.create(gig=self.gig, buyer=self.buyer, seller=self.seller)
+        self.other = ChatRoom.objects.create(gig=self.gig, buyer=self.stranger, seller=self.seller)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def search(self, **params):
+        return self.client.get('/chats/chatrooms/search/', params).json()
+
+    def test_finds_only_the_users_messages(self):
+        first = Message.objects.create(room=self.room, sender=self.seller, content='Here is the final logo design')
+        Message.objects.create(room=self.room, sender=self.buyer, content='Thanks!')
+        Message.objects.create(room=self.other, sender=self.seller, content='Your logo is ready too')
+        # Bulk inserts, as the write-behind buffer does them, are indexed too.
+        save_messages([Message(room=self.room, sender=self.buyer, content='Can the logos be bigger?')])
+
+        response = self.search(q='logo')
+        self.assertEqual([hit['snippet'] for hit in response['data']], ['Here is the final [logo] design'])
+        self.assertEqual(response['data'][0]['id'], first.id)
+        self.assertEqual(self.search(q='final design')['data'][0]['snippet'], 'Here is the [final] logo [design]')
+        self.assertEqual(self.search(q='logos')['data'][0]['snippet'], 'Can the [logos] be bigger?')
+        self.assertEqual(self.search(q='ready')['data'], [])
+        self.assertEqual(self.search(q='logo', room=self.other.id)['data'], [])
+
+    def test_cursor_pages_newest_first(self):
+        for idx in range(5):
+            Message.objects.create(room=self.room, sender=self.seller, content=f'invoice {idx}')
+
+        response = self.search(q='invoice', limit=2)
+        pages = [[hit['snippet'] for hit in response['data']]]
+        while response['next_cursor']:
+            response = self.search(q='invoice', limit=2, cursor=response['next_cursor'])
+            pages.append([hit['snippet'] for hit in response['data']])
+        self.assertEqual(pages, [['[invoice] 4', '[invoice] 3'], ['[invoice] 2', '[invoice] 1'], ['[invoice] 0']])
+        self.assertEqual(self.client.get('/chats/chatrooms/search/', {'q': 'x', 'cursor': 'nope'}).status_code, 400)
+
+    def test_deleted_rooms_leave_the_index(self):
+        Message.objects.create(room=self.room, sender=self.seller, content='invoice attached')
+        self.room.delete()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM chats_message_fts WHERE chats_message_fts MATCH 'invoice'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_index_triggers_exist_after_migrate(self):
+        # A migration that rebuilds chats_message or chats_chatroom drops them silently.
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'chats_%'")
+            triggers = {name for name, in cursor.fetchall()}
+        self.assertEqual(triggers, {
+            'chats_message_fts_insert', 'chats_message_fts_delete', 'chats_message_fts_update',
+            'chats_chatroom_fts_delete',
+        })
+
+    def test_basic_backend_matches(self):
+        message = Message.objects.create(room=self.room, sender=self.seller, content='Here is the final logo')
+        Message.objects.create(room=self.other, sender=self.seller, content='Your logo is ready')
+        self.assertEqual(BasicMessageSearchBackend().search(self.buyer.id, 'final logo'), [(message.id, message.content)])
+
+
+class BrokerChannelLayerTests(SimpleTestCase):
+    def run_with_broker(self, test, **config):
+        path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+
+        async def main():
+            broker = self.broker = ChannelBroker(path, **config)
+            server = await broker.start()
+            layer = BrokerChannelLayer(path)
+            try:
+                await test(layer)
+            finally:
+                await layer.close()
+                server.close()
+                await server.wait_closed()
+                os.unlink(path)
+        asyncio.run(main())
+
+    def test_group_fan_out(self):
+        async def test(layer):
+            first, second = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('chat_1', first)
+            await layer.group_add('chat_1', second)
+            await layer.group_send('chat_1', {'type': 'chat.message', 'message': 'Hi'})
+            self.assertEqual(await layer.receive(first), {'type': 'chat.message', 'message': 'Hi'})
+            self.assertEqual(await layer.receive(second), {'type': 'chat.message', 'message': 'Hi'})
+
+            await layer.group_discard('chat_1', second)
+            await layer.group_send('chat_1', {'type': 'chat.message', 'message': 'Bye'})
+            self.assertEqual((await layer.receive(first))['message'], 'Bye')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(second), 0.1)
+        self.run_with_broker(test)
+
+    def test_capacity_and_expiry(self):
+        async def test(layer):
+            channel = await layer.new_channel()
+            await layer.send(channel, {'type': 'one'})
+            await layer.send(channel, {'type': 'two'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'three'})
+
+            await asyncio.sleep(0.3)
+            await layer.send(channel, {'type': 'fresh'})
+            self.assertEqual(await layer.receive(channel), {'type': 'fresh'})
+        self.run_with_broker(test, capacity=2, expiry=0.2)
+
+    def test_cancelled_receive_keeps_channel_order(self):
+        async def test(layer):
+            channel = await layer.new_channel()
+            for follow_up in ('await', 'concurrent'):
+                receiving = asyncio.ensure_future(layer.receive(channel))
+                while not self.broker.waiters.get(channel):
+                    await asyncio.sleep(0.01)
+                # The broker answers the receive, then the consumer cancels it
+                # before the reply is read, as on a disconnect or a timeout.
+                self.broker.deliver(channel, {'type': 'first'})
+                self.broker.deliver(channel, {'type': 'second'})
+                receiving.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await receiving
+
+                if follow_up == 'concurrent':
+                    # Asked again before the cancelled reply has come back.
+                    received = await asyncio.gather(layer.receive(channel), layer.receive(channel))
+                else:
+                    received = [await layer.receive(channel), await layer.receive(channel)]
+                self.assertEqual([message['type'] for message in received], ['first', 'second'], follow_up)
+        self.run_with_broker(test)
+
+    def test_presence(self):
+        async def test(layer):
+            await layer.presence_join('7:1', 'phone', 60)
+            await layer.presence_join('7:1', 'laptop', 0.1)
+            await layer.presence_leave('7:1', 'phone')
+            self.assertTrue(await layer.presence_check('7:1'))
+            await asyncio.sleep(0.2)
+            self.assertFalse(await layer.presence_check('7:1'))
+        self.run_with_broker(test)
+
+
+class PresenceTests(SimpleTestCase):
+    def test_last_connection_ends_presence(self):
+        async_to_sync(mark_present)(7, 1, 'phone')
+        async_to_sync(mark_present)(7, 1, 'laptop')
+        async_to_sync(mark_absent)(7, 1, 'phone')
+        self.assertTrue(async_to_sync(is_present)(7, 1))
+        self.assertFalse(async_to_sync(is_present)(7, 2))
+
+        async_to_sync(mark_absent)(7, 1, 'laptop')
+        self.assertFalse(async_to_sync(is_present)(7, 1))
+
+    @override_settings(CHAT_PRESENCE_TTL=0)
+    def test_expires_without_heartbeat(self):
+        async_to_sync(mark_present)(8, 1, 'crashed')
+        self.assertFalse(async_to_sync(is_present)(8, 1))
+
+    @override_settings(CHAT_PRESENCE_TTL=0.3)
+    def test_one_heartbeat_renews_every_socket(self):
+        async def test():
+            await track_presence(9, 1, 'phone')
+            await track_presence(9, 2, 'laptop')
+            self.assertEqual(len([task for task in asyncio.all_tasks() if task is not asyncio.current_task()]), 1)
+            await asyncio.sleep(0.5)
+            self.assertTrue(await is_present(9, 1))
+            self.assertTrue(await is_present(9, 2))
+
+            await untrack_presence(9, 1, 'phone')
+            await asyncio.sleep(0.5)
+            self.assertFalse(await is_present(9, 1))
+            self.assertTrue(await is_present(9, 2))
+            await untrack_presence(9, 2, 'laptop')
+        async_to_sync(test)()
+
+    @override_settings(CHAT_PRESENCE_TTL=0.3)
+    def test_heartbeat_skips_sockets_that_left(self):
+        async def test():
+            await track_presence(10, 1, 'phone')
+            await track_presence(10, 2, 'laptop')
+            renewing = asyncio.Event()
+            join = LocalPresence.presence_join
+
+            async def slow_join(backend, key, connection, ttl):
+                if connection == 'phone':
+                    renewing.set()
+                    await asyncio.sleep(0.05)
+                await join(backend, key, connection, ttl)
+
+            with mock.patch.object(LocalPresence, 'presence_join', slow_join):
+                # The laptop disconnects while the phone's renewal is awaited.
+                await renewing.wait()
+                await untrack_presence(10, 2, 'laptop')
+                await asyncio.sleep(0.1)
+            self.assertFalse(await is_present(10, 2))
+            self.assertTrue(await is_present(10, 1))
+            await untrack_presence(10, 1, 'phone')
+        async_to_sync(test)()
+
+
+class OutboxTests(SimpleTestCase):
+    def test_coalesced_frame_goes_behind_earlier_frames(self):
+        async def test():
+            written = []
+            writing = asyncio.Event()
+
+            async def write(frames):
+                written.append(frames)
+                await writing.wait()
+
+            box = outbox.Outbox(write, 10)
+            box.put('message 1')
+            await asyncio.sleep(0)
+            box.put({'read': 1}, coalesce='read')
+            box.put('message 2')
+            # Replacing read 1 where it stood would mark message 2 read
+            # before the client has it.
+            box.put({'read': 2}, coalesce='read')
+            writing.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(written, [['message 1'], ['message 2', {'read': 2}]])
+        async_to_sync(test)()
+
+
+class FakeExpo:
+    """Stands in for exponent_server_sdk.PushClient."""
+
+    def __init__(self, failures=0, unregistered=(), expired=(), invalid=(), failure_status=None):
+        self.failures = failures
+        self.failure_status = failure_status
+        self.unregistered = set(unregistered)
+        self.expired = set(expired)
+        self.invalid = set(invalid)
+        self.requests = 0
+        self.batches = []
+
+    def error(self, status):
+        response = Response()
+        response.status_code = status
+        return PushServerError('Request failed', response)
+
+    def publish_multiple(self, messages):
+        self.requests += 1
+        if self.failures:
+            self.failures -= 1
+            if self.failure_status:
+                raise self.error(self.failure_status)
+            raise ConnectionError('expo unavailable')
+        if any(message.to in self.invalid for message in messages):
+            raise self.error(400)
+        self.batches.append(messages)
+        return [
+            PushTicket(message, 'error', 'gone', {'error': 'DeviceNotRegistered'}, None)
+            if message.to in self.unregistered else
+            PushTicket(message, 'ok', None, None, message.to)
+            for message in messages
+        ]
+
+    def check_receipts_multiple(self, tickets):
+        return [
+            PushReceipt(ticket.id, 'error', 'gone', {'error': 'DeviceNotRegistered'})
+            if ticket.id in self.expired else
+            PushReceipt(ticket.id, 'ok', None, None)
+            for ticket in tickets
+        ]
+
+
+class PushDispatcherTests(TestCase):
+    def test_batches_and_retries(self):
+        expo = FakeExpo(failures=1)
+        dispatcher = PushDispatcher(client_factory=lambda: expo, batch_window=0, backoff=0)
+        for idx in range(3):
+            dispatcher.enqueue(f'token-{idx}', 'Seller: hi', data={'chat_room_id': 1})
+        self.assertEqual(dispatcher.stats()['queueDepth'], 3)
+
+        dispatcher.process()
+
+        self.assertEqual([len(batch) for batch in expo.batches], [3])
+        stats = dispatcher.stats()
+        self.assertEqual((stats['queueDepth'], stats['sent'], stats['retries']), (0, 3, 1))
+        self.assertIsNotNone(stats['latencyMs']['p95'])
+
+    @mock.patch('chats.signals.announce_push_token')
+    def test_only_changed_tokens_are_saved_and_announced(self, announce):
+        user = User.objects.create_user(phone_number='+920000000801', password='secret', name='Buyer')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post('/chats/update-push-token/', {'push_token': 'token-1'})
+        with CaptureQueriesContext(connection) as queries:
+            client.post('/chats/update-push-token/', {'push_token': 'token-1'})
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['SELECT'])
+        client.post('/chats/update-push-token/', {'push_token': 'token-2'})
+
+        self.assertEqual([call.args for call in announce.call_args_list], [(user.id, 'token-1'), (user.id, 'token-2')])
+        self.assertEqual(UserProfile.objects.get(user=user).push_token, 'token-2')
+
+        profile = UserProfile.objects.get(user=user)
+        profile.save()
+        self.assertEqual(announce.call_count, 2)
+
+    def test_retries_server_errors_and_throttling(self):
+        for status in (503, 429):
+            expo = FakeExpo(failures=1, failure_status=status)
+            dispatcher = PushDispatcher(client_factory=lambda: expo, batch_window=0, backoff=0)
+            dispatcher.enqueue('token-0', 'Seller: hi')
+            dispatcher.process()
+            stats = dispatcher.stats()
+            self.assertEqual((stats['retries'], stats['sent']), (1, 1), status)
+
+    def test_rejected_batch_drops_only_the_offending_messages(self):
+        expo = FakeExpo(invalid=['bad-token'])
+        dispatcher = PushDispatcher(client_factory=lambda: expo, batch_window=0)
+        for token in ('token-0', 'token-1', 'bad-token', 'token-3', 'token-4'):
+            dispatcher.enqueue(token, 'Seller: hi')
+
+        with mock.patch('chats.push.time.sleep') as sleep, self.assertLogs('chats.push', 'WARNING') as logs:
+            dispatcher.process()
+
+        # Never retried: split until the refused message is alone.
+        sleep.assert_not_called()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('bad-token', logs.output[0])
+        self.assertEqual(
+            sorted(message.to for batch in expo.batches for message in batch),
+            ['token-0', 'token-1', 'token-3', 'token-4'],
+        )
+        stats = dispatcher.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['retries']), (4, 1, 0))
+
+    def test_dead_tokens_are_deactivated(self):
+        profiles = [
+            UserProfile.objects.create(
+                user=User.objects.create_user(phone_number=f'+92000000030{idx}', password='secret'),
+                push_token=f'token-{idx}',
+            )
+            for idx in range(3)
+        ]
+        expo = FakeExpo(unregistered=['token-0'], expired=['token-1'])
+        dispatcher = PushDispatcher(client_factory=lambda: expo, batch_window=0, receipt_delay=0)
+        for profile in profiles:
+            dispatcher.enqueue(profile.push_token, 'Seller: hi')
+
+        dispatcher.process()
+
+        self.assertEqual(
+            [profile.push_token for profile in UserProfile.objects.order_by('id')],
+            [None, None, 'token-2'],
+        )
+        self.assertEqual(dispatcher.stats()['deactivated'], 2)
+        self.assertEqual(dispatcher.stats()['pendingReceipts'], 0)
+
+    def test_coalesces_per_recipient_and_room(self):
+        expo = FakeExpo()
+        dispatcher = PushDispatcher(client_factory=lambda: expo, batch_window=0, digest_window=60)
+        for idx in range(10):
+            dispatcher.notify(('2', 1), 'seller-token', 'Ali', f'message {idx}')
+        dispatcher.notify(('2', 5), 'seller-token', 'Sara', 'only one')
+
+        dispatcher.process()
+        self.assertEqual(expo.batches, [])
+        self.assertEqual(dispatcher.stats()['pendingDigests'], 2)
+
+        dispatcher.flush_digests(force=True)
+        dispatcher.process()
+        self.assertEqual(
+            sorted(message.body for message in expo.batches[0]),
+            ['Ali: 10 new messages', 'Sara: only one'],
+        )
+        self.assertEqual(dispatcher.stats()['coalesced'], 9)
+
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(phone_number='+920000000401', password='secret', name='Seller')
+        self.buyer = User.objects.create_user(phone_number='+920000000402', password='secret', name='Buyer')
+        self.stranger = User.objects.create_user(phone_number='+920000000403', password='secret', name='Stranger')
+        gig = Gig.objects.create(
+            title='Logo', description='Logos', price=100, category='Design', location='Lahore', creator=self.seller
+        )
+        self.room = ChatRoom.objects.create(gig=gig, buyer=self.buyer, seller=self.seller)
+        self.profile = UserProfile.objects.create(user=self.seller, push_token='old-token')
+
+    def communicator(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/', subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'chat_room_id': str(self.room.id)}}
+        return communicator
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    @mock.patch('chats.consumers.get_push_dispatcher')
+    def test_write_behind_frames_get_their_seq(self, get_dispatcher):
+        buffer = MessageBuffer(tempfile.mkdtemp(), interval=0.01).start()
+        self.addCleanup(buffer.stop)
+
+        async def test():
+            seller = self.communicator(self.seller)
+            await seller.connect()
+            buyer = self.communicator(self.buyer)
+            await buyer.connect()
+
+            await buyer.send_json_to({'message': 'buffered'})
+            await buyer.receive_json_from()
+            frame = await seller.receive_json_from()
+            self.assertIsNone(frame['seq'])
+
+            # Sent by the flusher thread, it must wake the sockets' loop
+            # rather than wait for something else to.
+            started = time.monotonic()
+            saved = {'type': 'saved', 'room': self.room.id, 'ids': [frame['id']], 'last_seq': 1}
+            self.assertEqual(await seller.receive_json_from(timeout=2), saved)
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertEqual(await buyer.receive_json_from(), saved)
+
+            # The seq is good for read markers and for resuming.
+            await seller.send_json_to({'type': 'read', 'seq': saved['last_seq']})
+            self.assertEqual((await seller.receive_json_from())['unread_count'], 0)
+            await seller.send_json_to({'type': 'resume', 'last_seq': 0})
+            self.assertEqual((await seller.receive_json_from())['seq'], 1)
+            await buyer.disconnect()
+            await seller.disconnect()
+
+        with mock.patch('chats.consumers.get_message_buffer', return_value=buffer):
+            async_to_sync(test)()
+
+    @mock.patch('chats.consumers.get_push_dispatcher')
+    def test_dead_token_reaches_sockets_from_the_push_thread(self, get_dispatcher):
+        async def test():
+            loop = asyncio.get_running_loop()
+            buyer = self.communicator(self.buyer)
+            await buyer.connect()
+
+            layer = get_channel_layer()
+            group_send = layer.group_send
+            sent_on = []
+
+            async def recording_group_send(group, message):
+                sent_on.append(asyncio.get_running_loop())
+                await group_send(group, message)
+
+            with mock.patch.object(layer, 'group_send', recording_group_send):
+                # As PushDispatcher.deactivate does, on a thread with no loop.
+                await asyncio.to_thread(deactivate_tokens, ['old-token'])
+                await asyncio.sleep(0.05)
+            self.assertTrue(sent_on)
+            self.assertTrue(all(sent_loop is loop for sent_loop in sent_on))
+
+            await buyer.send_json_to({'message': 'No token to push to'})
+            await buyer.receive_json_from()
+            await buyer.disconnect()
+
+        async_to_sync(test)()
+        get_dispatcher.return_value.notify.assert_not_called()
+
+    def test_rejects_non_participants(self):
+        async def test():
+            connected, _ = await self.communicator(self.stranger).connect()
+            self.assertFalse(connected)
+        async_to_sync(test)()
+
+    @mock.patch('chats.consumers.get_push_dispatcher')
+    def test_user_socket_follows_all_rooms(self, get_dispatcher):
+        gig = Gig.objects.create(
+            title='Poster', description='Posters', price=50, category='Design', location='Lahore', creator=self.buyer
+        )
+        second = ChatRoom.objects.create(gig=gig, buyer=self.seller, seller=self.buyer)
+
+        async def test():
+            seller = WebsocketCommunicator(UserChatConsumer.as_asgi(), '/ws/chat/')
+            seller.scope['user'] = self.seller
+            await seller.connect()
+            self.assertEqual(await seller.receive_json_from(), {'type': 'subscribed', 'rooms': [self.room.id, second.id]})
+
+            buyer = self.communicator(self.buyer)
+            await buyer.connect()
+            await buyer.send_json_to({'message': 'In the first room'})
+            await buyer.receive_json_from()
+            frame = await seller.receive_json_from()
+            self.assertEqual((frame['room'], frame['message']), (self.room.id, 'In the first room'))
+
+            await seller.send_json_to({'type': 'unsubscribe', 'rooms': [self.room.id]})
+            self.assertEqual((await seller.receive_json_from())['rooms'], [second.id])
+            self.assertFalse(await is_present(self.seller.id, self.room.id))
+            self.assertTrue(await is_present(self.seller.id, second.id))
+            await buyer.send_json_to({'message': 'Not followed'})
+            await buyer.receive_json_from()
+            await seller.send_json_to({'room': second.id, 'message': 'From the inbox socket'})
+            frame = await seller.receive_json_from()
+            self.assertEqual((frame['room'], frame['message']), (second.id, 'From the inbox socket'))
+
+            await seller.send_json_to({'room': 999999, 'message': 'Nope'})
+            self.assertEqual((await seller.receive_json_from())['type'], 'error')
+
+            await seller.send_json_to({'type': 'subscribe', 'rooms': [self.room.id]})
+            await seller.receive_json_from()
+            self.assertTrue(await is_present(self.seller.id, self.room.id))
+            await buyer.disconnect()
+            await seller.disconnect()
+            self.assertFalse(await is_present(self.seller.id, self.room.id))
+            self.assertFalse(await is_present(self.seller.id, second.id))
+
+        async_to_sync(test)()
+        # The inbox socket makes the seller present only in the rooms it is
+        # sent: the message in the unsubscribed room was pushed.
+        notify = get_dispatcher.return_value.notify
+        notify.assert_called_once()
+        self.assertEqual(notify.call_args.args[0], (self.seller.id, self.room.id))
+        self.assertEqual(notify.call_args.args[3], 'Not followed')
+
+    @override_settings(CHAT_RESUME_MAX_MESSAGES=2)
+    def test_resume_replays_the_gap(self):
+        for idx in range(4):
+            Message.objects.create(room=self.room, sender=self.seller, content=f'm{idx}')
+
+        async def test():
+            communicator = self.communicator(self.buyer)
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'resume', 'last_seq': 1})
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+            return frames
+
+        first, second, done = async_to_sync(test)()
+        self.assertEqual([(first['seq'], first['message']), (second['seq'], second['message'])], [(2, 'm1'), (3, 'm2')])
+        self.assertEqual(done, {'type': 'resume_complete', 'room': self.room.id, 'last_seq': 3, 'has_more': True})
+
+    @mock.patch('chats.consumers.get_push_dispatcher')
+    def test_message_uses_cached_membership(self, get_dispatcher):
+        def update_token():
+            self.profile.push_token = 'new-token'
+            self.profile.save()
+
+        async def test():
+            communicator = self.communicator(self.buyer)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await database_sync_to_async(update_token)()
+            await asyncio.sleep(0.05)
+            # Entered on the thread the consumer's queries run on.
+            queries = CaptureQueriesContext(connection)
+            await database_sync_to_async(queries.__enter__)()
+            await communicator.send_json_to({'message': 'hello'})
+            self.assertEqual((await communicator.receive_json_from())['message'], 'hello')
+            await database_sync_to_async(queries.__exit__)(None, None, None)
+            await communicator.disconnect()
+            return queries
+
+        queries = async_to_sync(test)()
+        # Sequence number, message, inbox snapshot; no membership lookups.
+        self.assertEqual(
+            [query['sql'].split()[0] for query in queries],
+            ['BEGIN', 'UPDATE', 'SELECT', 'INSERT', 'UPDATE', 'COMMIT'],
+        )
+        self.assertNotIn('chats_userprofile', ' '.join(query['sql'] for query in queries))
+        self.assertEqual(get_dispatcher.return_value.notify.call_args.args[1], 'new-token')
+
+    @override_settings(CHAT_SOCKET_OUTBOX_LIMIT=2)
+    def test_slow_client_is_dropped(self):
+        async def stalled(consumer, frames):
+            await asyncio.Event().wait()
+
+        async def test():
+            communicator = self.communicator(self.buyer)
+            await communicator.connect()
+            layer, group = get_channel_layer(), f'chat_{self.room.id}'
+            coalesced = outbox.stats()['coalesced']
+
+            def read(seq):
+                return {'type': 'chat_read', 'room': self.room.id, 'user_id': self.seller.id, 'seq': seq, 'unread_count': 0}
+
+            message = {'type': 'chat_message', 'room': self.room.id, 'id': 1, 'seq': 1, 'message': 'hi', 'sender_id': self.seller.id}
+            await layer.group_send(group, read(1))
+            await asyncio.sleep(0.05)
+            for event in (read(2), read(3), message):
+                await layer.group_send(group, event)
+            await asyncio.sleep(0.05)
+            # read(1) is being written; read(3) replaced read(2) in the queue.
+            stats = outbox.stats()
+            self.assertEqual((stats['socketsBehind'], stats['queuedFrames']), (1, 2))
+            self.assertEqual(stats['coalesced'], coalesced + 1)
+
+            await layer.group_send(group, message)
+            self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4008})
+            self.assertEqual(outbox.stats()['socketsBehind'], 0)
+            await communicator.disconnect()
+
+        with mock.patch.object(ChatConsumer, 'write_frames', stalled):
+            async_to_sync(test)()
+
+    @override_settings(CHAT_SOCKET_OUTBOX_LIMIT=3)
+    def test_unacknowledged_frames_count_against_the_limit(self):
+        # The test server, like daphne, takes every frame at once.
+        async def test():
+            communicator = self.communicator(self.buyer)
+            await communicator.connect()
+            layer, group = get_channel_layer(), f'chat_{self.room.id}'
+
+            async def send_messages(count):
+                for seq in range(count):
+                    await layer.group_send(group, {
+                        'type': 'chat_message', 'room': self.room.id, 'id': seq, 'seq': seq,
+                        'message': 'hi', 'sender_id': self.seller.id,
+                    })
+
+            await communicator.send_json_to({'type': 'ack', 'received': 0})
+            await send_messages(3)
+            for _ in range(3):
+                await communicator.receive_json_from()
+            await communicator.send_json_to({'type': 'ack', 'received': 3})
+            await asyncio.sleep(0.05)
+
+            await send_messages(3)
+            for _ in range(3):
+                await communicator.receive_json_from()
+            # Three written and not acknowledged: the client is behind.
+            await send_messages(1)
+            self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4008})
+            await communicator.disconnect()
+
+        async_to_sync(test)()
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    @mock.patch('chats.consumers.get_push_dispatcher')
+    def test_msgpack_subprotocol(self, get_dispatcher):
+        async def test():
+            communicator = self.communicator(self.buyer, subprotocols=[MSGPACK_SUBPROTOCOL])
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+            await communicator.send_to(bytes_data=msgpack.packb({'m': 'hello'}))
+            frames = msgpack.unpackb(await communicator.receive_from())
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(test)()
+        self.assertEqual(frames, [{'r': self.room.id, 'i': Message.objects.get().id, 's': 1, 'm': 'hello', 'f': self.buyer.id}])
+
+    def test_json_is_the_default(self):
+        async def test():
+            communicator = self.communicator(self.buyer, subprotocols=['something-else'])
+            connected, subprotocol = await communicator.connect()
+            await communicator.disconnect()
+            return connected, subprotocol
+
+        self.assertEqual(async_to_sync(test)(), (True, None))
+
+
+class MessageBufferTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(phone_number='+920000000501', password='secret', name='Seller')
+        self.buyer = User.objects.create_user(phone_number='+920000000502', password='secret', name='Buyer')
+        gig = Gig.objects.create(
+            title='Logo', description='Logos', price=100, category='Design', location='Lahore', creator=self.seller
+        )
+        self.room = ChatRoom.objects.create(gig=gig, buyer=self.buyer, seller=self.seller)
+        self.journal = tempfile.mkdtemp()
+
+    def test_flush_saves_in_order_and_clears_journal(self):
+        buffer = MessageBuffer(self.journal)
+        sent = [buffer.add(self.room.id, self.buyer.id, f'message {idx}') for idx in range(5)]
+        self.assertEqual(Message.objects.count(), 0)
+
+        self.assertEqual(buffer.flush(), 5)
+        buffer.stop()
+
+        saved = list(Message.objects.order_by('id'))
+        self.assertEqual([(m.id, m.content, m.timestamp) for m in saved], [(m.id, m.content, m.timestamp) for m in sent])
+        self.assertEqual([m.seq for m in saved], [1, 2, 3, 4, 5])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_message_id, self.room.last_seq), (sent[-1].id, 5))
+        self.assertEqual(os.listdir(self.journal), [])
+
+    def test_replays_journal_of_crashed_process(self):
+        crashed = MessageBuffer(self.journal)
+        sent = [crashed.add(self.room.id, self.buyer.id, f'message {idx}') for idx in range(3)]
+        # The process dies: its lock goes away, the buffered messages do not.
+        os.close(crashed.segment.fd)
+
+        self.assertEqual(replay_journal(self.journal), 3)
+        self.assertEqual(replay_journal(self.journal), 0)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', flat=True)), [m.id for m in sent])
+
+    def test_replay_after_commit_counts_nothing_twice(self):
+        crashed = MessageBuffer(self.journal)
+        sent = [crashed.add(self.room.id, self.buyer.id, f'message {idx}') for idx in range(3)]
+        # The flush commits, then the process dies before deleting the segment.
+        save_messages(list(crashed.pending))
+        os.close(crashed.segment.fd)
+
+        self.assertEqual(replay_journal(self.journal), 3)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('id', 'seq')), [(m.id, m.seq) for m in sent])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_seq, self.room.seller_unread_count), (3, 3))
+
+    def test_retried_flush_counts_committed_batches_once(self):
+        buffer = MessageBuffer(self.journal, batch_size=2)
+        for idx in range(5):
+            buffer.add(self.room.id, self.buyer.id, f'message {idx}')
+        calls = []
+
+        def fail_second_batch(batch, replay=False):
+            calls.append(len(batch))
+            if len(calls) == 2:
+                raise OperationalError('database is locked')
+            save_messages(batch, replay=replay)
+
+        with mock.patch('chats.writebehind.save_messages', fail_second_batch):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+        self.assertEqual(buffer.flush(), 5)
+        buffer.stop()
+
+        self.assertEqual(list(Message.objects.order_by('id').values_list('seq', flat=True)), [1, 2, 3, 4, 5])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_seq, self.room.seller_unread_count), (5, 5))
+
+    def test_ids_never_collide_with_direct_inserts_or_other_processes(self):
+        first, second = MessageBuffer(self.journal, id_block=3), MessageBuffer(self.journal, id_block=3)
+        buffered = [buffer.add(self.room.id, self.buyer.id, 'buffered') for buffer in (first, second, first, second)]
+        direct = insert_message(self.room.id, self.seller.id, 'direct')
+        buffered += [first.add(self.room.id, self.buyer.id, 'buffered') for _ in range(3)]
+
+        ids = [message.id for message in buffered]
+        self.assertEqual(len(set(ids + [direct.id])), 8)
+        # Safe as JavaScript numbers.
+        self.assertLess(max(ids + [direct.id]), 2 ** 53)
+
+        first.flush()
+        second.flush()
+        first.stop()
+        second.stop()
+        self.assertEqual(Message.objects.count(), 8)
+
+    def test_id_taken_by_another_message_is_reported(self):
+        crashed = MessageBuffer(self.journal)
+        message = crashed.add(self.room.id, self.buyer.id, 'journaled')
+        os.close(crashed.segment.fd)
+        Message.objects.create(id=message.id, room=self.room, sender=self.seller, content='something else', seq=1)
+
+        with self.assertLogs('chats.writebehind', 'ERROR') as logs:
+            replay_journal(self.journal)
+        self.assertIn(str(message.id), logs.output[0])
+        self.assertEqual(Message.objects.get(id=message.id).content, 'something else')
+
+    def test_live_segments_are_not_replayed(self):
+        buffer = MessageBuffer(self.journal)
+        buffer.add(self.room.id, self.buyer.id, 'in flight')
+        self.assertEqual(replay_journal(self.journal), 0)
+        buffer.stop()
+        self.assertEqual(Message.objects.count(), 1)
@@ -4,8 +4,11 @@ from . import views
 urlpatterns = [
     path('chatrooms/', views.get_chat_list, name='get_chat_list'),
     path('chatrooms/create/', views.create_chat_room, name='create_chat_room'),
+    path('chatrooms/search/', views.search_messages, name='search_messages'),
     path('chatrooms/<int:chatroom_id>/messages/', views.get_messages, name='get_messages'),
     path('chatrooms/<int:chatroom_id>/close/', views.close_chat_room, name='close_chatroom'),
     path('update-push-token/', views.update_push_token, name='update_push_token'),
+    path('push-stats/', views.get_push_stats, name='get_push_stats'),
+    path('socket-stats/', views.get_socket_stats, name='get_socket_stats'),
     path('update-notification-settings/', views.update_notification_settings, name='update_notification_settings'),
 ]
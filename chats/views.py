@@ -1,12 +1,19 @@
+from django.conf import settings
 from django.db import models
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from .models import ChatRoom, Message, UserProfile
 from gigs.models import Gig
+from gigs.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page
+from . import outbox
+from .push import get_push_dispatcher
+from .search import get_message_search_backend
 from .serializers import MessageSerializer
 
+INBOX_ORDERING = ('-last_activity_at', '-id')
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -27,7 +34,8 @@ def create_chat_room(request):
         if chat_room:
             if chat_room.is_closed:
                 chat_room.is_closed = False
-                chat_room.save()
+                # Only this field: the inbox counters move under concurrent messages.
+                chat_room.save(update_fields=['is_closed'])
                 return Response({"success": True, "message": "Chat room reopened successfully.", "data": {"chat_room_id": chat_room.id}}, status=status.HTTP_200_OK)
             else:
                 return Response({"success": True, "message": "Chat room already open.", "data": {"chat_room_id": chat_room.id}}, status=status.HTTP_200_OK)
@@ -46,37 +54,113 @@ def get_chat_list(request):
     try:
         chat_rooms = ChatRoom.objects.filter(
             models.Q(buyer=request.user) | models.Q(seller=request.user), is_closed=False
-        ).select_related("gig", "buyer", "seller")
+        ).select_related("buyer", "seller")
+
+        # Opt-in cursor pages; without cursor or limit the whole inbox is returned.
+        paginate = 'cursor' in request.query_params or 'limit' in request.query_params
+        if paginate:
+            try:
+                chat_rooms, next_cursor = keyset_page(
+                    chat_rooms, INBOX_ORDERING, int(request.query_params.get('limit', 20)),
+                    request.query_params.get('cursor'), key='inbox'
+                )
+            except (InvalidCursor, ValueError) as e:
+                return Response({"success": False, "error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            chat_rooms = chat_rooms.order_by(*INBOX_ORDERING)
 
         data = []
         for room in chat_rooms:
-            last_message = Message.objects.filter(room=room).order_by('-timestamp').first()
-
-            if last_message:
-                if last_message.sender == request.user:
-                    other_person_name = room.seller.name if room.buyer == request.user else room.buyer.name
-                else:
-                    other_person_name = last_message.sender.name
+            other_person = room.seller if room.buyer_id == request.user.id else room.buyer
 
-                last_message_time = last_message.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                last_message_content = last_message.content
+            if room.last_message_id:
+                last_message_time = room.last_message_at.strftime('%Y-%m-%d %H:%M:%S')
+                last_message_content = room.last_message_preview
             else:
-                other_person_name = room.seller.name if room.buyer == request.user else room.buyer.name
                 last_message_time = room.created_at
                 last_message_content = "No messages yet"
 
             data.append({
                 "chat_room_id": room.id,
                 "last_message": last_message_content,
+                "last_message_id": room.last_message_id,
+                "last_message_sender_id": room.last_message_sender_id,
                 "last_message_time": last_message_time,
-                "other_person_name": other_person_name,
+                "other_person_name": other_person.name,
+                "unread_count": room.unread_count_for(request.user.id),
             })
-        return Response({"success": True, "data": data}, status=status.HTTP_200_OK)
+
+        response_data = {"success": True, "data": data}
+        if paginate:
+            response_data["next_cursor"] = next_cursor
+        return Response(response_data, status=status.HTTP_200_OK)
 
     except Exception as e:
         return Response({"success": False, "error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_messages(request):
+    """
+    GET chatrooms/search/?q=<terms>[&room=<id>][&limit=][&cursor=]: the user's
+    messages containing every term as a word, newest first, with the
+    matched terms in `snippet` wrapped in [ and ].
+    """
+    try:
+        query = request.query_params.get('q', '')
+        room_id = request.query_params.get('room')
+        limit = min(int(request.query_params.get('limit', 20)), settings.CHAT_MESSAGES_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        before_id = None
+        if request.query_params.get('cursor'):
+            values = decode_cursor('chat-search', request.query_params['cursor'])
+            if len(values) != 1 or not isinstance(values[0], int):
+                raise InvalidCursor('Invalid cursor.')
+            before_id = values[0]
+
+        hits = get_message_search_backend().search(
+            request.user.id, query, int(room_id) if room_id else None, before_id, limit + 1
+        )
+        next_cursor = encode_cursor('chat-search', [hits[limit - 1][0]]) if len(hits) > limit else None
+        hits = hits[:limit]
+
+        # Rows deleted since they were indexed are skipped.
+        messages = Message.objects.in_bulk([message_id for message_id, _ in hits])
+        data = []
+        for message_id, snippet in hits:
+            message = messages.get(message_id)
+            if message is None:
+                continue
+            data.append({
+                'id': message.id,
+                'seq': message.seq,
+                'chat_room_id': message.room_id,
+                'sender_id': message.sender_id,
+                'snippet': snippet,
+                'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+        return Response({
+            'success': True,
+            'data': data,
+            'next_cursor': next_cursor
+        }, status=status.HTTP_200_OK)
+
+    except (InvalidCursor, ValueError) as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def close_chat_room(request, chatroom_id):
@@ -90,7 +174,8 @@ def close_chat_room(request, chatroom_id):
             return Response({"success": False, "error": "You are not authorized to close this chat room."}, status=status.HTTP_403_FORBIDDEN)
 
         chat_room.is_closed = True
-        chat_room.save()
+        # Only this field: the inbox counters move under concurrent messages.
+        chat_room.save(update_fields=['is_closed'])
 
         return Response({"success": True, "message": "Chat room closed successfully."}, status=status.HTTP_200_OK)
 
@@ -115,26 +200,43 @@ def get_messages(request, chatroom_id):
                 'error': 'You do not have permission to access this chat room.'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        page_size = 20 
-        last_message_id = request.query_params.get('last_message_id')  
-        
-        if last_message_id:
-            messages = Message.objects.filter(
-                room=chatroom,
-                id__lt=last_message_id
-            ).order_by('-id')[:page_size]
+        page_size = min(int(request.query_params.get('page_size', 20)), settings.CHAT_MESSAGES_MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise ValueError("page_size must be positive")
+        last_message_id = request.query_params.get('last_message_id')
+        after_id = request.query_params.get('after_id')
+        after_seq = request.query_params.get('after_seq')
+
+        messages = Message.objects.filter(room=chatroom)
+        if after_seq:
+            # Forward sync in commit order. In write-behind mode a message can
+            # commit after one with a higher id, which after_id would skip.
+            messages = messages.filter(seq__gt=int(after_seq)).order_by('seq')
+        elif after_id:
+            # Forward sync: the messages after one the client already has,
+            # oldest first.
+            messages = messages.filter(id__gt=after_id).order_by('id')
+        elif last_message_id:
+            messages = messages.filter(id__lt=last_message_id).order_by('-id')
         else:
-            messages = Message.objects.filter(
-                room=chatroom
-            ).order_by('-id')[:page_size]
+            messages = messages.order_by('-id')
+        messages = list(messages.select_related('sender')[:page_size + 1])
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
 
         serialized_messages = MessageSerializer(messages, many=True)
 
         return Response({
             'success': True,
-            'data': serialized_messages.data
+            'data': serialized_messages.data,
+            'has_more': has_more
         }, status=status.HTTP_200_OK)
 
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({
             'success': False,
@@ -142,7 +244,7 @@ def get_messages(request, chatroom_id):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -155,9 +257,11 @@ def update_push_token(request):
     if not push_token:
         return Response({'error': 'Push token is required'}, status=status.HTTP_400_BAD_REQUEST)
     
-    profile, created = UserProfile.objects.get_or_create(user=user)
-    profile.push_token = push_token
-    profile.save()
+    profile, created = UserProfile.objects.get_or_create(user=user, defaults={'push_token': push_token})
+    # Apps send their token on every start; it rarely changes.
+    if profile.push_token != push_token:
+        profile.push_token = push_token
+        profile.save(update_fields=['push_token'])
     
     return Response({'message': 'Push token updated successfully'})
 
@@ -172,3 +276,22 @@ def update_notification_settings(request):
                       status=status.HTTP_400_BAD_REQUEST)
     
     return Response({'message': 'Notification settings updated successfully'})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_push_stats(request):
+    return Response({
+        'success': True,
+        'data': get_push_dispatcher().stats()
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_socket_stats(request):
+    # Per process, like the push stats.
+    return Response({
+        'success': True,
+        'data': outbox.stats()
+    })
@@ -0,0 +1,340 @@
+"""
+Write-behind buffer for chat messages (CHAT_WRITE_BEHIND).
+
+ChatConsumer hands each message to MessageBuffer.add(), which assigns its id
+from a block reserved in the table's id sequence (see MessageIds) and its
+timestamp, appends it to a journal segment and returns at once, so the
+message is broadcast before it reaches the database. A flusher thread saves
+the buffer with one bulk_create every CHAT_WRITE_BEHIND_INTERVAL seconds.
+The room sequence number (Message.seq) is assigned during that save, so the
+broadcast frame has no seq; once the save commits, a chat_saved event hands
+it to the room's sockets. Seq is also what clients page forward by, as a
+message can commit after one with a higher id.
+
+A segment is deleted only after its messages are committed. Every process
+holds a lock on the segments it owns, so a segment that nobody has locked was
+left by a process that died before flushing. replay_journal() saves those
+segments again, and running it twice is safe because the ids are already
+assigned: messages whose ids are in the table are skipped before anything
+is counted for them.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from operator import attrgetter
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .inbox import record_last_message
+from .models import ChatRoom, Message
+from .signals import announce_saved_messages
+
+logger = logging.getLogger(__name__)
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def reserve_message_ids(count):
+    """
+    Takes `count` ids from the sequence chats_message numbers its rows from,
+    in increasing order. Nothing else is handed them afterwards: neither an
+    autoincrement insert nor another process reserving at the same time.
+    """
+    table = Message._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT numbers new rows after sqlite_sequence, which has
+            # no row until the table's first insert.
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s", [count, table])
+            if not cursor.rowcount:
+                cursor.execute(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX(id), 0) + %s FROM {table}",
+                    [table, count],
+                )
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            last_id = cursor.fetchone()[0]
+            return list(range(last_id - count + 1, last_id + 1))
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [table, count]
+            )
+            return sorted(row[0] for row in cursor.fetchall())
+    raise ImproperlyConfigured(f"CHAT_WRITE_BEHIND does not support {connection.vendor} databases.")
+
+
+class MessageIds:
+    """
+    Ids for buffered messages, from blocks of `block_size` reserved in the
+    table's own id sequence. So they never collide with rows saved directly or
+    by another process, stay below 2**53 like every autoincrement id, and
+    increase within the process, which keeps a room's messages in order.
+    """
+
+    def __init__(self, block_size=1000):
+        self.block_size = block_size
+        self.ids = deque()
+        self.lock = threading.Lock()
+
+    def available(self):
+        return len(self.ids)
+
+    def reserve(self):
+        """Reserves another block. A database write, so async callers run it in a thread."""
+        ids = reserve_message_ids(self.block_size)
+        with self.lock:
+            self.ids.extend(ids)
+
+    def next(self):
+        while True:
+            with self.lock:
+                if self.ids:
+                    return self.ids.popleft()
+            self.reserve()
+
+
+class _Segment:
+    """One journal file, locked for as long as this process owns it."""
+
+    def __init__(self, directory):
+        self.path = Path(directory) / f"{os.getpid()}-{uuid.uuid4().hex}.jsonl"
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def append(self, line, fsync):
+        os.write(self.fd, line)
+        if fsync:
+            os.fsync(self.fd)
+
+    def remove(self):
+        os.unlink(self.path)
+        os.close(self.fd)
+
+
+def _to_line(message):
+    return (json.dumps({
+        'id': message.id,
+        'room': message.room_id,
+        'sender': message.sender_id,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }) + '\n').encode()
+
+
+def _from_line(line):
+    data = json.loads(line)
+    return Message(
+        id=data['id'], room_id=data['room'], sender_id=data['sender'],
+        content=data['content'], timestamp=parse_datetime(data['timestamp']),
+    )
+
+
+def unsaved(messages, batch_size=500):
+    """
+    The messages of `messages` whose ids are not in the table yet. An id that
+    is taken by a different message is logged and the message dropped.
+    """
+    saved = {}
+    for start in range(0, len(messages), batch_size):
+        batch_ids = [message.id for message in messages[start:start + batch_size]]
+        rows = Message.objects.filter(id__in=batch_ids).values_list('id', 'room_id', 'sender_id', 'content')
+        saved.update((row[0], row[1:]) for row in rows)
+    for message in messages:
+        if message.id in saved and saved[message.id] != (message.room_id, message.sender_id, message.content):
+            logger.error("Dropping buffered chat message %s: its id belongs to another message", message.id)
+    return [message for message in messages if message.id not in saved]
+
+
+def save_messages(messages, replay=False):
+    """
+    Inserts `messages` and moves each room's inbox snapshot, in one
+    transaction. Sequence numbers are handed out here, in id order per room,
+    because only the database can order messages from several processes.
+    With `replay`, messages an earlier attempt already committed are left
+    out first, so their rooms' seq and unread counts do not move twice.
+    """
+    with transaction.atomic():
+        if replay:
+            messages = unsaved(messages)
+        by_room = defaultdict(list)
+        for message in sorted(messages, key=attrgetter('id')):
+            by_room[message.room_id].append(message)
+        saved = []
+        for room_id, room_messages in list(by_room.items()):
+            try:
+                last_seq = ChatRoom.allocate_seq(room_id, [message.sender_id for message in room_messages])
+            except ChatRoom.DoesNotExist:
+                logger.error("Dropping %d buffered messages of deleted chat room %s", len(room_messages), room_id)
+                del by_room[room_id]
+                continue
+            for seq, message in enumerate(room_messages, start=last_seq - len(room_messages) + 1):
+                message.seq = seq
+            saved.extend(room_messages)
+        Message.objects.bulk_create(saved)
+        for room_messages in by_room.values():
+            record_last_message(room_messages[-1])
+        participants = ChatRoom.objects.filter(id__in=by_room).values_list('id', 'buyer_id', 'seller_id')
+        for room_id, buyer_id, seller_id in participants:
+            room_messages = by_room[room_id]
+            announce_saved_messages(
+                room_id, (buyer_id, seller_id), [message.id for message in room_messages], room_messages[-1].seq
+            )
+
+
+def save_each(messages, replay=False):
+    # Some message the database will not take, e.g. from a deleted user;
+    # drop it rather than block every later flush.
+    for message in messages:
+        try:
+            save_messages([message], replay=replay)
+        except IntegrityError as e:
+            logger.error("Dropping buffered chat message %s: %s", message.id, e)
+
+
+class MessageBuffer:
+    def __init__(self, journal_dir, interval=0.005, batch_size=500, fsync=False, id_block=1000):
+        self.journal_dir = Path(journal_dir)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.ids = MessageIds(id_block)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.segment = _Segment(self.journal_dir)
+        # [segment, messages, attempted] taken out of `pending`, not yet committed
+        self.sealed = []
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='chat-write-behind', daemon=True)
+        self.thread.start()
+        return self
+
+    def add(self, room_id, sender_id, content):
+        """Journals a message and returns it unsaved, with its final id and timestamp."""
+        with self.lock:
+            message = Message(
+                id=self.ids.next(), room_id=room_id, sender_id=sender_id,
+                content=content, timestamp=timezone.now(),
+            )
+            self.segment.append(_to_line(message), self.fsync)
+            self.pending.append(message)
+        return message
+
+    def run(self):
+        try:
+            replay_journal(self.journal_dir)
+        except Exception:
+            logger.exception("Could not replay the chat write-behind journal")
+        while not self.stopping.is_set():
+            self.stopping.wait(self.interval)
+            try:
+                self.flush()
+                if self.ids.available() < self.ids.block_size // 2:
+                    # Ahead of time, so add() rarely has to wait for a block.
+                    self.ids.reserve()
+            except Exception:
+                logger.exception("Chat write-behind flush failed; the journal keeps the messages")
+                self.stopping.wait(1)
+        self.flush()
+
+    def flush(self):
+        """Saves everything added so far. Returns the number of messages written."""
+        with self.lock:
+            if self.pending:
+                self.sealed.append([self.segment, self.pending, False])
+                self.pending, self.segment = [], _Segment(self.journal_dir)
+            sealed = list(self.sealed)
+
+        written = 0
+        close_old_connections()
+        try:
+            for entry in sealed:
+                segment, messages, attempted = entry
+                # A failed attempt may have committed some batches already.
+                entry[2] = True
+                for start in range(0, len(messages), self.batch_size):
+                    batch = messages[start:start + self.batch_size]
+                    try:
+                        save_messages(batch, replay=attempted)
+                    except IntegrityError:
+                        save_each(batch, replay=attempted)
+                segment.remove()
+                with self.lock:
+                    self.sealed.remove(entry)
+                written += len(messages)
+        finally:
+            close_old_connections()
+        return written
+
+    def stop(self, timeout=10):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        else:
+            self.flush()
+        with self.lock:
+            if not self.pending and not self.sealed:
+                self.segment.remove()
+
+
+def replay_segment(path):
+    """Saves one orphaned journal segment, skipping messages already in the table, then deletes it."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # Still owned by a running process.
+        os.close(fd)
+        return 0
+
+    try:
+        with open(path, 'rb') as journal:
+            # A crash mid-append leaves at most one partial last line.
+            messages = [_from_line(line) for line in journal if line.endswith(b'\n')]
+        try:
+            save_messages(messages, replay=True)
+        except IntegrityError:
+            save_each(messages, replay=True)
+        os.unlink(path)
+    finally:
+        os.close(fd)
+    return len(messages)
+
+
+def replay_journal(journal_dir=None):
+    """Saves the segments left by processes that stopped before flushing."""
+    journal_dir = Path(journal_dir or settings.CHAT_WRITE_BEHIND_JOURNAL)
+    if not journal_dir.is_dir():
+        return 0
+    return sum(replay_segment(path) for path in sorted(journal_dir.glob('*.jsonl')))
+
+
+def write_behind_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+
+def get_message_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = MessageBuffer(
+                settings.CHAT_WRITE_BEHIND_JOURNAL,
+                interval=getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.005),
+                batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 500),
+                fsync=getattr(settings, 'CHAT_WRITE_BEHIND_FSYNC', False),
+                id_block=getattr(settings, 'CHAT_WRITE_BEHIND_ID_BLOCK', 1000),
+            ).start()
+            atexit.register(_buffer.stop)
+        return _buffer
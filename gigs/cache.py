@@ -0,0 +1,105 @@
+import hashlib
+import json
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+GENERATION_KEY = 'gigs:generation'
+HITS_KEY = 'gigs:feed:hits'
+MISSES_KEY = 'gigs:feed:misses'
+
+# Query parameters that change the feed response, with their defaults.
+FEED_PARAMS = {
+    'category': '',
+    'minPrice': '',
+    'maxPrice': '',
+    'search': '',
+    'near': '',
+    'radius': '',
+    'page': '1',
+    'limit': '10',
+    'cursor': None,
+}
+
+
+def gig_cache():
+    return caches[getattr(settings, 'GIG_CACHE_ALIAS', 'default')]
+
+
+def generation():
+    cache = gig_cache()
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        # Seeded from the clock so an evicted generation never comes back.
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        value = cache.get(GENERATION_KEY)
+    return value
+
+
+def bump_generation():
+    cache = gig_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, int(time.time() * 1000), None)
+
+
+def invalidate_gigs():
+    """Drops every cached gig response once the current transaction commits."""
+    transaction.on_commit(bump_generation)
+
+
+def normalize_params(params, names=FEED_PARAMS):
+    """
+    The `names` query parameters with whitespace collapsed and search lowercased.
+    Views filter on these same values they are cached under, so two requests
+    sharing a key always share a response.
+    """
+    normalized = {}
+    for name, default in names.items():
+        value = params.get(name, default)
+        if isinstance(value, str):
+            value = ' '.join(value.split())
+            if name == 'search':
+                value = value.lower()
+        normalized[name] = value
+    return normalized
+
+
+def make_key(namespace, params, names=FEED_PARAMS):
+    normalized = normalize_params(params, names)
+    digest = hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+    return f"gigs:{namespace}:{generation()}:{digest}"
+
+
+def _count(key):
+    cache = gig_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_cached(key):
+    value = gig_cache().get(key)
+    _count(HITS_KEY if value is not None else MISSES_KEY)
+    return value
+
+
+def set_cached(key, value):
+    gig_cache().set(key, value, getattr(settings, 'GIG_CACHE_TIMEOUT', 300))
+
+
+def cache_stats():
+    cache = gig_cache()
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hitRate': round(hits / lookups, 4) if lookups else None,
+        'generation': generation(),
+    }
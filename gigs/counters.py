@@ -0,0 +1,102 @@
+import hashlib
+from decimal import Decimal
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, Sum
+from django.db.models.functions import Cast
+from .cache import generation, gig_cache
+from .models import Gig, GigListingCount, GigPriceBucketCount
+
+
+def price_step():
+    return Decimal(str(getattr(settings, 'GIG_FACET_PRICE_STEP', 50)))
+
+
+def price_bucket(price):
+    return int(Decimal(str(price)) // price_step())
+
+
+def _adjust(model, delta, **lookup):
+    if not delta:
+        return
+    updated = model.objects.filter(**lookup).update(listed=F('listed') + delta)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(listed=delta, **lookup)
+    except IntegrityError:
+        # Created concurrently between the update and the insert.
+        model.objects.filter(**lookup).update(listed=F('listed') + delta)
+
+
+def adjust_listing_count(category, delta):
+    _adjust(GigListingCount, delta, category=category)
+
+
+def adjust_price_bucket_count(category, bucket, delta):
+    _adjust(GigPriceBucketCount, delta, category=category, bucket=bucket)
+
+
+def _counted_under(state):
+    # (category, price bucket) a gig in this listing state is counted under.
+    if not state or not state[1]:
+        return None
+    return state[0], price_bucket(state[2])
+
+
+def record_listing_change(old_state, new_state):
+    """Applies one gig's move between (category, listed, price) states to the counters."""
+    old_key, new_key = _counted_under(old_state), _counted_under(new_state)
+    if old_key == new_key:
+        return
+    old_category = old_key[0] if old_key else None
+    new_category = new_key[0] if new_key else None
+    if old_category != new_category:
+        if old_key:
+            adjust_listing_count(old_category, -1)
+        if new_key:
+            adjust_listing_count(new_category, 1)
+    if old_key:
+        adjust_price_bucket_count(*old_key, -1)
+    if new_key:
+        adjust_price_bucket_count(*new_key, 1)
+
+
+def rebuild_listing_counts():
+    listed = Gig.objects.filter(is_unlisted=False)
+    rows = listed.values('category').annotate(listed=Count('id'))
+    buckets = listed.annotate(
+        bucket=Cast(F('price') / price_step(), IntegerField())
+    ).values('category', 'bucket').annotate(listed=Count('id'))
+    with transaction.atomic():
+        GigListingCount.objects.all().delete()
+        GigListingCount.objects.bulk_create(
+            GigListingCount(category=row['category'], listed=row['listed']) for row in rows
+        )
+        GigPriceBucketCount.objects.all().delete()
+        GigPriceBucketCount.objects.bulk_create(
+            GigPriceBucketCount(category=row['category'], bucket=row['bucket'], listed=row['listed'])
+            for row in buckets
+        )
+
+
+def listed_count(category=None):
+    """Number of listed gigs, optionally in one category, read from the counter table."""
+    if category is not None:
+        return GigListingCount.objects.filter(category=category).values_list('listed', flat=True).first() or 0
+    return GigListingCount.objects.aggregate(total=Sum('listed'))['total'] or 0
+
+
+def cached_count(queryset, filters):
+    """
+    Count for filter sets the counter table cannot answer (price ranges, search).
+    Cached per gig cache generation, so any gig write refreshes it.
+    """
+    digest = hashlib.sha1(repr(sorted(filters.items())).encode()).hexdigest()
+    key = f"gigs:count:{generation()}:{digest}"
+    total = gig_cache().get(key)
+    if total is None:
+        total = queryset.count()
+        gig_cache().set(key, total, getattr(settings, 'GIG_COUNT_CACHE_TIMEOUT', 60))
+    return total
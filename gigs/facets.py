@@ -0,0 +1,102 @@
+from collections import defaultdict
+from decimal import ROUND_CEILING, Decimal, InvalidOperation
+from django.conf import settings
+from django.db.models import Count, F, IntegerField, Sum
+from django.db.models.functions import Cast
+from .counters import price_step
+from .models import Gig, GigListingCount, GigPriceBucketCount
+
+# Query parameters that change the facets response, with their defaults.
+FACET_PARAMS = {
+    'category': '',
+    'minPrice': '',
+    'maxPrice': '',
+    'search': '',
+    'near': '',
+    'radius': '',
+    'priceBucket': '',
+}
+
+
+def bucket_width(value):
+    step = price_step()
+    try:
+        width = Decimal(value) if value else Decimal(str(getattr(settings, 'GIG_FACET_PRICE_BUCKET', 500)))
+    except InvalidOperation:
+        raise ValueError('priceBucket must be a number.')
+    if width <= 0 or width % step:
+        raise ValueError(f'priceBucket must be a positive multiple of {step}.')
+    return width
+
+
+def _ceil_bucket(price):
+    return int((price / price_step()).to_integral_value(rounding=ROUND_CEILING))
+
+
+def _category_counts_in_range(low, high):
+    """
+    Whole price buckets inside [low, high] come from GigPriceBucketCount; only
+    the gigs in the partial buckets at either end are counted from the gigs
+    table, over the listed price index. One statement for all three parts.
+    """
+    step = price_step()
+    low = Decimal(str(low)) if low else None
+    high = Decimal(str(high)) if high else None
+    listed = Gig.objects.filter(is_unlisted=False).order_by()
+
+    if low is not None and high is not None and _ceil_bucket(low) >= high // step:
+        # Narrower than one bucket.
+        parts = [listed.filter(price__gte=low, price__lte=high)]
+        buckets = None
+    else:
+        parts = []
+        buckets = GigPriceBucketCount.objects.order_by()
+        if low is not None:
+            first = _ceil_bucket(low)
+            buckets = buckets.filter(bucket__gte=first)
+            parts.append(listed.filter(price__gte=low, price__lt=first * step))
+        if high is not None:
+            end = int(high // step)
+            buckets = buckets.filter(bucket__lt=end)
+            parts.append(listed.filter(price__gte=end * step, price__lte=high))
+
+    parts = [part.values('category').annotate(listed=Count('id')).values_list('category', 'listed') for part in parts]
+    if buckets is not None:
+        parts.append(buckets.values('category').annotate(total=Sum('listed')).values_list('category', 'total'))
+    return parts[0].union(*parts[1:], all=True)
+
+
+def category_counts(queryset, filter_kwargs):
+    filters = set(filter_kwargs) - {'is_unlisted'}
+    if not filters:
+        rows = GigListingCount.objects.values_list('category', 'listed')
+    elif filters <= {'price__gte', 'price__lte'}:
+        rows = _category_counts_in_range(filter_kwargs.get('price__gte'), filter_kwargs.get('price__lte'))
+    else:
+        rows = queryset.order_by().values('category').annotate(listed=Count('id')).values_list('category', 'listed')
+
+    totals = defaultdict(int)
+    for category, listed in rows:
+        totals[category] += listed
+    counts = [{'category': category, 'count': count} for category, count in totals.items() if count > 0]
+    return sorted(counts, key=lambda entry: (-entry['count'], entry['category']))
+
+
+def price_histogram(queryset, filter_kwargs, width):
+    """Listed gigs per `width`-wide price bucket, lowest first, empty buckets left out."""
+    if set(filter_kwargs) <= {'is_unlisted', 'category'}:
+        rows = GigPriceBucketCount.objects.order_by()
+        if 'category' in filter_kwargs:
+            rows = rows.filter(category=filter_kwargs['category'])
+        rows = rows.annotate(
+            slot=F('bucket') / int(width / price_step())
+        ).values('slot').annotate(count=Sum('listed')).values_list('slot', 'count')
+    else:
+        rows = queryset.order_by().annotate(
+            slot=Cast(F('price') / width, IntegerField())
+        ).values('slot').annotate(count=Count('id')).values_list('slot', 'count')
+
+    return [
+        {'min': float(slot * width), 'max': float((slot + 1) * width), 'count': count}
+        for slot, count in sorted(rows) if count > 0
+    ]
@@ -0,0 +1,134 @@
+import math
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+GEOHASH_PRECISION = 9
+MAX_CELLS = 16
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lng_range[0] = mid
+            else:
+                bits <<= 1
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    """(height, width) of a geohash cell in degrees."""
+    lng_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def bounding_box(latitude, longitude, radius_km):
+    lat_delta = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(latitude))
+    lng_delta = 360.0 if cos_lat < 1e-9 else radius_km / (KM_PER_DEGREE * cos_lat)
+    return (
+        max(-90.0, latitude - lat_delta), min(90.0, latitude + lat_delta),
+        longitude - lng_delta, longitude + lng_delta,
+    )
+
+
+def _wrap_longitude(longitude):
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """
+    Geohash prefixes whose cells cover the circle, at the finest precision that
+    needs at most MAX_CELLS of them. Returns None when the circle is too large
+    to prune usefully.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounding_box(latitude, longitude, radius_km)
+    if max_lng - min_lng >= 360.0:
+        return None
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = math.floor(max_lat / height) - math.floor(min_lat / height) + 1
+        columns = math.floor(max_lng / width) - math.floor(min_lng / width) + 1
+        if rows * columns > MAX_CELLS:
+            continue
+
+        cells = set()
+        for row in range(rows):
+            lat = min(max_lat, (math.floor(min_lat / height) + row + 0.5) * height)
+            for column in range(columns):
+                lng = (math.floor(min_lng / width) + column + 0.5) * width
+                cells.add(encode(max(-90.0, lat), _wrap_longitude(lng), precision))
+        return sorted(cells)
+    return None
+
+
+def within_cells(cells, field='geohash'):
+    # Prefix ranges rather than startswith, so SQLite can walk the index ('{'
+    # sorts right after 'z', the last geohash character).
+    condition = Q()
+    for cell in cells:
+        condition |= Q(**{f'{field}__gte': cell, f'{field}__lt': cell + '{'})
+    return condition
+
+
+def distance_km(latitude, longitude, lat_field='latitude', lng_field='longitude'):
+    """Haversine distance from a point to each row, as a query expression."""
+    lat = Radians(lat_field)
+    d_lat = Radians(lat_field) - math.radians(latitude)
+    d_lng = Radians(lng_field) - math.radians(longitude)
+    a = (
+        Power(Sin(d_lat / 2), 2)
+        + Value(math.cos(math.radians(latitude))) * Cos(lat) * Power(Sin(d_lng / 2), 2)
+    )
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(a), output_field=FloatField())
+
+
+def parse_coordinates(latitude, longitude):
+    latitude, longitude = float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Coordinates out of range.')
+    return latitude, longitude
+
+
+def parse_point(value):
+    """Parses the `near=lat,lng` query parameter."""
+    parts = value.split(',')
+    if len(parts) != 2:
+        raise ValueError('near must be given as lat,lng.')
+    return parse_coordinates(*parts)
+
+
+def parse_radius(value, default, maximum):
+    """Parses the `radius` query parameter in km, capped at `maximum`."""
+    radius = float(value) if value else float(default)
+    if not math.isfinite(radius) or radius <= 0:
+        raise ValueError('radius must be a positive number of kilometres.')
+    return min(radius, maximum)
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+from .cache import invalidate_gigs
+from .models import GigImage
+from .storage import acquire_blob, delete_unreferenced, is_blob, write_blob
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'webp': ('WEBP', 'GIG_IMAGE_WEBP_QUALITY', 80),
+    'jpeg': ('JPEG', 'GIG_IMAGE_JPEG_QUALITY', 85),
+}
+
+_executor = None
+_upload_executor = None
+_executor_lock = threading.Lock()
+
+
+def variant_sizes():
+    return getattr(settings, 'GIG_IMAGE_VARIANTS', {'thumbnail': 320, 'medium': 1280})
+
+
+def _encode(image, image_format, quality):
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _flatten(image):
+    # JPEG has no alpha channel; composite transparent uploads onto white.
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def variant_digest(max_edge, image_format, quality):
+    """Short hash of everything that decides a variant's bytes, part of its name."""
+    version = getattr(settings, 'GIG_IMAGE_VARIANT_VERSION', 1)
+    return hashlib.sha1(f"{version}:{max_edge}:{image_format}:{quality}".encode()).hexdigest()[:8]
+
+
+def build_variants(name):
+    """
+    Writes every size/format variant of the stored image `name` under
+    derivatives/ and returns the dict kept in GigImage.variants. The original
+    file is only read. Variants of a blob are named after its hash and the
+    settings that produced them, so they are served as immutable: ones already
+    written for the same bytes and settings are reused, never rewritten, and
+    new settings give new names.
+    """
+    with default_storage.open(name, 'rb') as original:
+        source = Image.open(original)
+        source.load()
+    source = _flatten(ImageOps.exif_transpose(source))
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    variants = {}
+    for variant, max_edge in variant_sizes().items():
+        resized = source.copy()
+        resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        entry = {'width': resized.width, 'height': resized.height}
+        for extension, (image_format, quality_setting, default_quality) in FORMATS.items():
+            quality = getattr(settings, quality_setting, default_quality)
+            digest = variant_digest(max_edge, image_format, quality)
+            path = os.path.join('derivatives', f"{stem}_{variant}_{digest}.{extension}")
+            if is_blob(name) and default_storage.exists(path):
+                entry[extension] = path
+                continue
+            saved = default_storage.save(path, ContentFile(_encode(resized, image_format, quality)))
+            if is_blob(name) and saved != path:
+                # Built concurrently for the same blob; keep the hash-named copy.
+                default_storage.delete(saved)
+                saved = path
+            entry[extension] = saved
+        variants[variant] = entry
+    return variants
+
+
+def variant_names(variants):
+    names = []
+    for entry in (variants or {}).values():
+        names.extend(entry[extension] for extension in FORMATS if extension in entry)
+    return names
+
+
+def _release_stale_variants(name, old_variants, variants):
+    """Deletes variants `name` no longer uses once no other gig image points at them."""
+    stale = set(variant_names(old_variants)) - set(variant_names(variants))
+    for other in GigImage.objects.filter(image=name).values_list('variants', flat=True):
+        stale -= set(variant_names(other))
+    for path in stale:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+
+
+def generate_derivatives(image_ids, rebuild=False):
+    close_old_connections()
+    try:
+        for gig_image in GigImage.objects.filter(id__in=image_ids):
+            name = gig_image.image.name
+            # Another gig already uses these bytes; share its variants. A
+            # rebuild builds from the current settings instead.
+            variants = None if rebuild else (
+                GigImage.objects.filter(image=name).exclude(variants={})
+                .values_list('variants', flat=True).first()
+            )
+            if not variants:
+                try:
+                    variants = build_variants(name)
+                except FileNotFoundError:
+                    # Replaced or deleted since it was scheduled.
+                    continue
+                except Exception:
+                    logger.exception("Could not build variants for gig image %s", gig_image.id)
+                    continue
+            if not GigImage.objects.filter(id=gig_image.id).update(variants=variants):
+                delete_unreferenced(name, variant_names(variants))
+            elif rebuild:
+                _release_stale_variants(name, gig_image.variants, variants)
+        invalidate_gigs()
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'GIG_IMAGE_WORKERS', 2),
+                thread_name_prefix='gig-images'
+            )
+        return _executor
+
+
+def _get_upload_executor():
+    global _upload_executor
+    with _executor_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'GIG_UPLOAD_WORKERS', 4),
+                thread_name_prefix='gig-uploads'
+            )
+        return _upload_executor
+
+
+def write_uploads(uploads):
+    """
+    Writes the uploaded files to blob storage concurrently and returns their
+    (sha256, name) pairs in upload order. If any write fails, the blobs nothing
+    references yet are removed again.
+    """
+    futures = [_get_upload_executor().submit(write_blob, upload) for upload in uploads]
+    stored = []
+    error = None
+    for future in futures:
+        try:
+            stored.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error:
+        for sha256, name in stored:
+            delete_unreferenced(name)
+        raise error
+    return stored
+
+
+def discard_uploads(stored):
+    """Removes blobs from write_uploads() whose rows were never committed."""
+    for sha256, name in stored:
+        delete_unreferenced(name)
+
+
+def attach_images(gig, stored, uploads):
+    """
+    Adds the blobs written by write_uploads() to `gig` with one INSERT for all
+    rows, taking a blob reference for each. Write the files before and call
+    this inside the transaction that creates or updates the gig, so no storage
+    I/O holds it open; variants are scheduled for after it commits.
+    """
+    names = [acquire_blob(sha256, name, upload) for (sha256, name), upload in zip(stored, uploads)]
+    gig_images = GigImage.objects.bulk_create(GigImage(gig=gig, image=name) for name in names)
+    schedule_derivatives(gig_image.id for gig_image in gig_images)
+    return gig_images
+
+
+def schedule_derivatives(image_ids):
+    """Builds the variants off the request path once the images are committed."""
+    image_ids = list(image_ids)
+    if image_ids:
+        transaction.on_commit(lambda: _get_executor().submit(generate_derivatives, image_ids))
+
+
+def image_urls(name, variants, variant):
+    original = default_storage.url(name)
+    entry = (variants or {}).get(variant)
+    if not entry:
+        # Still being generated, or the upload could not be decoded.
+        return {'webp': original, 'jpeg': original, 'original': original}
+    return {
+        'webp': default_storage.url(entry['webp']),
+        'jpeg': default_storage.url(entry['jpeg']),
+        'original': original,
+    }
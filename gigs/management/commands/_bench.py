@@ -0,0 +1,76 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+from django.db import transaction
+from accounts.models import User
+from gigs.models import Gig
+
+CATEGORIES = ['Design', 'Writing', 'Tutoring', 'Photography', 'Repairs', 'Cleaning', 'Music', 'Development']
+CITIES = ['Lahore', 'Karachi', 'Islamabad', 'Peshawar', 'Multan', 'Quetta', 'Faisalabad', 'Sialkot']
+WORDS = (
+    'logo brand poster flyer website app android ios python django essay resume cover letter '
+    'math physics chemistry biology english urdu arabic french guitar piano violin vocals drums '
+    'wedding portrait product event drone studio plumbing wiring painting carpentry tiling roofing '
+    'deep clean sofa carpet kitchen garden lawn moving delivery courier translation editing '
+    'proofreading animation video voiceover illustration seo marketing copywriting branding '
+    'bookkeeping taxes accounting excel spreadsheet database server hosting wordpress shopify '
+    'laptop phone screen battery repair install setup network printer camera lighting makeup '
+    'henna bridal tailoring stitching embroidery catering baking cake biryani tutoring coaching '
+    'fitness yoga trainer nutrition diet interior decor furniture assembly welding mechanic car '
+    'bike ac fridge washing machine generator solar inverter calligraphy sketch mural tattoo'
+).split()
+
+
+class Rollback(Exception):
+    pass
+
+
+class rolled_back(transaction.Atomic):
+    """Runs a benchmark inside a transaction that is always rolled back."""
+
+    def __init__(self):
+        super().__init__(using=None, savepoint=True, durable=False)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            exc_type, exc_value = Rollback, Rollback()
+        super().__exit__(exc_type, exc_value, traceback)
+        return exc_type is Rollback
+
+
+def bench_user():
+    return User.objects.create_user(phone_number=f'bench-{random.randint(0, 10 ** 9)}', password=None, name='Bench')
+
+
+def make_gigs(creator, count, rng, batch_size=5000, **fields):
+    created = []
+    for start in range(0, count, batch_size):
+        batch = []
+        for _ in range(min(batch_size, count - start)):
+            words = rng.sample(WORDS, 8)
+            gig_fields = {
+                'title': ' '.join(words[:3]).title(),
+                'description': ' '.join(words),
+                'price': Decimal(rng.randint(5, 2000)),
+                'category': rng.choice(CATEGORIES),
+                'location': rng.choice(CITIES),
+                'creator': creator,
+            }
+            gig_fields.update({key: value(rng) if callable(value) else value for key, value in fields.items()})
+            batch.append(Gig(**gig_fields))
+        created.extend(Gig.objects.bulk_create(batch))
+    return created
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'median': statistics.median(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
@@ -0,0 +1,55 @@
+import random
+from django.core.management.base import BaseCommand
+from gigs.counters import rebuild_listing_counts
+from gigs.facets import bucket_width, category_counts, price_histogram
+from gigs.models import Gig
+from gigs.search import get_search_backend
+from gigs.views import filter_gigs
+from ._bench import bench_user, make_gigs, rolled_back, timed
+
+FILTERS = {
+    'none': {},
+    'category': {'category': 'Design'},
+    'price range': {'minPrice': '120', 'maxPrice': '870'},
+    'category + price': {'category': 'Music', 'minPrice': '300'},
+    'search': {'search': 'logo'},
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures facet latency (category counts and price histogram) without the response cache. All rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=500000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def facets(self, params, width):
+        category_queryset, category_filters = filter_gigs(
+            {key: value for key, value in params.items() if key != 'category'}
+        )
+        price_queryset, price_filters = filter_gigs(
+            {key: value for key, value in params.items() if key not in ('minPrice', 'maxPrice')}
+        )
+        return (
+            category_counts(category_queryset, category_filters),
+            price_histogram(price_queryset, price_filters, width),
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(11)
+        width = bucket_width(None)
+
+        with rolled_back():
+            self.stdout.write(f"inserting {options['size']} gigs...")
+            make_gigs(bench_user(), options['size'], rng)
+            rebuild_listing_counts()
+            get_search_backend().rebuild(Gig.objects.all())
+
+            self.stdout.write(f"{'filters':>18} {'categories':>10} {'buckets':>8} {'p50 ms':>8} {'p95 ms':>8}")
+            for name, params in FILTERS.items():
+                categories, buckets = self.facets(params, width)
+                timing = timed(lambda: self.facets(params, width), options['repeat'])
+                self.stdout.write(
+                    f"{name:>18} {len(categories):>10} {len(buckets):>8} "
+                    f"{timing['median']:>8.2f} {timing['p95']:>8.2f}"
+                )
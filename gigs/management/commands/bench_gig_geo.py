@@ -0,0 +1,74 @@
+import random
+from django.core.management.base import BaseCommand
+from gigs import geo
+from gigs.models import Gig
+from ._bench import bench_user, make_gigs, rolled_back, timed
+
+# Gigs are scattered over Pakistan; queries are centred on its large cities.
+BOUNDS = (24.0, 37.0, 61.0, 77.0)
+CENTRES = {
+    'Lahore': (31.5204, 74.3587),
+    'Karachi': (24.8607, 67.0011),
+    'Islamabad': (33.6844, 73.0479),
+    'Quetta': (30.1798, 66.9750),
+}
+
+
+class Command(BaseCommand):
+    help = 'Measures radius search latency over the geohash index. All rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000000)
+        parser.add_argument('--radii', type=float, nargs='+', default=[1, 5, 25, 100])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--skip-baseline', action='store_true', help='Do not time the unpruned distance scan.')
+
+    def point(self, rng):
+        return rng.uniform(BOUNDS[0], BOUNDS[1]), rng.uniform(BOUNDS[2], BOUNDS[3])
+
+    def nearest(self, latitude, longitude, radius, limit, prune=True):
+        queryset = Gig.objects.filter(is_unlisted=False)
+        cells = geo.covering_cells(latitude, longitude, radius) if prune else None
+        if cells:
+            queryset = queryset.filter(geo.within_cells(cells))
+        queryset = queryset.annotate(
+            distance=geo.distance_km(latitude, longitude)
+        ).filter(distance__lte=radius).order_by('distance', 'id')
+        return list(queryset.values_list('id', 'distance')[:limit])
+
+    def handle(self, *args, **options):
+        rng = random.Random(7)
+        limit = options['limit']
+
+        with rolled_back():
+            creator = bench_user()
+            points = {}
+
+            def located(gig_rng):
+                points['last'] = self.point(gig_rng)
+                return points['last'][0]
+
+            self.stdout.write(f"inserting {options['size']} gigs...")
+            make_gigs(
+                creator, options['size'], rng,
+                latitude=located,
+                longitude=lambda gig_rng: points['last'][1],
+                geohash=lambda gig_rng: geo.encode(*points['last']),
+            )
+
+            self.stdout.write(f"{'centre':>10} {'radius km':>10} {'cells':>6} {'found':>6} {'p50 ms':>8} {'p95 ms':>8} {'scan p50 ms':>12}")
+            for name, (latitude, longitude) in CENTRES.items():
+                for radius in options['radii']:
+                    cells = geo.covering_cells(latitude, longitude, radius) or []
+                    found = len(self.nearest(latitude, longitude, radius, limit))
+                    pruned = timed(lambda: self.nearest(latitude, longitude, radius, limit), options['repeat'])
+                    if options['skip_baseline']:
+                        scanned = '-'
+                    else:
+                        scanned = timed(lambda: self.nearest(latitude, longitude, radius, limit, prune=False), 1)
+                        scanned = f"{scanned['median']:.1f}"
+                    self.stdout.write(
+                        f"{name:>10} {radius:>10g} {len(cells):>6} {found:>6} "
+                        f"{pruned['median']:>8.2f} {pruned['p95']:>8.2f} {scanned:>12}"
+                    )
@@ -0,0 +1,51 @@
+import random
+from django.core.management.base import BaseCommand
+from gigs.models import Gig
+from gigs.search import BasicSearchBackend, get_search_backend
+from ._bench import bench_user, make_gigs, rolled_back, timed
+
+QUERIES = ['logo', 'desi', 'python tutor', 'wedding portrait', 'plumb lahore', 'essay editing']
+
+
+class Command(BaseCommand):
+    help = 'Measures gig search latency as the gig table grows. All rows are rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000, 300000])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--skip-baseline', action='store_true', help='Do not time the icontains baseline.')
+
+    def first_page(self, backend, queryset, query, limit):
+        # Same work as get_gigs: one page plus the total.
+        results = backend.search(queryset, query)
+        return list(results[:limit]), results.count()
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        backend = get_search_backend()
+        baseline = BasicSearchBackend()
+        limit = options['limit']
+
+        self.stdout.write(f"backend: {type(backend).__name__}, page size {limit}, {options['repeat']} runs per query")
+        self.stdout.write(f"{'gigs':>10} {'query':>18} {'index p50 ms':>13} {'index p95 ms':>13} {'icontains p50 ms':>17}")
+
+        with rolled_back():
+            creator = bench_user()
+            size = 0
+            for target in sorted(options['sizes']):
+                gigs = make_gigs(creator, target - size, rng)
+                backend.index_many(gigs)
+                size = target
+
+                listed = Gig.objects.filter(is_unlisted=False)
+                for query in QUERIES:
+                    indexed = timed(lambda: self.first_page(backend, listed, query, limit), options['repeat'])
+                    if options['skip_baseline']:
+                        scanned = '-'
+                    else:
+                        scanned = timed(lambda: self.first_page(baseline, listed, query, limit), 3)
+                        scanned = f"{scanned['median']:.2f}"
+                    self.stdout.write(
+                        f"{size:>10} {query:>18} {indexed['median']:>13.2f} {indexed['p95']:>13.2f} {scanned:>17}"
+                    )
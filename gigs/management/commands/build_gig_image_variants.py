@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from gigs.images import generate_derivatives
+from gigs.models import GigImage
+
+
+class Command(BaseCommand):
+    help = 'Builds thumbnail and medium variants for gig images that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild variants for every image.')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        images = GigImage.objects.order_by('id')
+        if not options['all']:
+            images = images.filter(variants={})
+
+        image_ids = list(images.values_list('id', flat=True))
+        for start in range(0, len(image_ids), options['batch_size']):
+            generate_derivatives(image_ids[start:start + options['batch_size']], rebuild=options['all'])
+        self.stdout.write(self.style.SUCCESS(f"Built variants for {len(image_ids)} images."))
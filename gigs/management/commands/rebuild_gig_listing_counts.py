@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from gigs.counters import rebuild_listing_counts
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-category and per-price-bucket listing counters from the gig table.'
+
+    def handle(self, *args, **options):
+        rebuild_listing_counts()
+        self.stdout.write(self.style.SUCCESS('Gig listing counts rebuilt.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from gigs.models import Gig
+from gigs.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the gig search index from the gig table.'
+
+    def handle(self, *args, **options):
+        get_search_backend().rebuild(Gig.objects.all())
+        self.stdout.write(self.style.SUCCESS('Gig search index rebuilt.'))
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:53
+
+import django.db.models.deletion
+import gigs.search
+from django.db import migrations, models
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS gigs_gig_fts USING fts5("
+        "title, description, category, location, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    # Title matches count the most, then description, then category and location.
+    schema_editor.execute(
+        "INSERT INTO gigs_gig_fts (gigs_gig_fts, rank) VALUES ('rank', 'bm25(10.0, 4.0, 2.0, 2.0)')"
+    )
+    schema_editor.execute(
+        "INSERT INTO gigs_gig_fts (rowid, title, description, category, location) "
+        "SELECT id, title, description, category, location FROM gigs_gig WHERE NOT is_unlisted"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    schema_editor.execute("DROP TABLE IF EXISTS gigs_gig_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.CreateModel(
+            name='GigSearchEntry',
+            fields=[
+                ('gig', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_entry', serialize=False, to='gigs.gig')),
+                ('document', gigs.search.SearchDocumentField(db_column='gigs_gig_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'gigs_gig_fts',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:57
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_listing_counts(apps, schema_editor):
+    Gig = apps.get_model('gigs', 'Gig')
+    GigListingCount = apps.get_model('gigs', 'GigListingCount')
+    rows = Gig.objects.filter(is_unlisted=False).values('category').annotate(listed=Count('id'))
+    GigListingCount.objects.bulk_create(
+        GigListingCount(category=row['category'], listed=row['listed']) for row in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0002_gig_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GigListingCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=100, unique=True)),
+                ('listed', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_listing_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(fields=['is_unlisted', '-created_at', '-id'], name='gigs_listed_newest_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0003_gig_listing_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='gig',
+            name='gigs_listed_newest_idx',
+        ),
+        migrations.AddField(
+            model_name='gig',
+            name='geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='gig',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gig',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(condition=models.Q(('is_unlisted', False)), fields=['-created_at', '-id'], name='gigs_listed_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(fields=['geohash'], name='gigs_geohash_idx'),
+        ),
+    ]
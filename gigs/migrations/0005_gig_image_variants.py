@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0004_gig_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gigimage',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
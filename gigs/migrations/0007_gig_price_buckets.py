@@ -0,0 +1,48 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:18
+
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField
+from django.db.models.functions import Cast
+
+
+def backfill_price_buckets(apps, schema_editor):
+    Gig = apps.get_model('gigs', 'Gig')
+    GigPriceBucketCount = apps.get_model('gigs', 'GigPriceBucketCount')
+    step = Decimal(str(getattr(settings, 'GIG_FACET_PRICE_STEP', 50)))
+    rows = Gig.objects.filter(is_unlisted=False).annotate(
+        bucket=Cast(F('price') / step, IntegerField())
+    ).values('category', 'bucket').annotate(listed=Count('id'))
+    GigPriceBucketCount.objects.bulk_create(
+        GigPriceBucketCount(category=row['category'], bucket=row['bucket'], listed=row['listed']) for row in rows
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0006_blobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GigPriceBucketCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=100)),
+                ('bucket', models.IntegerField()),
+                ('listed', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(condition=models.Q(('is_unlisted', False)), fields=['price', 'category'], name='gigs_listed_price_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='gigpricebucketcount',
+            constraint=models.UniqueConstraint(fields=('category', 'bucket'), name='gigs_price_bucket_unique'),
+        ),
+        migrations.RunPython(backfill_price_buckets, migrations.RunPython.noop),
+    ]
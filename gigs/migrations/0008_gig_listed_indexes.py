@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gigs', '0007_gig_price_buckets'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(condition=models.Q(('is_unlisted', False)), fields=['category', '-created_at', '-id'], name='gigs_listed_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(condition=models.Q(('is_unlisted', False)), fields=['category', 'price'], name='gigs_listed_cat_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gig',
+            index=models.Index(condition=models.Q(('is_unlisted', False)), fields=['creator'], name='gigs_listed_creator_idx'),
+        ),
+    ]
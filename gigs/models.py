@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth import get_user_model
+from . import geo
+from .search import SearchDocumentField
 
 User = get_user_model()
 
@@ -15,6 +17,64 @@ class Gig(models.Model):
     creator = models.ForeignKey(User, related_name='gigs', on_delete=models.CASCADE)
     number_of_raters = models.IntegerField(default=0)
     is_unlisted = models.BooleanField(default=False)
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
+    geohash = models.CharField(max_length=12, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Partial indexes over listed gigs: Django renders is_unlisted=False as
+            # NOT is_unlisted, which SQLite cannot use as a leading index column.
+            # Keyset pages of the feed, newest first.
+            models.Index(
+                fields=['-created_at', '-id'], name='gigs_listed_newest_idx',
+                condition=models.Q(is_unlisted=False)
+            ),
+            # Category pages of the feed, newest first.
+            models.Index(
+                fields=['category', '-created_at', '-id'], name='gigs_listed_category_idx',
+                condition=models.Q(is_unlisted=False)
+            ),
+            # Category plus price range (feed counts, facets).
+            models.Index(
+                fields=['category', 'price'], name='gigs_listed_cat_price_idx',
+                condition=models.Q(is_unlisted=False)
+            ),
+            # A seller's own listed gigs (accounts.views.get_my_info); unlisted
+            # gigs are kept, so the creator FK index alone reads them too.
+            models.Index(
+                fields=['creator'], name='gigs_listed_creator_idx',
+                condition=models.Q(is_unlisted=False)
+            ),
+            # Radius search prunes by geohash cell before measuring distances. Not
+            # partial: SQLite's multi-index OR over the cell ranges skips those.
+            models.Index(fields=['geohash'], name='gigs_geohash_idx'),
+            # Price ranges; covers the category counts of partial facet buckets.
+            models.Index(
+                fields=['price', 'category'], name='gigs_listed_price_idx',
+                condition=models.Q(is_unlisted=False)
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = geo.encode(self.latitude, self.longitude)
+        else:
+            self.geohash = ''
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._listing_state = instance.listing_state()
+        return instance
+
+    def listing_state(self):
+        # (category, listed, price) as last read from or written to the database;
+        # the signals compare it on save to keep the counter tables incremental.
+        if self.get_deferred_fields() & {'category', 'is_unlisted', 'price'}:
+            return None
+        return (self.category, not self.is_unlisted, self.price)
     
     def __str__(self):
         return self.title
@@ -23,6 +83,60 @@ class Gig(models.Model):
 class GigImage(models.Model):
     gig = models.ForeignKey(Gig, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='uploads/')
+    # {'thumbnail': {'webp': name, 'jpeg': name, 'width': w, 'height': h}, 'medium': {...}},
+    # filled in by gigs.images after upload; empty until then.
+    variants = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"Image for {self.gig.title}"
+
+
+class GigListingCount(models.Model):
+    category = models.CharField(max_length=100, unique=True)
+    listed = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.category}: {self.listed}"
+
+
+class GigPriceBucketCount(models.Model):
+    # Listed gigs per category and GIG_FACET_PRICE_STEP-wide price bucket, so
+    # the price histogram never scans the gigs table.
+    category = models.CharField(max_length=100)
+    bucket = models.IntegerField()
+    listed = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'bucket'], name='gigs_price_bucket_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.category} #{self.bucket}: {self.listed}"
+
+
+class GigSearchEntry(models.Model):
+    # Row of the FTS5 table created by migration 0002, written only by gigs.search.
+    gig = models.OneToOneField(
+        Gig, primary_key=True, db_column='rowid', db_constraint=False,
+        related_name='search_entry', on_delete=models.DO_NOTHING
+    )
+    document = SearchDocumentField(db_column='gigs_gig_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'gigs_gig_fts'
+
+
+class Blob(models.Model):
+    # Content-addressed file shared by every GigImage.image and Review.payment_proof
+    # holding the same bytes; written and reclaimed only through gigs.storage.
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} references)"
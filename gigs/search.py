@@ -0,0 +1,168 @@
+import re
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, F, FloatField, Lookup, Q, Subquery, TextField, Value, When
+from django.db.models.functions import Coalesce
+from django.utils.module_loading import import_string
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+SEARCH_FIELDS = ('title', 'description', 'category', 'location')
+
+
+class SearchDocumentField(TextField):
+    """The hidden FTS5 column named after its table, the left-hand side of MATCH."""
+
+
+@SearchDocumentField.register_lookup
+class Match(Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+def tokenize(query):
+    return TERM_RE.findall(query or '')[:16]
+
+
+class SearchBackend:
+    """
+    Interface every gig search backend implements.
+
+    `index` and `remove` are called from the Gig signals so the backend stays in
+    sync with create/update/unlist; `search` narrows and orders a Gig queryset.
+    """
+
+    def index(self, gig):
+        pass
+
+    def index_many(self, gigs):
+        for gig in gigs:
+            self.index(gig)
+
+    def remove(self, gig_id):
+        pass
+
+    def rebuild(self, queryset):
+        self.index_many(queryset.iterator())
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+
+class BasicSearchBackend(SearchBackend):
+    """
+    Database agnostic fallback: every term must appear in one of the text fields.
+    Unranked and scans the table, so only use it where FTS5 is not available.
+    """
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.none()
+
+        condition = Q()
+        for term in terms:
+            term_condition = Q()
+            for field in SEARCH_FIELDS:
+                term_condition |= Q(**{f'{field}__icontains': term})
+            condition &= term_condition
+
+        return queryset.filter(condition).order_by('-id')
+
+
+class SQLiteFTSSearchBackend(SearchBackend):
+    """
+    SQLite FTS5 index over the listed gigs. The virtual table is created by
+    migration 0002, keyed by the gig id (rowid) and mapped by GigSearchEntry.
+    """
+
+    table = 'gigs_gig_fts'
+
+    def __init__(self, max_candidates=None):
+        if max_candidates is None:
+            max_candidates = getattr(settings, 'GIG_SEARCH_MAX_CANDIDATES', 2000)
+        self.max_candidates = max_candidates
+
+    def _row(self, gig):
+        return (gig.id,) + tuple(getattr(gig, field) or '' for field in SEARCH_FIELDS)
+
+    def index(self, gig):
+        if gig.is_unlisted:
+            self.remove(gig.id)
+            return
+        self.index_many([gig])
+
+    def index_many(self, gigs):
+        rows = [self._row(gig) for gig in gigs if not gig.is_unlisted]
+        if not rows:
+            return
+        columns = ', '.join(SEARCH_FIELDS)
+        placeholders = ', '.join(['%s'] * (len(SEARCH_FIELDS) + 1))
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (rowid, {columns}) VALUES ({placeholders})",
+                rows
+            )
+
+    def remove(self, gig_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [gig_id])
+
+    def rebuild(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+        batch = []
+        for gig in queryset.filter(is_unlisted=False).iterator(chunk_size=2000):
+            batch.append(gig)
+            if len(batch) >= 2000:
+                self.index_many(batch)
+                batch = []
+        self.index_many(batch)
+
+    def match_expression(self, query):
+        # Every term is quoted so user input can never be parsed as FTS5 syntax,
+        # and suffixed with * for prefix matching ("desi" finds "designer").
+        return ' '.join(f'"{term}"*' for term in tokenize(query))
+
+    def search(self, queryset, query):
+        match = self.match_expression(query)
+        if not match:
+            return queryset.none()
+
+        # Joins the FTS table so SQLite drives the query from the index and only
+        # then looks up the matching gigs by primary key. The bm25 column weights
+        # behind `rank` are configured on the table by migration 0002.
+        queryset = queryset.filter(search_entry__document__match=match)
+        rank = F('search_entry__rank')
+
+        # bm25 has to be computed for every row it orders, so only the newest
+        # `max_candidates` matches are ranked. Older matches still come back,
+        # after every ranked one, newest first: bm25 is always negative in FTS5
+        # so 0 sorts last. The window is taken from `queryset`, which already
+        # carries the caller's filters, so filtered searches rank their own
+        # newest matches. Finding it is a short descending walk of the index.
+        if self.max_candidates:
+            window_start = queryset.order_by('-id').values('id')[self.max_candidates - 1:self.max_candidates]
+            rank = Case(
+                When(id__gte=Coalesce(Subquery(window_start), 0), then=rank),
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+
+        return queryset.annotate(search_rank=rank).order_by('search_rank', '-id')
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    backend_path = getattr(settings, 'GIG_SEARCH_BACKEND', None)
+    if not backend_path:
+        if connection.vendor == 'sqlite':
+            backend_path = 'gigs.search.SQLiteFTSSearchBackend'
+        else:
+            backend_path = 'gigs.search.BasicSearchBackend'
+    return import_string(backend_path)()
@@ -1,7 +1,34 @@
+from collections import defaultdict
 from rest_framework import serializers
-from .models import Gig
+from .images import image_urls
+from .models import Gig, GigImage
 
 class GigSerializer(serializers.ModelSerializer):
+    creator_name = serializers.CharField(source='creator.name', read_only=True)
+
     class Meta:
         model = Gig
         fields = '__all__'  
+
+
+def serialize_gigs(gigs, variant='thumbnail'):
+    """
+    Serializes gigs for every gig endpoint with one query for all of their images.
+    Load the gigs with select_related('creator') so creator_name is joined too.
+
+    `images` lists the WebP `variant` of each image (the original until it has
+    been generated) and `imageVariants` adds the JPEG fallback and the original.
+    """
+    gigs = list(gigs)
+    variants_by_gig = defaultdict(list)
+    images = GigImage.objects.filter(gig_id__in=[gig.id for gig in gigs]).order_by('id')
+    for gig_id, name, variants in images.values_list('gig_id', 'image', 'variants'):
+        variants_by_gig[gig_id].append(image_urls(name, variants, variant))
+
+    gigs_data = GigSerializer(gigs, many=True).data
+    for gig, gig_data in zip(gigs, gigs_data):
+        gig_data['images'] = [urls['webp'] for urls in variants_by_gig[gig.id]]
+        gig_data['imageVariants'] = variants_by_gig[gig.id]
+        if getattr(gig, 'distance', None) is not None:
+            gig_data['distance'] = round(gig.distance, 3)
+    return gigs_data
@@ -0,0 +1,71 @@
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from .cache import invalidate_gigs
+from .counters import record_listing_change
+from .images import variant_names
+from .models import Gig, GigImage
+from .search import get_search_backend
+from .storage import release_blob
+
+
+@receiver(post_save, sender=Gig)
+def sync_gig_search_index(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    get_search_backend().index(instance)
+
+
+@receiver(post_delete, sender=Gig)
+def remove_gig_from_search_index(sender, instance, **kwargs):
+    get_search_backend().remove(instance.id)
+
+
+def stored_listing_state(gig_id):
+    row = Gig.objects.filter(pk=gig_id).values_list('category', 'is_unlisted', 'price').first()
+    return (row[0], not row[1], row[2]) if row else None
+
+
+@receiver(pre_save, sender=Gig)
+@receiver(pre_delete, sender=Gig)
+def load_listing_state(sender, instance, raw=False, **kwargs):
+    # A partial or hand-built instance does not know what the counters hold
+    # for it; read the stored row once rather than recounting every gig.
+    if raw or instance.pk is None or getattr(instance, '_listing_state', None) is not None:
+        return
+    instance._listing_state = stored_listing_state(instance.pk)
+
+
+@receiver(post_save, sender=Gig)
+def update_listing_counts(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    new_state = instance.listing_state()
+    if new_state is None:
+        # Saved with deferred fields, which the write left as they were.
+        new_state = stored_listing_state(instance.pk)
+    old_state = None if created else getattr(instance, '_listing_state', None)
+    record_listing_change(old_state, new_state)
+    instance._listing_state = new_state
+
+
+@receiver(post_delete, sender=Gig)
+def remove_from_listing_counts(sender, instance, **kwargs):
+    record_listing_change(getattr(instance, '_listing_state', None), None)
+
+
+@receiver(post_save, sender=Gig)
+@receiver(post_delete, sender=Gig)
+@receiver(post_save, sender=GigImage)
+@receiver(post_delete, sender=GigImage)
+def invalidate_cached_gigs(sender, raw=False, **kwargs):
+    # Covers create_gig, update_gig, delete_gig and the rating update in
+    # reviews.views.create_review, which all save the gig.
+    if raw:
+        return
+    invalidate_gigs()
+
+
+@receiver(post_delete, sender=GigImage)
+def release_gig_image_blob(sender, instance, **kwargs):
+    release_blob(instance.image.name, variant_names(instance.variants))
@@ -0,0 +1,91 @@
+import hashlib
+import os
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import Blob
+
+BLOB_PREFIX = 'blobs'
+
+
+def content_hash(upload):
+    digest = hashlib.sha256()
+    for chunk in upload.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_name(sha256, filename):
+    extension = os.path.splitext(filename)[1].lower()[:10]
+    return f"{BLOB_PREFIX}/{sha256[:2]}/{sha256}{extension}"
+
+
+def is_blob(name):
+    return name.startswith(f"{BLOB_PREFIX}/")
+
+
+def write_blob(upload):
+    """
+    Hashes `upload` and writes it under its content hash unless identical
+    bytes are already stored. Touches no database rows, so it is safe to call
+    from worker threads; follow it with acquire_blob() in the request.
+    Returns (sha256, name).
+    """
+    sha256 = content_hash(upload)
+    name = blob_name(sha256, upload.name)
+    if not default_storage.exists(name):
+        saved = default_storage.save(name, upload)
+        if saved != name:
+            # Another request wrote the same bytes first.
+            default_storage.delete(saved)
+    return sha256, name
+
+
+def acquire_blob(sha256, name, upload):
+    """Takes one reference on the blob and returns the name to store on the row."""
+    if Blob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1):
+        return Blob.objects.values_list('name', flat=True).get(sha256=sha256)
+
+    if not default_storage.exists(name):
+        # Reclaimed between write_blob() and now.
+        write_blob(upload)
+    try:
+        with transaction.atomic():
+            Blob.objects.create(sha256=sha256, name=name, size=upload.size, ref_count=1)
+    except IntegrityError:
+        Blob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + 1)
+        name = Blob.objects.values_list('name', flat=True).get(sha256=sha256)
+    return name
+
+
+def store_blob(upload):
+    return acquire_blob(*write_blob(upload), upload)
+
+
+def delete_unreferenced(name, derived_names=()):
+    """Deletes `name` and its derived files unless a Blob row still owns it."""
+    if is_blob(name) and Blob.objects.filter(name=name).exists():
+        return
+    for path in [name, *derived_names]:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+
+
+def release_blob(name, derived_names=()):
+    """
+    Drops one reference to the stored file `name`. When it was the last one,
+    the file and `derived_names` (its variants) are deleted after commit.
+    Names from before content addressing have no Blob row and are deleted
+    straight away, as they always had a single owner.
+    """
+    if not name:
+        return
+
+    if is_blob(name):
+        Blob.objects.filter(name=name).update(ref_count=F('ref_count') - 1)
+        deleted, _ = Blob.objects.filter(name=name, ref_count__lte=0).delete()
+        if not deleted:
+            return
+
+    derived_names = list(derived_names)
+    transaction.on_commit(lambda: delete_unreferenced(name, derived_names))
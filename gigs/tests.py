@@ -1,3 +1,571 @@
-from django.test import TestCase
+import hashlib
+import re
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from accounts.models import User
+from .counters import rebuild_listing_counts
+from .facets import _category_counts_in_range
+from .images import generate_derivatives, variant_names, write_uploads
+from .models import Blob, Gig, GigImage, GigListingCount, GigPriceBucketCount
+from .pagination import keyset_filter
+from .search import SQLiteFTSSearchBackend
+from .storage import blob_name, write_blob
+from .views import filter_gigs, gig_ordering
 
-# Create your tests here.
+
+class GigTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(phone_number='+920000000001', password='secret', name='Seller')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_gig(self, images=2, **fields):
+        values = {
+            'title': 'Logo design',
+            'description': 'Custom logos for small businesses',
+            'price': 100,
+            'category': 'Design',
+            'location': 'Lahore',
+            'creator': self.user,
+        }
+        values.update(fields)
+        gig = Gig.objects.create(**values)
+        GigImage.objects.bulk_create(
+            GigImage(gig=gig, image=f'uploads/{gig.id}_{idx}.jpg') for idx in range(images)
+        )
+        return gig
+
+
+class GigQueryCountTests(GigTestCase):
+    """Pins the number of queries per gig endpoint so N+1 regressions fail."""
+
+    def setUp(self):
+        super().setUp()
+        self.gigs = [self.create_gig(title=f'Gig {idx}') for idx in range(10)]
+
+    def test_list_page(self):
+        # listing count, gigs with their creators, images
+        with self.assertNumQueries(3):
+            response = self.client.get('/gigs/', {'limit': 10})
+        gigs = response.json()['data']['gigs']
+        self.assertEqual(len(gigs), 10)
+        self.assertTrue(all(len(gig['images']) == 2 for gig in gigs))
+        self.assertEqual(gigs[0]['creator_name'], 'Seller')
+
+    def test_list_cursor(self):
+        with self.assertNumQueries(3):
+            response = self.client.get('/gigs/', {'limit': 5, 'cursor': ''})
+        data = response.json()['data']
+        self.assertEqual(len(data['gigs']), 5)
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/gigs/', {'limit': 5, 'cursor': data['nextCursor']})
+        self.assertEqual(len(response.json()['data']['gigs']), 5)
+
+    def test_list_search(self):
+        # cached total, gigs, images
+        with self.assertNumQueries(3):
+            response = self.client.get('/gigs/', {'search': 'logo'})
+        self.assertEqual(len(response.json()['data']['gigs']), 10)
+
+    def test_detail(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/gigs/{self.gigs[0].id}/')
+        self.assertEqual(len(response.json()['data']['images']), 2)
+
+    def test_batch(self):
+        self.gigs[3].is_unlisted = True
+        self.gigs[3].save()
+        ids = [self.gigs[5].id, 999999, self.gigs[3].id, self.gigs[0].id, self.gigs[5].id]
+
+        # gigs with their creators, images
+        with self.assertNumQueries(2):
+            response = self.client.get('/gigs/batch/', {'ids': ','.join(map(str, ids))})
+        data = response.json()['data']
+        self.assertEqual([gig['id'] for gig in data['gigs']], [self.gigs[5].id, self.gigs[0].id])
+        self.assertEqual(data['missing'], [999999])
+        self.assertEqual(data['unlisted'], [self.gigs[3].id])
+
+        detail = self.client.get(f'/gigs/{self.gigs[0].id}/').json()['data']
+        self.assertEqual(data['gigs'][1], detail)
+
+    def test_batch_limit(self):
+        ids = ','.join(str(idx) for idx in range(1, 202))
+        self.assertEqual(self.client.get('/gigs/batch/', {'ids': ids}).status_code, 400)
+        self.assertEqual(self.client.get('/gigs/batch/', {'ids': '1,x'}).status_code, 400)
+
+    def test_update_without_images(self):
+        # gig, savepoint, update, search index sync, release, images
+        with self.assertNumQueries(6):
+            response = self.client.put(f'/gigs/update/{self.gigs[0].id}/', {'title': 'Logo and brand design'})
+        data = response.json()['data']
+        self.assertEqual(data['title'], 'Logo and brand design')
+        self.assertEqual(len(data['images']), 2)
+
+
+class GigCursorTests(GigTestCase):
+    def walk(self, params, limit=3):
+        ids, cursor = [], ''
+        while cursor is not None:
+            data = self.client.get('/gigs/', {**params, 'limit': limit, 'cursor': cursor}).json()['data']
+            ids += [gig['id'] for gig in data['gigs']]
+            cursor = data['nextCursor']
+        return ids
+
+    def test_cursor_pages_match_offset_pages(self):
+        created_at = timezone.now()
+        for idx in range(8):
+            # Shared timestamps make the id tie-breaker carry the cursor.
+            self.create_gig(images=0, title=f'Logo {idx}', latitude=31.5 + idx / 100, longitude=74.3)
+        Gig.objects.update(created_at=created_at)
+
+        for params in ({}, {'search': 'logo'}, {'near': '31.5,74.3', 'radius': '50'}):
+            cache.clear()
+            offset = self.client.get('/gigs/', {**params, 'limit': 100}).json()['data']['gigs']
+            self.assertEqual(self.walk(params), [gig['id'] for gig in offset])
+            self.assertEqual(len(offset), 8)
+
+        self.assertEqual(self.client.get('/gigs/', {'cursor': 'bogus'}).status_code, 400)
+
+
+class GigRadiusTests(GigTestCase):
+    def setUp(self):
+        super().setUp()
+        # About 2 km and 30 km from the centre of Lahore.
+        self.close = self.create_gig(images=0, title='Close', latitude=31.535, longitude=74.36)
+        self.far = self.create_gig(images=0, title='Far', latitude=31.52, longitude=74.675)
+        self.create_gig(images=0, title='Nowhere')
+
+    def near(self, **params):
+        return self.client.get('/gigs/', {'near': '31.5204,74.3587', **params})
+
+    def test_radius_limits_and_orders_by_distance(self):
+        self.assertEqual([gig['id'] for gig in self.near(radius=10).json()['data']['gigs']], [self.close.id])
+        self.assertEqual([gig['id'] for gig in self.near(radius=50).json()['data']['gigs']], [self.close.id, self.far.id])
+        # Beyond GIG_NEAR_MAX_RADIUS_KM the radius is capped, not rejected.
+        self.assertEqual(self.near(radius=100000).json()['data']['total'], 2)
+
+    def test_invalid_radius(self):
+        for radius in ('0', '-5', 'nan', 'inf', 'far'):
+            self.assertEqual(self.near(radius=radius).status_code, 400, radius)
+        self.assertEqual(self.client.get('/gigs/', {'near': '31.5'}).status_code, 400)
+
+
+class GigListingCountTests(GigTestCase):
+    def counts(self):
+        return (
+            dict(GigListingCount.objects.exclude(listed=0).values_list('category', 'listed')),
+            sorted(GigPriceBucketCount.objects.exclude(listed=0).values_list('category', 'bucket', 'listed')),
+        )
+
+    def assertCountsCorrect(self):
+        counts = self.counts()
+        rebuild_listing_counts()
+        self.assertEqual(counts, self.counts())
+
+    def test_counters_follow_every_write(self):
+        gig = self.create_gig(images=0, category='Design', price=40)
+        other = self.create_gig(images=0, category='Music', price=120)
+        self.assertEqual(self.counts()[0], {'Design': 1, 'Music': 1})
+
+        gig.category, gig.price = 'Music', 480
+        gig.save()
+        other.is_unlisted = True
+        other.save()
+        self.assertEqual(self.counts()[0], {'Music': 1})
+        self.assertCountsCorrect()
+
+        other.is_unlisted = False
+        other.save()
+        gig.delete()
+        self.assertEqual(self.counts()[0], {'Music': 1})
+        self.assertCountsCorrect()
+
+    def test_partial_instances_do_not_recount(self):
+        gig = self.create_gig(images=0, category='Design', price=40)
+        with mock.patch('gigs.counters.rebuild_listing_counts') as rebuild:
+            partial = Gig.objects.only('id', 'title').get(pk=gig.pk)
+            partial.title = 'Renamed'
+            partial.save()
+
+            unlisted = Gig.objects.only('id', 'is_unlisted').get(pk=gig.pk)
+            unlisted.is_unlisted = True
+            unlisted.save()
+            self.assertEqual(self.counts()[0], {})
+
+            Gig.objects.only('id').get(pk=gig.pk).delete()
+        rebuild.assert_not_called()
+        self.assertCountsCorrect()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'The gig search index is SQLite FTS5.')
+class GigSearchTests(GigTestCase):
+    def search(self, query, queryset=None, max_candidates=2000):
+        queryset = Gig.objects.filter(is_unlisted=False) if queryset is None else queryset
+        return [gig.title for gig in SQLiteFTSSearchBackend(max_candidates).search(queryset, query)]
+
+    def test_title_matches_rank_first(self):
+        self.create_gig(title='Wedding photos', description='Also a logo on request')
+        self.create_gig(title='Logo design', description='Brand marks')
+        self.create_gig(title='Piano lessons', description='Beginners welcome')
+        self.assertEqual(self.search('logo'), ['Logo design', 'Wedding photos'])
+
+    def test_prefix_matching(self):
+        self.create_gig(title='Graphic designer', description='Posters')
+        self.assertEqual(self.search('desi'), ['Graphic designer'])
+        self.assertEqual(self.search('de'), ['Graphic designer'])
+
+    def test_index_follows_updates_and_unlisting(self):
+        gig = self.create_gig(title='Logo design', description='Brand marks')
+        gig.title = 'Piano lessons'
+        gig.save()
+        self.assertEqual(self.search('logo'), [])
+        self.assertEqual(self.search('piano'), ['Piano lessons'])
+
+        gig.is_unlisted = True
+        gig.save()
+        self.assertEqual(self.search('piano', Gig.objects.all()), [])
+
+    def test_filtered_search_keeps_matches_outside_the_window(self):
+        for idx in range(3):
+            self.create_gig(title=f'Logo {idx}', category='Design')
+        for idx in range(3):
+            self.create_gig(title=f'Logo jingle {idx}', category='Music')
+
+        designs = Gig.objects.filter(is_unlisted=False, category='Design')
+        self.assertEqual(sorted(self.search('logo', designs, max_candidates=2)), ['Logo 0', 'Logo 1', 'Logo 2'])
+        # The newest two are ranked, the oldest follows them.
+        self.assertEqual(self.search('logo', designs, max_candidates=2)[-1], 'Logo 0')
+
+        response = self.client.get('/gigs/', {'search': 'logo', 'category': 'Design'}).json()['data']
+        self.assertEqual(response['total'], 3)
+
+
+class GigFeedCacheTests(GigTestCase):
+    def test_repeated_feed_is_served_from_cache(self):
+        gig = self.create_gig()
+        response = self.client.get('/gigs/', {'category': ' Design'}).json()['data']
+        self.assertEqual((response['total'], [g['id'] for g in response['gigs']]), (1, [gig.id]))
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/gigs/', {'category': 'Design', 'page': '1'})
+        response = response.json()['data']
+        self.assertEqual((response['total'], [g['id'] for g in response['gigs']]), (1, [gig.id]))
+
+    def test_gig_write_invalidates_feed(self):
+        gig = self.create_gig()
+        self.client.get('/gigs/')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/gigs/update/{gig.id}/', {'title': 'Brand design'})
+
+        response = self.client.get('/gigs/')
+        self.assertEqual(response.json()['data']['gigs'][0]['title'], 'Brand design')
+
+
+class BlobStorageTests(GigTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # The uploads are not decodable images; variants are out of scope here.
+        patcher = mock.patch('gigs.images.schedule_derivatives')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, content=b'same bytes', name='photo.jpg'):
+        return SimpleUploadedFile(name, content, content_type='image/jpeg')
+
+    def post_gig(self, *uploads):
+        return self.client.post('/gigs/create/', {
+            'title': 'Logo design',
+            'description': 'Custom logos',
+            'price': '100',
+            'category': 'Design',
+            'location': 'Lahore',
+            'images': list(uploads),
+        }, format='multipart')
+
+    def test_identical_uploads_share_one_blob(self):
+        with self.captureOnCommitCallbacks():
+            self.post_gig(self.upload(name='a.jpg'), self.upload(name='b.JPG'))
+            self.post_gig(self.upload(name='c.jpg'))
+
+        names = set(GigImage.objects.values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual(blob.name, names.pop())
+        self.assertTrue(default_storage.exists(blob.name))
+
+    def test_blob_reclaimed_with_last_reference(self):
+        with self.captureOnCommitCallbacks():
+            first = self.post_gig(self.upload()).json()['data']['id']
+            second = self.post_gig(self.upload()).json()['data']['id']
+        name = Blob.objects.get().name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/gigs/update/{first}/', {
+                'replace_images': 'true', 'images': [self.upload(b'other bytes')]
+            }, format='multipart')
+        self.assertEqual(Blob.objects.get(name=name).ref_count, 1)
+        self.assertTrue(default_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/gigs/delete/{second}/')
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertFalse(default_storage.exists(name))
+
+
+    def test_images_are_one_insert(self):
+        uploads = [self.upload(f'bytes {idx}'.encode(), f'{idx}.jpg') for idx in range(3)]
+        with self.captureOnCommitCallbacks(), CaptureQueriesContext(connection) as queries:
+            response = self.post_gig(*uploads)
+        self.assertEqual(response.status_code, 201)
+
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT INTO "gigs_gigimage"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(GigImage.objects.count(), 3)
+
+    def test_failed_image_write_leaves_nothing_behind(self):
+        with self.captureOnCommitCallbacks():
+            self.post_gig(self.upload())
+        blob = Blob.objects.get()
+        gigs_while_writing = []
+
+        def write_or_fail(upload):
+            if upload.name == 'broken.jpg':
+                raise OSError('Disk full')
+            return write_blob(upload)
+
+        def count_then_write(uploads):
+            gigs_while_writing.append(Gig.objects.count())
+            return write_uploads(uploads)
+
+        with mock.patch('gigs.images.write_blob', write_or_fail), \
+                mock.patch('gigs.views.write_uploads', count_then_write), self.captureOnCommitCallbacks():
+            response = self.post_gig(self.upload(), self.upload(b'new bytes', 'new.jpg'), self.upload(name='broken.jpg'))
+        self.assertEqual(response.status_code, 500)
+
+        # The files are written before the gig row exists.
+        self.assertEqual(gigs_while_writing, [1])
+        self.assertEqual(Gig.objects.count(), 1)
+        self.assertEqual(list(Blob.objects.values_list('name', 'ref_count')), [(blob.name, 1)])
+        self.assertTrue(default_storage.exists(blob.name))
+        self.assertFalse(default_storage.exists(blob_name(hashlib.sha256(b'new bytes').hexdigest(), 'new.jpg')))
+
+class GigImageVariantTests(GigTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Built inline below; the worker closing the test's connection would
+        # end its transaction.
+        for target in ('gigs.images.schedule_derivatives', 'gigs.images.close_old_connections'):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload_image(self, size=(800, 600), name='photo.png'):
+        buffer = BytesIO()
+        Image.new('RGBA', size, (200, 40, 40, 128)).save(buffer, format='PNG')
+        upload = SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+        with self.captureOnCommitCallbacks():
+            response = self.client.post('/gigs/create/', {
+                'title': 'Logo design',
+                'description': 'Custom logos',
+                'price': '100',
+                'category': 'Design',
+                'location': 'Lahore',
+                'images': [upload],
+            }, format='multipart')
+        return GigImage.objects.get(gig_id=response.json()['data']['id'])
+
+    @override_settings(GIG_IMAGE_VARIANTS={'thumbnail': 320, 'medium': 1280})
+    def test_variants_are_resized_webp_and_jpeg(self):
+        gig_image = self.upload_image(size=(800, 600))
+        generate_derivatives([gig_image.id])
+        gig_image.refresh_from_db()
+
+        variants = gig_image.variants
+        self.assertEqual(set(variants), {'thumbnail', 'medium'})
+        # Longest edge capped, aspect ratio kept, never upscaled.
+        expected = {'thumbnail': (320, 240), 'medium': (800, 600)}
+        for variant, size in expected.items():
+            entry = variants[variant]
+            self.assertEqual((entry['width'], entry['height']), size)
+            for extension, image_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                self.assertTrue(entry[extension].endswith(f'.{extension}'))
+                with default_storage.open(entry[extension]) as stored:
+                    image = Image.open(stored)
+                    image.load()
+                self.assertEqual(image.format, image_format)
+                self.assertEqual(image.size, size)
+                # Transparency is flattened onto white for both formats.
+                self.assertEqual(image.mode, 'RGB')
+
+        response = self.client.get(f'/gigs/{gig_image.gig_id}/')
+        urls = response.json()['data']['imageVariants'][0]
+        self.assertTrue(urls['webp'].endswith(variants['medium']['webp']))
+        self.assertTrue(urls['jpeg'].endswith(variants['medium']['jpeg']))
+
+    def test_rebuild_with_new_settings_writes_new_names(self):
+        gig_image = self.upload_image()
+        generate_derivatives([gig_image.id])
+        gig_image.refresh_from_db()
+        old_names = variant_names(gig_image.variants)
+        old_bytes = {path: default_storage.open(path).read() for path in old_names}
+        stem = gig_image.image.name.rsplit('/', 1)[1].split('.')[0]
+        self.assertTrue(all(path.startswith(f'derivatives/{stem}_') for path in old_names))
+
+        # Same settings: the files already written are reused as they are.
+        generate_derivatives([gig_image.id], rebuild=True)
+        gig_image.refresh_from_db()
+        self.assertEqual(variant_names(gig_image.variants), old_names)
+        self.assertEqual({path: default_storage.open(path).read() for path in old_names}, old_bytes)
+
+        with override_settings(GIG_IMAGE_WEBP_QUALITY=40, GIG_IMAGE_VARIANT_VERSION=2):
+            generate_derivatives([gig_image.id], rebuild=True)
+        gig_image.refresh_from_db()
+        new_names = variant_names(gig_image.variants)
+        self.assertFalse(set(new_names) & set(old_names))
+        self.assertTrue(all(default_storage.exists(path) for path in new_names))
+        # Nothing else used the old files, so they went with the rebuild.
+        self.assertFalse(any(default_storage.exists(path) for path in old_names))
+
+    def test_rebuild_keeps_variants_other_gigs_still_use(self):
+        first = self.upload_image()
+        second = self.upload_image()
+        self.assertEqual(first.image.name, second.image.name)
+        generate_derivatives([first.id, second.id])
+        second.refresh_from_db()
+        old_names = variant_names(second.variants)
+
+        with override_settings(GIG_IMAGE_VARIANT_VERSION=2):
+            generate_derivatives([first.id], rebuild=True)
+        self.assertTrue(all(default_storage.exists(path) for path in old_names))
+
+
+class GigFacetTests(GigTestCase):
+    def setUp(self):
+        super().setUp()
+        for category, price in [('Design', 40), ('Design', 120), ('Design', 480), ('Music', 130), ('Music', 990)]:
+            self.create_gig(images=0, category=category, price=price)
+        self.create_gig(images=0, category='Music', price=150, is_unlisted=True)
+
+    def facets(self, **params):
+        response = self.client.get('/gigs/facets/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_unfiltered(self):
+        data = self.facets(priceBucket=500)
+        self.assertEqual(data['total'], 5)
+        self.assertEqual(data['categories'], [
+            {'category': 'Design', 'count': 3},
+            {'category': 'Music', 'count': 2},
+        ])
+        self.assertEqual(data['priceHistogram']['buckets'], [
+            {'min': 0.0, 'max': 500.0, 'count': 4},
+            {'min': 500.0, 'max': 1000.0, 'count': 1},
+        ])
+
+    def test_each_facet_ignores_its_own_filter(self):
+        data = self.facets(category='Design', minPrice=100, maxPrice=135, priceBucket=100)
+        self.assertEqual(data['total'], 1)
+        self.assertEqual(data['categories'], [
+            {'category': 'Design', 'count': 1},
+            {'category': 'Music', 'count': 1},
+        ])
+        self.assertEqual([bucket['count'] for bucket in data['priceHistogram']['buckets']], [1, 1, 1])
+
+    def test_counters_follow_price_changes(self):
+        gig = Gig.objects.get(price=990)
+        gig.price = '60'
+        gig.save()
+        data = self.facets(minPrice=50, maxPrice=700)
+        self.assertEqual(data['categories'], [
+            {'category': 'Design', 'count': 2},
+            {'category': 'Music', 'count': 2},
+        ])
+
+    def test_invalid_bucket(self):
+        response = self.client.get('/gigs/facets/', {'priceBucket': 75})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cached(self):
+        data = self.facets(category=' Music')
+        self.assertEqual(data['total'], 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.facets(category='Music'), data)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific.')
+class GigQueryPlanTests(GigTestCase):
+    """Fails when a hot query reads the gigs table without an index."""
+
+    def assertIndexed(self, queryset, index):
+        plan = queryset.explain()
+        for line in plan.splitlines():
+            if re.search(r'\bSCAN gigs_gig\b(?! USING)', line):
+                self.fail(f"Full scan of gigs_gig:\n{plan}")
+        self.assertIn(index, plan)
+
+    def page(self, params, cursor=False):
+        queryset, filter_kwargs = filter_gigs(params)
+        ordering = gig_ordering(filter_kwargs)[1]
+        queryset = queryset.order_by(*ordering)
+        if cursor:
+            queryset = queryset.filter(keyset_filter(ordering, (timezone.now(), 10)))
+        return queryset[:11]
+
+    def test_feed(self):
+        self.assertIndexed(self.page({}), 'gigs_listed_newest_idx')
+        self.assertIndexed(self.page({}, cursor=True), 'SEARCH gigs_gig USING INDEX gigs_listed_newest_idx')
+
+    def test_feed_by_category(self):
+        self.assertIndexed(self.page({'category': 'Design'}), 'gigs_listed_category_idx')
+        self.assertIndexed(
+            self.page({'category': 'Design'}, cursor=True), 'gigs_listed_category_idx (category=? AND created_at<?)'
+        )
+
+    def test_feed_by_price(self):
+        params = {'minPrice': '100', 'maxPrice': '300'}
+        self.assertIndexed(self.page(params), 'gigs_listed_price_idx')
+        self.assertIndexed(filter_gigs(params)[0].order_by().values('id'), 'gigs_listed_price_idx')
+
+    def test_feed_by_category_and_price(self):
+        params = {'category': 'Design', 'minPrice': '100'}
+        self.assertIndexed(self.page(params), 'gigs_listed_cat_price_idx')
+        self.assertIndexed(filter_gigs(params)[0].order_by().values('id'), 'gigs_listed_cat_price_idx')
+
+    def test_feed_near(self):
+        self.assertIndexed(self.page({'near': '31.52,74.35', 'radius': '5'}), 'gigs_geohash_idx')
+
+    def test_feed_search(self):
+        self.assertIndexed(self.page({'search': 'logo'}), 'SEARCH gigs_gig USING INTEGER PRIMARY KEY')
+
+    def test_facet_price_edges(self):
+        self.assertIndexed(_category_counts_in_range('120', '870'), 'gigs_listed_price_idx')
+
+    def test_my_gigs(self):
+        # accounts.views.get_my_info
+        self.assertIndexed(Gig.objects.filter(creator=self.user, is_unlisted=False), 'gigs_listed_creator_idx')
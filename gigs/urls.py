@@ -3,8 +3,11 @@ from . import views
 
 urlpatterns = [
     path('', views.get_gigs, name='get_gigs'),
+    path('batch/', views.get_gigs_by_ids, name='get_gigs_by_ids'),
+    path('facets/', views.get_gig_facets, name='get_gig_facets'),
     path('<int:gig_id>/', views.get_gig_by_id, name='get_gig_by_id'),
     path('create/', views.create_gig, name='create_gig'),
     path('update/<int:gig_id>/', views.update_gig, name='update_gig'),
     path('delete/<int:gig_id>/', views.delete_gig, name='delete_gig'),
+    path('cache-stats/', views.get_cache_stats, name='get_cache_stats'),
 ]
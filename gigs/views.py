@@ -1,14 +1,21 @@
-import os
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import default_storage
 from django.contrib.auth.decorators import login_required
-from .models import Gig, GigImage
+from django.conf import settings
+from .models import Gig
 from accounts.models import User
-from .serializers import GigSerializer
+from . import geo
+from .serializers import serialize_gigs
+from .images import attach_images, discard_uploads, write_uploads
+from .search import get_search_backend
+from .counters import cached_count, listed_count
+from .pagination import InvalidCursor, keyset_page
+from .cache import cache_stats, get_cached, make_key, normalize_params, set_cached
+from .facets import FACET_PARAMS, bucket_width, category_counts, price_histogram
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 
 @csrf_exempt
 @api_view(['POST'])
@@ -28,36 +35,42 @@ def create_gig(request):
                     'error': 'All fields including are required.'
                 }, status=400)
 
-            gig = Gig.objects.create(
-                title=title,
-                description=description,
-                price=float(price),
-                category=category,
-                location=location,
-                creator=request.user
-            )
-
             if 'images' not in request.FILES:
                 return JsonResponse({
                     'success': False,
                     'error': 'At least one image is required.'
                 }, status=400)
 
-            images = request.FILES.getlist('images')
-
-            for idx, image in enumerate(images):
-                filename = f"{gig.id}_{idx}_{image.name}"
-                image_path = os.path.join('uploads', filename)
+            latitude = request.POST.get('latitude')
+            longitude = request.POST.get('longitude')
+            if latitude and longitude:
+                latitude, longitude = geo.parse_coordinates(latitude, longitude)
+            else:
+                latitude = longitude = None
 
-                with default_storage.open(image_path, 'wb') as f:
-                    for chunk in image.chunks():
-                        f.write(chunk)
-                        
-                GigImage.objects.create(gig=gig, image=image_path)
+            images = request.FILES.getlist('images')
+            stored = write_uploads(images)
+
+            try:
+                with transaction.atomic():
+                    gig = Gig.objects.create(
+                        title=title,
+                        description=description,
+                        price=float(price),
+                        category=category,
+                        location=location,
+                        latitude=latitude,
+                        longitude=longitude,
+                        creator=request.user
+                    )
+                    attach_images(gig, stored, images)
+            except Exception:
+                discard_uploads(stored)
+                raise
 
             return JsonResponse({
                 'success': True,
-                'data': GigSerializer(gig).data
+                'data': serialize_gigs([gig], variant='medium')[0]
             }, status=201)
 
         return JsonResponse({
@@ -65,54 +78,203 @@ def create_gig(request):
             'error': 'Invalid request method.'
         }, status=405)
 
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
     except Exception as e:
         return JsonResponse({
             'success': False,
             'error': str(e)
         }, status=500)
 
+def filter_gigs(params):
+    filter_kwargs = {'is_unlisted': False}
+    category = params.get('category')
+    if category:
+        filter_kwargs['category'] = category
+
+    min_price = params.get('minPrice')
+    max_price = params.get('maxPrice')
+    if min_price:
+        filter_kwargs['price__gte'] = min_price
+    if max_price:
+        filter_kwargs['price__lte'] = max_price
+
+    queryset = Gig.objects.filter(**filter_kwargs).select_related('creator')
+
+    near = params.get('near')
+    if near:
+        latitude, longitude = geo.parse_point(near)
+        radius = geo.parse_radius(
+            params.get('radius'), settings.GIG_NEAR_DEFAULT_RADIUS_KM, settings.GIG_NEAR_MAX_RADIUS_KM
+        )
+        cells = geo.covering_cells(latitude, longitude, radius)
+        if cells:
+            queryset = queryset.filter(geo.within_cells(cells))
+        queryset = queryset.annotate(
+            distance=geo.distance_km(latitude, longitude)
+        ).filter(distance__lte=radius)
+        filter_kwargs['near'] = (latitude, longitude, radius)
+
+    # Searched last so the search backend sees every other filter.
+    search_query = params.get('search')
+    if search_query:
+        queryset = get_search_backend().search(queryset, search_query)
+        filter_kwargs['search'] = search_query
+
+    if near:
+        queryset = queryset.order_by('distance', 'id')
+
+    return queryset, filter_kwargs
+
+
+def count_gigs(queryset, filter_kwargs):
+    if set(filter_kwargs) <= {'is_unlisted', 'category'}:
+        return listed_count(filter_kwargs.get('category'))
+    return cached_count(queryset, filter_kwargs)
+
+
+def gig_ordering(filter_kwargs):
+    if 'near' in filter_kwargs:
+        return 'nearest', ('distance', 'id')
+    if 'search' in filter_kwargs:
+        return 'relevance', ('search_rank', '-id')
+    return 'newest', ('-created_at', '-id')
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_gigs(request):
     try:
-        page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 10))
-        skip = (page - 1) * limit
+        params = normalize_params(request.GET)
+        cache_key = make_key('feed', params)
+        cached = get_cached(cache_key)
+        if cached is not None:
+            return JsonResponse(cached)
+
+        limit = int(params['limit'])
+        queryset, filter_kwargs = filter_gigs(params)
+        total = count_gigs(queryset, filter_kwargs)
+
+        if params['cursor'] is not None:
+            ordering_key, ordering = gig_ordering(filter_kwargs)
+            try:
+                gigs, next_cursor = keyset_page(
+                    queryset, ordering, limit, params['cursor'], key=ordering_key
+                )
+            except InvalidCursor as e:
+                return JsonResponse({
+                    'success': False,
+                    'error': str(e)
+                }, status=400)
+        else:
+            page = int(params['page'])
+            skip = (page - 1) * limit
+            # Same order as cursor pages, so either walks the feed identically.
+            queryset = queryset.order_by(*gig_ordering(filter_kwargs)[1])
+            gigs = list(queryset[skip:skip + limit + 1])
+            has_more = len(gigs) > limit
+            gigs = gigs[:limit]
+
+        gigs_data = serialize_gigs(gigs)
+
+        if params['cursor'] is not None:
+            response_data = {
+                'success': True,
+                'data': {
+                    'gigs': gigs_data,
+                    'total': total,
+                    'nextCursor': next_cursor,
+                    'hasMore': next_cursor is not None
+                }
+            }
+        else:
+            response_data = {
+                'success': True,
+                'data': {
+                    'gigs': gigs_data,
+                    'total': total,
+                    'currentPage': page,
+                    'totalPages': (total // limit) + (1 if total % limit > 0 else 0),
+                    'hasMore': has_more
+                }
+            }
 
-        filter_kwargs = {'is_unlisted': False}
-        category = request.GET.get('category')
-        if category:
-            filter_kwargs['category'] = category
+        set_cached(cache_key, response_data)
+        return JsonResponse(response_data)
 
-        min_price = request.GET.get('minPrice')
-        max_price = request.GET.get('maxPrice')
-        if min_price or max_price:
-            filter_kwargs['price__gte'] = min_price if min_price else 0
-            filter_kwargs['price__lte'] = max_price if max_price else float('inf')
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+def _without(params, *names):
+    params = params.copy()
+    for name in names:
+        params.pop(name, None)
+    return params
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_gig_facets(request):
+    try:
+        params = normalize_params(request.GET, names=FACET_PARAMS)
+        cache_key = make_key('facets', params, names=FACET_PARAMS)
+        cached = get_cached(cache_key)
+        if cached is not None:
+            return JsonResponse(cached)
+
+        width = bucket_width(params['priceBucket'])
+        queryset, filter_kwargs = filter_gigs(params)
+        # Each facet ignores its own filter, so the client can offer the alternatives.
+        category_queryset, category_filters = filter_gigs(_without(params, 'category'))
+        price_queryset, price_filters = filter_gigs(_without(params, 'minPrice', 'maxPrice'))
+
+        response_data = {
+            'success': True,
+            'data': {
+                'total': count_gigs(queryset, filter_kwargs),
+                'categories': category_counts(category_queryset, category_filters),
+                'priceHistogram': {
+                    'bucketSize': float(width),
+                    'buckets': price_histogram(price_queryset, price_filters, width),
+                },
+            }
+        }
 
-        search_query = request.GET.get('search')
-        if search_query:
-            filter_kwargs['title__icontains'] = search_query
+        set_cached(cache_key, response_data)
+        return JsonResponse(response_data)
 
-        gigs = Gig.objects.filter(**filter_kwargs)[skip:skip + limit]
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
 
-        total = Gig.objects.filter(**filter_kwargs).count()
 
-        gigs_data = []
-        for gig in gigs:
-            gig_data = GigSerializer(gig).data
-            gig_data['images'] = [image.image.url for image in gig.images.all()]
-            gigs_data.append(gig_data)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_gig_by_id(request, gig_id):
+    try:
+        gig = get_object_or_404(Gig.objects.select_related('creator'), id=gig_id, is_unlisted=False)
 
         return JsonResponse({
             'success': True,
-            'data': {
-                'gigs': gigs_data,
-                'total': total,
-                'currentPage': page,
-                'totalPages': (total // limit) + (1 if total % limit > 0 else 0),
-                'hasMore': skip + len(gigs) < total
-            }
+            'data': serialize_gigs([gig], variant='medium')[0]
         })
 
     except Exception as e:
@@ -121,20 +283,44 @@ def get_gigs(request):
             'error': str(e)
         }, status=500)
 
+
+def parse_ids(params):
+    """Gig ids from `ids=1,2,3` or repeated `ids` parameters, deduplicated in order."""
+    ids = []
+    for value in params.getlist('ids'):
+        for part in value.split(','):
+            if part.strip():
+                ids.append(int(part))
+    ids = list(dict.fromkeys(ids))
+    max_ids = settings.GIG_BATCH_MAX_IDS
+    if len(ids) > max_ids:
+        raise ValueError(f'At most {max_ids} ids can be requested at once.')
+    return ids
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
-def get_gig_by_id(request, gig_id):
+def get_gigs_by_ids(request):
     try:
-        gig = get_object_or_404(Gig, id=gig_id, is_unlisted=False)
-        gig_data = GigSerializer(gig).data
+        ids = parse_ids(request.GET)
+        gigs = Gig.objects.select_related('creator').in_bulk(ids)
 
-        gig_data['images'] = [image.image.url for image in gig.images.all()]
+        listed = [gigs[gig_id] for gig_id in ids if gig_id in gigs and not gigs[gig_id].is_unlisted]
 
         return JsonResponse({
             'success': True,
-            'data': gig_data
+            'data': {
+                'gigs': serialize_gigs(listed, variant='medium'),
+                'missing': [gig_id for gig_id in ids if gig_id not in gigs],
+                'unlisted': [gig_id for gig_id in ids if gig_id in gigs and gigs[gig_id].is_unlisted],
+            }
         })
 
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -147,7 +333,7 @@ def get_gig_by_id(request, gig_id):
 @permission_classes([IsAuthenticated])
 def update_gig(request, gig_id):
     try:
-        gig = get_object_or_404(Gig, id=gig_id)
+        gig = get_object_or_404(Gig.objects.select_related('creator'), id=gig_id)
 
         if request.method == 'PUT':
             title = request.POST.get('title')
@@ -167,35 +353,32 @@ def update_gig(request, gig_id):
                 gig.category = category
             if location:
                 gig.location = location
+            latitude = request.POST.get('latitude')
+            longitude = request.POST.get('longitude')
+            if latitude and longitude:
+                gig.latitude, gig.longitude = geo.parse_coordinates(latitude, longitude)
 
-            if 'images' in request.FILES:
-                images = request.FILES.getlist('images')
-                
-                if replace_images:
-                    for existing_image in gig.images.all():
-                        if default_storage.exists(existing_image.image.name):
-                            default_storage.delete(existing_image.image.name)
-                        existing_image.delete()
-
-                for idx, image in enumerate(images):
-                    filename = f"{gig.id}_{idx}_{image.name}"
-                    image_path = os.path.join('uploads', filename)
-
-                    with default_storage.open(image_path, 'wb') as f:
-                        for chunk in image.chunks():
-                            f.write(chunk)
+            images = request.FILES.getlist('images')
+            stored = write_uploads(images)
 
-                    gig_image = GigImage(gig=gig, image=image_path)
-                    gig_image.save()
+            try:
+                with transaction.atomic():
+                    if images:
+                        if replace_images:
+                            # Files are reclaimed by the post_delete signal once
+                            # no other image or review shares their blob.
+                            gig.images.all().delete()
 
-            gig.save()
+                        attach_images(gig, stored, images)
 
-            updated_gig_data = GigSerializer(gig).data
-            updated_gig_data['images'] = [image.image.url for image in gig.images.all()]
+                    gig.save()
+            except Exception:
+                discard_uploads(stored)
+                raise
 
             return JsonResponse({
                 'success': True,
-                'data': updated_gig_data
+                'data': serialize_gigs([gig], variant='medium')[0]
             })
 
         return JsonResponse({
@@ -203,6 +386,11 @@ def update_gig(request, gig_id):
             'error': 'Invalid request method.'
         }, status=405)
 
+    except ValueError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=400)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -225,11 +413,7 @@ def delete_gig(request, gig_id):
                 'error': 'You are not authorized to delete this gig.'
             }, status=403)  
 
-        if gig.images.exists():
-            for gig_image in gig.images.all(): 
-                if default_storage.exists(gig_image.image.path):  
-                    default_storage.delete(gig_image.image.path)  
-                gig_image.delete()  
+        gig.images.all().delete()
 
         gig.is_unlisted = True
         gig.save()
@@ -244,3 +428,12 @@ def delete_gig(request, gig_id):
             'success': False,
             'error': str(e)
         }, status=500)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_cache_stats(request):
+    return JsonResponse({
+        'success': True,
+        'data': cache_stats()
+    })
@@ -0,0 +1,9 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from gigs.storage import release_blob
+from .models import Review
+
+
+@receiver(post_delete, sender=Review)
+def release_payment_proof_blob(sender, instance, **kwargs):
+    release_blob(instance.payment_proof.name)
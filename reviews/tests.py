@@ -1,3 +1,73 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from accounts.models import User
+from chats.models import ChatRoom
+from gigs.models import Blob, Gig
+from .models import Review
 
-# Create your tests here.
+
+class PaymentProofTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.buyer = User.objects.create_user(phone_number='+920000000001', password='secret', name='Buyer')
+        self.seller = User.objects.create_user(phone_number='+920000000002', password='secret', name='Seller')
+        self.gig = Gig.objects.create(
+            title='Logo design', description='Custom logos', price=100, category='Design',
+            location='Lahore', creator=self.seller,
+        )
+        self.room = ChatRoom.objects.create(gig=self.gig, buyer=self.buyer, seller=self.seller)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def post_review(self, content=b'receipt bytes', name='proof.jpg'):
+        return self.client.post('/reviews/', {
+            'chatRoomId': self.room.id,
+            'rating': '4',
+            'comment': 'Great work',
+            'paymentProof': SimpleUploadedFile(name, content, content_type='image/jpeg'),
+        }, format='multipart')
+
+    def test_proof_is_stored_as_a_blob(self):
+        response = self.post_review()
+        self.assertEqual(response.status_code, 201)
+
+        review = Review.objects.get()
+        blob = Blob.objects.get()
+        self.assertEqual(review.payment_proof.name, blob.name)
+        self.assertRegex(blob.name, r'^blobs/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(blob.ref_count, 1)
+        with default_storage.open(blob.name) as stored:
+            self.assertEqual(stored.read(), b'receipt bytes')
+        self.gig.refresh_from_db()
+        self.assertEqual(self.gig.number_of_raters, 1)
+
+    def test_identical_proofs_share_one_blob(self):
+        self.post_review(name='a.jpg')
+        self.post_review(name='b.JPG')
+
+        names = set(Review.objects.values_list('payment_proof', flat=True))
+        self.assertEqual(names, {Blob.objects.get().name})
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_blob_released_with_the_last_review(self):
+        self.post_review()
+        self.post_review()
+        name = Blob.objects.get().name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.first().delete()
+        self.assertEqual(Blob.objects.get(name=name).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.get().delete()
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertFalse(default_storage.exists(name))
@@ -1,5 +1,4 @@
-import os
-from django.core.files.storage import default_storage
+from django.db import transaction
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -7,6 +6,7 @@ from rest_framework import status
 from decimal import Decimal
 from .models import Review
 from chats.models import ChatRoom
+from gigs.storage import acquire_blob, write_blob
 from .serializers import ReviewSerializer
 
 @api_view(['POST'])
@@ -48,28 +48,23 @@ def create_review(request):
                 'error': 'Only the buyer can submit a review.'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        review_count = Review.objects.filter(gig=gig, buyer=request.user).count()
-        filename = f"{gig.id}_{request.user.id}_{review_count + 1}{os.path.splitext(payment_proof.name)[1]}"
-        file_path = os.path.join('payment_proofs', filename)
+        sha256, file_path = write_blob(payment_proof)
 
-        with default_storage.open(file_path, 'wb') as destination:
-            for chunk in payment_proof.chunks():
-                destination.write(chunk)
-            
-        review = Review.objects.create(
-            gig=gig,
-            buyer=request.user,
-            seller=seller,
-            rating=rating,
-            comment=comment,
-            payment_proof=file_path,
-        )
-        
-        total_rating = gig.rating * gig.number_of_raters  
-        gig.number_of_raters += 1  
-        new_rating = (total_rating + rating) / gig.number_of_raters  
-        gig.rating = new_rating  
-        gig.save()  
+        with transaction.atomic():
+            review = Review.objects.create(
+                gig=gig,
+                buyer=request.user,
+                seller=seller,
+                rating=rating,
+                comment=comment,
+                payment_proof=acquire_blob(sha256, file_path, payment_proof),
+            )
+
+            total_rating = gig.rating * gig.number_of_raters  
+            gig.number_of_raters += 1  
+            new_rating = (total_rating + rating) / gig.number_of_raters  
+            gig.rating = new_rating  
+            gig.save()  
 
         serialized_review = ReviewSerializer(review)
 